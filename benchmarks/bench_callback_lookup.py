@@ -0,0 +1,104 @@
+"""
+Measures the SentMessage lookup CallbackView performs for every delivery
+receipt, SentMessage.objects.filter(uuid=...), on a large table with and
+without the uuid index added in migration 0006.
+
+Fills wrapper_sentmessage with --rows synthetic messages using
+generate_series, so it needs PostgreSQL and a scratch database:
+
+    $ DB_NAME=text_api_bench env/bin/python benchmarks/bench_callback_lookup.py --rows 10000000
+
+The uuid indexes are dropped for the "before" run and recreated from their
+original definitions afterwards.
+"""
+import argparse
+import hashlib
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'text_api.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from wrapper.models import SentMessage, Server  # noqa: E402
+
+
+def fill(rows):
+    Server.objects.all().delete()
+    server = Server.objects.create(url='http://bench.invalid/', weight=1)
+    with connection.cursor() as cursor:
+        cursor.execute('TRUNCATE wrapper_sentmessage')
+        cursor.execute(
+            """
+            INSERT INTO wrapper_sentmessage (uuid, number, status, start_time, end_time, server_id)
+            SELECT md5(i::text), lpad(i::text, 10, '0'), 'delivered',
+                   now() - i * interval '1 millisecond', now(), %s
+            FROM generate_series(1, %s) AS i
+            """,
+            [server.id, rows],
+        )
+        cursor.execute('ANALYZE wrapper_sentmessage')
+
+
+def uuid_indexes():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE tablename = 'wrapper_sentmessage' AND indexdef LIKE %s
+            """,
+            ['%(uuid%'],
+        )
+        return cursor.fetchall()
+
+
+def time_lookups(rows, lookups):
+    timings = []
+    for _ in range(lookups):
+        uuid = hashlib.md5(str(random.randint(1, rows)).encode()).hexdigest()
+        start = time.perf_counter()
+        SentMessage.objects.filter(uuid=uuid)[0]
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    cuts = statistics.quantiles(timings, n=100)
+    print(f"{name:>8} {statistics.mean(timings) * 1000:>10.3f} {cuts[49] * 1000:>10.3f} {cuts[98] * 1000:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--lookups', type=int, default=50)
+    parser.add_argument('--skip-fill', action='store_true', help='reuse rows from a previous run')
+    args = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    if not args.skip_fill:
+        fill(args.rows)
+
+    indexes = uuid_indexes()
+    print(f"{'index':>8} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    try:
+        with connection.cursor() as cursor:
+            for name, _ in indexes:
+                cursor.execute(f'DROP INDEX {name}')
+        report('without', time_lookups(args.rows, args.lookups))
+    finally:
+        with connection.cursor() as cursor:
+            for _, definition in indexes:
+                cursor.execute(definition)
+    report('with', time_lookups(args.rows, args.lookups * 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Simulates steady traffic against local stub providers with different
+latency profiles and compares the tail latency of every LoadBalancer
+strategy.
+
+Each provider is given as latency:concurrency, a fixed service time in
+seconds and how many messages it works on at once; requests beyond that
+queue up at the provider. --clients threads send through one balancer,
+and every round trip is fed back to its latency tracker the way delivery
+callbacks are in production.
+
+The balancer is given a fixed server list, so no database is touched:
+
+    $ env/bin/python benchmarks/bench_strategies.py --providers 0.02:8 0.05:8 0.2:4 --clients 32
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'text_api.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from wrapper.health import HealthRegistry  # noqa: E402
+from wrapper.inflight import InFlightCounter  # noqa: E402
+from wrapper.latency import LatencyTracker  # noqa: E402
+from wrapper.load_balancer import LoadBalancer  # noqa: E402
+from wrapper.registry import ServerEntry, ServerRegistry, ServerSnapshot  # noqa: E402
+from wrapper.sessions import SessionPool  # noqa: E402
+from wrapper.stubs import StubProvider  # noqa: E402
+
+
+class FixedRegistry(ServerRegistry):
+    def __init__(self, servers):
+        super().__init__(ttl=float('inf'))
+        self.servers = servers
+
+    def load(self):
+        return ServerSnapshot(self.servers)
+
+
+def simulate(strategy, servers, args):
+    tracker = LatencyTracker()
+    tracker.seed({}, [server.id for server in servers])
+    balancer = LoadBalancer(
+        strategy=strategy,
+        registry=FixedRegistry(servers),
+        tracker=tracker,
+        sessions=SessionPool(pool_size=args.clients),
+        health=HealthRegistry(),
+        in_flight=InFlightCounter(),
+    )
+    latencies = []
+    routed = {server.url: 0 for server in servers}
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(args.requests // args.clients):
+            start = time.perf_counter()
+            balancer.request({'to_number': '5550000000', 'message': 'benchmark'})
+            elapsed = time.perf_counter() - start
+            tracker.observe(balancer.targeted_server.id, elapsed * 1e6)
+            with lock:
+                latencies.append(elapsed)
+                routed[balancer.targeted_url] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    balancer.sessions.close()
+    return latencies, [routed[server.url] for server in servers]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--providers', nargs='+', default=['0.02:8', '0.05:8', '0.2:4'])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=3200)
+    parser.add_argument('--strategies', nargs='+', default=LoadBalancer.strategies)
+    args = parser.parse_args()
+
+    stubs = []
+    for profile in args.providers:
+        latency, concurrency = profile.split(':')
+        stubs.append(StubProvider(latency=float(latency), concurrency=int(concurrency)).start())
+    servers = [ServerEntry(i, stub.url, 1) for i, stub in enumerate(stubs, 1)]
+
+    print(f"{'strategy':>18} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  share per provider")
+    try:
+        for strategy in args.strategies:
+            latencies, routed = simulate(strategy, servers, args)
+            cuts = statistics.quantiles(latencies, n=100)
+            shares = ' '.join(f'{count / len(latencies):>5.0%}' for count in routed)
+            print(
+                f"{strategy:>18} {statistics.mean(latencies) * 1000:>9.1f} {cuts[49] * 1000:>9.1f} "
+                f"{cuts[94] * 1000:>9.1f} {cuts[98] * 1000:>9.1f}  {shares}"
+            )
+    finally:
+        for stub in stubs:
+            stub.stop()
+
+
+if __name__ == '__main__':
+    main()
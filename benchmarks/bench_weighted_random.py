@@ -0,0 +1,58 @@
+"""
+Micro-benchmark for the weighted_random strategy.
+
+Compares the original list-expansion selector, which built a list holding
+int(weight * 100) copies of every url on each call, against the cumulative
+weight bisect used by ServerSnapshot.weighted_choice.
+
+    $ env/bin/python benchmarks/bench_weighted_random.py --servers 3 10 100
+"""
+import argparse
+from decimal import Decimal
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'text_api.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from wrapper.registry import ServerEntry, ServerSnapshot  # noqa: E402
+
+
+def list_expansion(servers):
+    serv_list = []
+    for server in servers:
+        weight = int(server.weight * 100)
+        weight_as_list = [server.url for i in range(weight)]
+        serv_list.extend(weight_as_list)
+    return random.choice(serv_list)
+
+
+def make_servers(count):
+    return [
+        ServerEntry(i, f'https://provider{i}.example.com', Decimal(random.randint(1, 99)) / 100)
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', type=int, nargs='+', default=[3, 10, 100])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'servers':>8} {'list expansion':>16} {'bisect':>12} {'speedup':>9}")
+    for count in args.servers:
+        servers = make_servers(count)
+        snapshot = ServerSnapshot(servers)
+        old = timeit.timeit(lambda: list_expansion(servers), number=args.number) / args.number
+        new = timeit.timeit(snapshot.weighted_choice, number=args.number) / args.number
+        print(f"{count:>8} {old * 1e6:>13.2f} us {new * 1e6:>9.2f} us {old / new:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
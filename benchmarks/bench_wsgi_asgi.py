@@ -0,0 +1,130 @@
+"""
+Compares send throughput under WSGI and ASGI against a local stub provider.
+
+Starts a StubProvider, points the Server table at it, then serves the app
+twice: with gunicorn on text_api.wsgi, driving the synchronous /send/, and
+with uvicorn on text_api.asgi, driving the async /send_async/. Each run
+fires the same number of sends at the same concurrency and reports
+requests per second and latency percentiles.
+
+The Server table is replaced, so run this against a scratch database:
+
+    $ DB_NAME=text_api_bench env/bin/python benchmarks/bench_wsgi_asgi.py \\
+        --requests 2000 --concurrency 200 --latency 0.2
+
+Requires the packages in requirements/bench.txt.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'text_api.settings')
+
+import django  # noqa: E402
+django.setup()
+
+import httpx  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+
+from wrapper.models import Server  # noqa: E402
+from wrapper.stubs import StubProvider  # noqa: E402
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f'Nothing listening on port {port} after {timeout}s')
+
+
+async def drive(url, total, concurrency):
+    latencies = []
+    failures = 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker(client):
+        nonlocal failures
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json={'number': f'555{i:07d}', 'message': 'benchmark'})
+                if response.status_code != 200:
+                    failures += 1
+            except httpx.HTTPError:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies, failures
+
+
+def run(name, command, port, path, args):
+    env = dict(os.environ, LB_STRAT='round_robin')
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        elapsed, latencies, failures = asyncio.run(
+            drive(f'http://127.0.0.1:{port}{path}', args.requests, args.concurrency)
+        )
+    finally:
+        process.terminate()
+        process.wait()
+    cuts = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name:>5} {args.requests / elapsed:>10.1f} {cuts[49] * 1000:>9.1f} "
+        f"{cuts[94] * 1000:>9.1f} {cuts[98] * 1000:>9.1f} {failures:>9}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2, help='stub provider latency in seconds')
+    parser.add_argument('--workers', type=int, default=1, help='server processes for both runs')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    stub = StubProvider(latency=args.latency).start()
+    Server.objects.all().delete()
+    Server(url=stub.url, weight=1).save()
+
+    workers = str(args.workers)
+    print(f"{'mode':>5} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'failures':>9}")
+    try:
+        run('wsgi', [
+            sys.executable, '-m', 'gunicorn', 'text_api.wsgi',
+            '--bind', f'127.0.0.1:{args.port}', '--workers', workers, '--threads', str(args.threads),
+        ], args.port, '/send/', args)
+        run('asgi', [
+            sys.executable, '-m', 'uvicorn', 'text_api.asgi:application',
+            '--port', str(args.port), '--workers', workers, '--log-level', 'warning',
+        ], args.port, '/send_async/', args)
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'wrapper.profiling.profiling_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,6 +57,13 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'text_api.urls'
 
+# Request profiling (see wrapper.profiling): the share of requests to
+# profile, whether an X-Profile header turns it on for a request, and
+# where to append the profiles.
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_HEADER = os.getenv('PROFILING_HEADER', 'off') == 'on'
+PROFILING_LOG = os.getenv('PROFILING_LOG')
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -16,12 +16,20 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from wrapper.views import CallbackView, LBView, SendView, ListMessageView
+from wrapper.views import CallbackView, LBView, LBWeightsView, SendView, ListMessageView, MetricsView, StatsView, ProviderHealthView, ProviderPoolView, SendBatchView, send_async
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('send/', SendView.as_view()),
+    path('send_async/', send_async),
+    path('send_batch/', SendBatchView.as_view()),
     path('ingest/', CallbackView.as_view()),
     path('list_messages/', ListMessageView.as_view()),
-    path('update_lb_strat/', LBView.as_view())
+    path('update_lb_strat/', LBView.as_view()),
+    path('lb_weights/', LBWeightsView.as_view()),
+    path('provider_pools/', ProviderPoolView.as_view()),
+    path('provider_health/', ProviderHealthView.as_view()),
+    path('stats/', StatsView.as_view()),
+    # No trailing slash: /metrics is where Prometheus scrapes by default.
+    path('metrics', MetricsView.as_view()),
 ]
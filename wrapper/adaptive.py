@@ -0,0 +1,145 @@
+from decimal import Decimal
+import os
+import statistics
+import threading
+import time
+
+from wrapper.health import HEALTH
+from wrapper.latency import TRACKER
+from wrapper.registry import ServerSnapshot
+
+
+class WeightController:
+    """
+    Adjusts the weights that weighted_random and weighted_round_robin route
+    by, shifting traffic away from providers that are slow or failing and
+    back once they recover. Configured from the environment:
+        LB_ADAPTIVE_WEIGHTS   `on` to adjust weights (off)
+        LB_ADAPTIVE_INTERVAL  seconds between adjustments (10)
+        LB_ADAPTIVE_DAMPING   share of the way to its target a weight moves per adjustment (0.3)
+        LB_ADAPTIVE_FLOOR     lowest weight, as a share of the configured one (0.1)
+
+    Each adjustment works out a target for every server from its configured
+    weight, its tracked latency relative to the median of all servers, and
+    the error rate its circuit breaker has seen:
+
+        target = weight * median latency / latency * (1 - error rate) ** 2
+
+    kept between `floor` and `ceiling` times the configured weight. The
+    effective weight then moves only `damping` of the way there, and is
+    rounded to the precision of Server.weight, so a few slow callbacks
+    don't make traffic flap and small drifts change nothing.
+    """
+
+    def __init__(self, tracker=None, health=None, enabled=None, interval=None, damping=None, floor=None,
+                 ceiling=4, latency_metric=None, clock=time.monotonic):
+        self.tracker = tracker or TRACKER
+        self.health = health or HEALTH
+        self.enabled = enabled if enabled is not None else os.getenv('LB_ADAPTIVE_WEIGHTS', 'off') == 'on'
+        self.interval = float(interval if interval is not None else os.getenv('LB_ADAPTIVE_INTERVAL', '10'))
+        self.damping = float(damping if damping is not None else os.getenv('LB_ADAPTIVE_DAMPING', '0.3'))
+        self.floor = float(floor if floor is not None else os.getenv('LB_ADAPTIVE_FLOOR', '0.1'))
+        self.ceiling = ceiling
+        self.latency_metric = latency_metric or os.getenv('LB_LATENCY_METRIC', 'mean')
+        self.clock = clock
+        # Called with the new weights whenever an adjustment changes them.
+        self.on_change = None
+        self._lock = threading.Lock()
+        self._weights = {}
+        self._adjusted_at = None
+        self._version = 0
+        self._snapshots = {}
+
+    def apply(self, servers):
+        """
+        Returns `servers` as a snapshot carrying their effective weights,
+        adjusting them first if `interval` has passed. The snapshot is
+        reused until the weights change, so routing stays a lookup.
+        """
+        if not self.enabled:
+            return servers
+        now = self.clock()
+        if self._adjusted_at is None or now - self._adjusted_at >= self.interval:
+            with self._lock:
+                if self._adjusted_at is None or now - self._adjusted_at >= self.interval:
+                    self.adjust(servers)
+                    self._adjusted_at = now
+
+        cached = self._snapshots.get(id(servers))
+        if cached is not None and cached[0] is servers and cached[1] == self._version:
+            return cached[2]
+        weights = self._weights
+        adjusted = ServerSnapshot(server._replace(weight=weights.get(server.id, server.weight)) for server in servers)
+        if len(self._snapshots) >= 16:
+            self._snapshots.clear()
+        self._snapshots[id(servers)] = (servers, self._version, adjusted)
+        return adjusted
+
+    def adjust(self, servers):
+        """
+        Moves every server's effective weight one step toward its target.
+        """
+        latencies = self.tracker.estimates(self.latency_metric)
+        known = [latencies[server.id] for server in servers if latencies.get(server.id)]
+        median = statistics.median(known) if known else None
+
+        weights = dict(self._weights)
+        for server in servers:
+            configured = float(server.weight)
+            if configured <= 0:
+                weights[server.id] = Decimal(0)
+                continue
+            target = configured * (1 - self.health.error_rate(server.url)) ** 2
+            if median and latencies.get(server.id):
+                target *= median / latencies[server.id]
+            target = min(max(target, self.floor * configured), self.ceiling * configured)
+            current = float(weights.get(server.id, server.weight))
+            weight = current + self.damping * (target - current)
+            weights[server.id] = max(Decimal(weight).quantize(Decimal('0.01')), Decimal('0.01'))
+
+        if weights != self._weights:
+            self._weights = weights
+            self._version += 1
+            if self.on_change is not None:
+                self.on_change(weights)
+
+    def receive(self, weights):
+        """
+        Takes on the weights another process adjusted to, and waits a full
+        `interval` before adjusting from them, so processes take turns
+        rather than each moving every weight.
+        """
+        with self._lock:
+            self._weights = dict(weights)
+            self._version += 1
+            self._adjusted_at = self.clock()
+
+    def describe(self, servers):
+        """
+        The configured and effective weight of each server, with the
+        latency (microseconds) and error rate they were adjusted for. Only
+        reads the current weights: it never adjusts them.
+        """
+        weights = self._weights if self.enabled else {}
+        latencies = self.tracker.estimates(self.latency_metric)
+        return [
+            {
+                'id': server.id,
+                'url': server.url,
+                'weight': float(server.weight),
+                'effective_weight': float(weights.get(server.id, server.weight)),
+                'latency': latencies.get(server.id),
+                'error_rate': self.health.error_rate(server.url),
+            }
+            for server in servers
+        ]
+
+    def reset(self):
+        with self._lock:
+            self._weights = {}
+            self._adjusted_at = None
+            self._version += 1
+            self._snapshots = {}
+
+
+WEIGHTS = WeightController()
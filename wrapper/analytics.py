@@ -0,0 +1,241 @@
+from datetime import timedelta
+from itertools import islice
+import math
+import os
+import threading
+import time
+
+import numpy as np
+from django.db.models import FloatField, Func
+from django.utils import timezone
+
+from wrapper.models import SentMessage
+from wrapper.pagination import InvalidQuery
+
+
+DELIVERED_STATUSES = ['delivered']
+FAILED_STATUSES = ['failed', 'failed_to_send', 'invalid', 'undelivered']
+QUANTILES = [0.5, 0.95, 0.99]
+MAX_BUCKETS = 1440
+LOAD_CHUNK_SIZE = 10000
+
+
+class Epoch(Func):
+    """
+    A datetime column in seconds since the epoch, as a float worked out by
+    the database. NULL stays NULL.
+    """
+    template = 'EXTRACT(EPOCH FROM %(expressions)s)'
+    output_field = FloatField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # SQLite stores 'YYYY-MM-DD HH:MM:SS[.ffffff]' in UTC: whole seconds
+        # from strftime, plus the fraction, which julianday() would round.
+        return super().as_sql(
+            compiler, connection,
+            template="(CAST(strftime('%%%%s', %(expressions)s) AS REAL) + CAST(substr(%(expressions)s, 20) AS REAL))",
+            **extra_context,
+        )
+
+
+class Deliveries:
+    """
+    The messages sent through each server in a time range, as parallel
+    arrays: server id, start and end in epoch seconds (end is NaN until
+    the delivery callback), and status.
+    """
+
+    def __init__(self, server, start, end, status):
+        self.server = server
+        self.start = start
+        self.end = end
+        self.status = status
+
+    @classmethod
+    def load(cls, since, until, chunk_size=LOAD_CHUNK_SIZE):
+        """
+        Reads the messages started in [since, until) with start and end
+        already in epoch seconds, filling the arrays `chunk_size` rows at a
+        time rather than building a list of every row.
+        """
+        rows = (
+            SentMessage.objects
+            .filter(start_time__gte=since, start_time__lt=until, server__isnull=False)
+            .annotate(start_epoch=Epoch('start_time'), end_epoch=Epoch('end_time'))
+            .values_list('server_id', 'start_epoch', 'end_epoch', 'status')
+            .iterator(chunk_size=chunk_size)
+        )
+        columns = ([], [], [], [])
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            servers, starts, ends, statuses = columns
+            servers.append(np.fromiter((row[0] for row in chunk), dtype=np.int64, count=len(chunk)))
+            starts.append(np.fromiter((row[1] for row in chunk), dtype=np.float64, count=len(chunk)))
+            ends.append(np.fromiter(
+                (np.nan if row[2] is None else row[2] for row in chunk), dtype=np.float64, count=len(chunk),
+            ))
+            statuses.append(np.array([row[3] for row in chunk], dtype=object))
+        return cls(*(
+            np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+            for parts, dtype in zip(columns, (np.int64, np.float64, np.float64, object))
+        ))
+
+    @property
+    def latency(self):
+        return self.end - self.start
+
+
+def grouped_quantiles(groups, values, size, quantiles=QUANTILES):
+    """
+    Returns a (len(quantiles), size) array of the quantiles of `values`
+    within each group 0..size-1, interpolated linearly like np.quantile,
+    NaN for empty groups. One sort covers every group.
+    """
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    counts = np.bincount(groups, minlength=size)
+    first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = np.full((len(quantiles), size), np.nan)
+    present = counts > 0
+    for i, q in enumerate(quantiles):
+        position = first[present] + q * (counts[present] - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, first[present] + counts[present] - 1)
+        result[i, present] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def delivery_stats(deliveries, since, until, bucket):
+    """
+    Per server: messages sent, delivery and failure rates and latency
+    percentiles over the whole range, and the same as time series of
+    `bucket` second buckets starting at `since`. Latencies are in seconds
+    and only count delivered or failed messages that have been reported.
+    """
+    size = math.ceil((until - since).total_seconds() / bucket)
+    index = ((deliveries.start - since.timestamp()) // bucket).astype(np.int64)
+    delivered = np.isin(deliveries.status, DELIVERED_STATUSES).astype(np.float64)
+    failed = np.isin(deliveries.status, FAILED_STATUSES).astype(np.float64)
+    latency = deliveries.latency
+    completed = ~np.isnan(latency)
+
+    servers = {}
+    for server in np.unique(deliveries.server):
+        mine = deliveries.server == server
+        sent = np.bincount(index[mine], minlength=size)
+        reported = mine & completed
+        overall = grouped_quantiles(np.zeros(reported.sum(), dtype=np.int64), latency[reported], 1)[:, 0]
+        series = grouped_quantiles(index[reported], latency[reported], size)
+        servers[int(server)] = {
+            'sent': int(mine.sum()),
+            'completed': int(reported.sum()),
+            'delivery_rate': _rate(delivered[mine].sum(), mine.sum()),
+            'failure_rate': _rate(failed[mine].sum(), mine.sum()),
+            'latency': dict(zip(_labels(), _floats(overall))),
+            'series': {
+                'sent': sent.tolist(),
+                'delivery_rate': _floats(_rates(np.bincount(index[mine], delivered[mine], size), sent)),
+                'failure_rate': _floats(_rates(np.bincount(index[mine], failed[mine], size), sent)),
+                **dict(zip(_labels(), (_floats(row) for row in series))),
+            },
+        }
+    return {
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'bucket': bucket,
+        'buckets': [(since + timedelta(seconds=bucket * i)).isoformat() for i in range(size)],
+        'servers': servers,
+    }
+
+
+def parse_window(params):
+    """
+    Reads the `window` (minutes, 60 by default) and `bucket` (seconds, 60
+    by default) query parameters of /stats/.
+    """
+    try:
+        window = int(params.get('window', 60))
+        bucket = int(params.get('bucket', 60))
+    except ValueError:
+        raise InvalidQuery('window and bucket must be integers')
+    if not 0 < window <= 7 * 24 * 60:
+        raise InvalidQuery('window must be between 1 and 10080 minutes')
+    if bucket <= 0 or window * 60 / bucket > MAX_BUCKETS:
+        raise InvalidQuery(f'bucket must be positive and split the window into at most {MAX_BUCKETS} buckets')
+    return window, bucket
+
+
+class StatsCache:
+    """
+    Caches /stats/ results per (window, bucket) for `ttl` seconds,
+    STATS_CACHE_TTL (30) by default. Only one request per key computes a
+    missing result while the others wait for it, so dashboards polling
+    the same view cost one query per TTL.
+    """
+
+    def __init__(self, ttl=None, capacity=64, clock=time.monotonic):
+        self.ttl = float(ttl if ttl is not None else os.getenv('STATS_CACHE_TTL', '30'))
+        self.capacity = capacity
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._computing = {}
+
+    def get(self, window, bucket):
+        key = (window, bucket)
+        with self._lock:
+            result = self._fresh(key)
+            if result is not None:
+                return result
+            computing = self._computing.setdefault(key, threading.Lock())
+        with computing:
+            with self._lock:
+                result = self._fresh(key)
+            if result is not None:
+                return result
+            result = self.compute(window, bucket)
+            with self._lock:
+                if len(self._entries) >= self.capacity:
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k][0])]
+                self._entries[key] = (self.clock(), result)
+                self._computing.pop(key, None)
+            return result
+
+    def compute(self, window, bucket):
+        until = timezone.now()
+        since = until - timedelta(minutes=window)
+        return delivery_stats(Deliveries.load(since, until), since, until, bucket)
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}
+
+    # private
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.clock() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+
+def _labels():
+    return [f'p{round(q * 100)}' for q in QUANTILES]
+
+
+def _rate(count, total):
+    return float(count / total) if total else None
+
+
+def _rates(counts, totals):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(totals > 0, counts / totals, np.nan)
+
+
+def _floats(values):
+    return [None if np.isnan(value) else round(float(value), 6) for value in values]
+
+
+STATS = StatsCache()
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class WrapperConfig(AppConfig):
     name = 'wrapper'
+
+    def ready(self):
+        import wrapper.signals  # noqa: F401
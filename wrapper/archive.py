@@ -0,0 +1,174 @@
+from io import BytesIO
+from itertools import islice
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from wrapper.models import SentMessage
+
+
+COLUMNS = ['id', 'uuid', 'number', 'message', 'status', 'start_time', 'end_time', 'server_id']
+FORMATS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+
+
+def pyarrow():
+    """
+    Imports pyarrow, which is only needed for exports and imports, so it
+    lives in requirements/analytics.txt rather than the app's requirements.
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Message archives need pyarrow: pip install -r requirements/analytics.txt')
+    return pyarrow
+
+
+def file_format(path):
+    for extension, name in FORMATS.items():
+        if path.endswith(extension):
+            return name
+    raise ValueError(f"Can't tell the format of {path}: use one of {', '.join(FORMATS)}")
+
+
+def schema():
+    pa = pyarrow()
+    timestamp = pa.timestamp('us', tz='UTC')
+    return pa.schema([
+        ('id', pa.int64()),
+        ('uuid', pa.string()),
+        ('number', pa.string()),
+        ('message', pa.string()),
+        ('status', pa.string()),
+        ('start_time', timestamp),
+        ('end_time', timestamp),
+        ('server_id', pa.int64()),
+    ])
+
+
+def export_messages(messages, path, batch_size=50000, compression='zstd'):
+    """
+    Writes the SentMessage queryset `messages` to `path`, a Parquet file
+    or an Arrow IPC file depending on its extension, `batch_size` rows at
+    a time. Rows are read as tuples through a server-side cursor, so
+    neither model instances nor the whole result are ever held in memory.
+    Returns the number of rows written.
+    """
+    pa = pyarrow()
+    columns = schema()
+    rows = messages.values_list(*COLUMNS).iterator(chunk_size=batch_size)
+    written = 0
+    with _writer(path, columns, compression) as writer:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*batch), columns)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=columns))
+            written += len(batch)
+    return written
+
+
+def read_batches(path, batch_size=50000):
+    """
+    Yields the record batches of an export. Arrow IPC files are memory
+    mapped, so uncompressed ones are read without copying.
+    """
+    pa = pyarrow()
+    if file_format(path) == 'parquet':
+        yield from pa.parquet.ParquetFile(path).iter_batches(batch_size=batch_size)
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def import_messages(path, batch_size=50000, keep_ids=True, skip_existing=False):
+    """
+    Loads an export back into SentMessage in one transaction, with COPY on
+    PostgreSQL. With `keep_ids` the exported ids are kept, and the id
+    sequence moved past them; otherwise rows get new ids. Returns the
+    number of rows loaded.
+
+    Kept ids are checked against the table first, since the partitioned
+    table can't enforce their uniqueness on its own. If any is taken,
+    ValueError is raised and nothing is loaded, unless `skip_existing`
+    is set, in which case those rows are left out. On PostgreSQL the
+    table is locked against other writes while ids are kept, so that no
+    message sent meanwhile takes one of them from the sequence.
+    """
+    columns = COLUMNS if keep_ids else COLUMNS[1:]
+    loaded = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        if keep_ids and connection.vendor == 'postgresql':
+            cursor.execute(f'LOCK TABLE {SentMessage._meta.db_table} IN SHARE ROW EXCLUSIVE MODE')
+        for batch in read_batches(path, batch_size):
+            batch = batch.select(columns)
+            if keep_ids:
+                batch = _without_existing(batch, skip_existing)
+            if connection.vendor == 'postgresql':
+                _copy(cursor, batch, columns)
+            else:
+                _insert(cursor, batch, columns)
+            loaded += batch.num_rows
+        if keep_ids:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [SentMessage]):
+                cursor.execute(sql)
+    return loaded
+
+
+# private
+
+def _writer(path, columns, compression):
+    pa = pyarrow()
+    compression = None if compression == 'none' else compression
+    if file_format(path) == 'parquet':
+        return pa.parquet.ParquetWriter(path, columns, compression=compression or 'none')
+    return pa.ipc.new_file(path, columns, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+
+def _without_existing(batch, skip_existing, chunk_size=10000):
+    ids = batch.column('id').to_pylist()
+    existing = set()
+    for start in range(0, len(ids), chunk_size):
+        existing.update(
+            SentMessage.objects.filter(id__in=ids[start:start + chunk_size]).values_list('id', flat=True)
+        )
+    if not existing:
+        return batch
+    if not skip_existing:
+        raise ValueError(
+            f'{len(existing)} of the imported ids, such as {min(existing)}, are already taken: '
+            'import with new ids or skip the existing ones'
+        )
+    return batch.filter(pyarrow().array([row_id not in existing for row_id in ids]))
+
+
+def _copy(cursor, batch, columns):
+    # Nulls are written as unquoted empty fields and empty strings as "",
+    # which is how COPY's CSV format tells them apart.
+    buffer = BytesIO()
+    pyarrow().csv.write_csv(batch, buffer)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {SentMessage._meta.db_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, HEADER true)",
+        buffer,
+    )
+
+
+def _insert(cursor, batch, columns):
+    adapt = {
+        name: connection.ops.adapt_datetimefield_value
+        for name in columns if name in ('start_time', 'end_time')
+    }
+    values = [
+        [adapt[name](value) if name in adapt else value for value in batch.column(name).to_pylist()]
+        for name in columns
+    ]
+    cursor.executemany(
+        f"INSERT INTO {SentMessage._meta.db_table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(['%s'] * len(columns))})",
+        list(zip(*values)),
+    )
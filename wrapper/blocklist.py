@@ -0,0 +1,142 @@
+import hashlib
+import math
+import os
+import threading
+import time
+
+from wrapper.models import InvalidNumber
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter sized for `capacity` items at the given false
+    positive rate. Membership tests never give false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def _positions(self, item):
+        # Kirsch-Mitzenmacher double hashing: k positions from one digest.
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+
+class InvalidNumberCache:
+    """
+    Answers "has this number been marked invalid?" without a database
+    round trip in the common case. A Bloom filter over every InvalidNumber
+    rules out numbers that were never blocked; only possible matches are
+    confirmed with an indexed lookup.
+
+    New rows are added as they are saved in this process (see
+    wrapper.signals) and picked up from other processes every
+    INVALID_NUMBER_REFRESH seconds by loading rows with a higher id than
+    any seen so far, less `overlap` ids: a row can commit after rows with
+    higher ids, and the overlap catches it on a later refresh. Rows later
+    still are caught by rebuilding the whole filter every
+    INVALID_NUMBER_REBUILD_EVERY (60) refreshes. The filter is also
+    rebuilt, at twice the size, once it holds more than
+    INVALID_NUMBER_CAPACITY numbers.
+    """
+
+    def __init__(self, ttl=None, capacity=None, error_rate=0.01, overlap=1000, rebuild_every=None):
+        self.ttl = float(ttl if ttl is not None else os.getenv('INVALID_NUMBER_REFRESH', '60'))
+        self.capacity = int(capacity or os.getenv('INVALID_NUMBER_CAPACITY', '1000000'))
+        self.error_rate = error_rate
+        self.overlap = overlap
+        self.rebuild_every = int(
+            rebuild_every if rebuild_every is not None else os.getenv('INVALID_NUMBER_REBUILD_EVERY', '60')
+        )
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._last_id = 0
+        self._loaded_at = 0
+        self._refreshes = 0
+
+    def contains(self, number):
+        if not self.might_contain(number):
+            return False
+        return InvalidNumber.objects.filter(number=number).exists()
+
+    def filter(self, numbers):
+        """
+        Returns the subset of `numbers` that are marked invalid, querying
+        only for the ones the filter cannot rule out.
+        """
+        candidates = {number for number in numbers if self.might_contain(number)}
+        if not candidates:
+            return set()
+        return set(InvalidNumber.objects.filter(number__in=candidates).values_list('number', flat=True))
+
+    def might_contain(self, number):
+        return number in self.refresh()
+
+    def is_fresh(self):
+        return self._bloom is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def refresh(self):
+        """
+        Loads any rows not seen yet once the TTL has passed, and returns the
+        current filter.
+        """
+        bloom = self._bloom
+        if bloom is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return bloom
+        with self._lock:
+            if self.is_fresh():
+                return self._bloom
+            self._refreshes += 1
+            bloom, last_id = self._bloom, self._last_id
+            since = max(last_id - self.overlap, 0)
+            if bloom is None or (self.rebuild_every and self._refreshes % self.rebuild_every == 0):
+                # Rebuilt filters are filled before being published so that
+                # readers never see a partially loaded one.
+                bloom, last_id, since = BloomFilter(self.capacity, self.error_rate), 0, 0
+            while True:
+                rows = (
+                    InvalidNumber.objects
+                    .filter(id__gt=since)
+                    .order_by('id')
+                    .values_list('id', 'number')
+                )
+                seen = last_id
+                for row_id, number in rows.iterator():
+                    # Rows in the overlap are mostly loaded already, and
+                    # must not count toward the capacity twice.
+                    if row_id > seen or number not in bloom:
+                        bloom.add(number)
+                    last_id = max(last_id, row_id)
+                if bloom.count <= bloom.capacity:
+                    break
+                self.capacity = bloom.count * 2
+                bloom, last_id, since = BloomFilter(self.capacity, self.error_rate), 0, 0
+            self._bloom, self._last_id = bloom, last_id
+            self._loaded_at = time.monotonic()
+            return bloom
+
+    def add(self, number):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(number)
+
+    def invalidate(self):
+        with self._lock:
+            self._bloom = None
+
+
+INVALID_NUMBERS = InvalidNumberCache()
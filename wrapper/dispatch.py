@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from wrapper.models import SentMessage
+from wrapper.registry import REGISTRY
+from wrapper.retry import RETRY_POLICY
+
+
+logger = logging.getLogger(__name__)
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+
+def forward(balancer, request_to_forward, idempotency_key=None, policy=None, max_wait=None):
+    """
+    Sends `request_to_forward` through `balancer` under `policy`, RETRY_POLICY
+    by default. Returns the provider's response, or None once retries run out
+    or every provider stays saturated for `max_wait` seconds.
+    """
+    return (policy or RETRY_POLICY).send(
+        balancer, request_to_forward, idempotency_key=idempotency_key, max_wait=max_wait,
+    )
+
+
+def forward_many(balancer, requests_to_forward):
+    """
+    Forwards every request concurrently on a shared pool of
+    SEND_BATCH_CONCURRENCY threads. Returns, in order, a
+    (response, targeted_url, start_time) triple per request, where response
+    is None if that request ran out of retries.
+    """
+    balancer.warm()
+
+    def send(request_to_forward):
+        try:
+            start_time = timezone.now()
+            response = forward(balancer, request_to_forward)
+            return response, balancer.targeted_url, start_time
+        finally:
+            close_old_connections()
+
+    return list(batch_executor().map(send, requests_to_forward))
+
+
+def batch_executor():
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv('SEND_BATCH_CONCURRENCY', '16')),
+                thread_name_prefix='send-batch',
+            )
+        return _batch_executor
+
+
+def build_request(number, message):
+    return {
+        "to_number": number,
+        "message": message,
+        "callback_url": os.getenv('CALLBACK_URL'),
+    }
+
+
+class Dispatcher:
+    """
+    Drains messages that SendView accepted in queue mode. Each pass claims
+    up to `batch_size` queued rows, marking them as dispatching so that
+    concurrent dispatchers skip them, and forwards them to the providers on
+    a pool of `workers` threads.
+
+    A claim is a lease: the row records which dispatcher claimed it and
+    when, renewed as each message's send starts. Only rows whose lease is
+    older than `lease` seconds, DISPATCH_LEASE_SECONDS (300) by default,
+    are taken to belong to a dispatcher that died and may be requeued.
+    """
+
+    def __init__(self, balancer, workers=4, batch_size=50, poll_interval=1.0, lease=None):
+        self.balancer = balancer
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = float(lease if lease is not None else os.getenv('DISPATCH_LEASE_SECONDS', '300'))
+        self.name = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def claim(self):
+        with transaction.atomic():
+            ids = list(
+                SentMessage.objects
+                .select_for_update(skip_locked=True)
+                .filter(status='queued')
+                .order_by('start_time', 'id')
+                .values_list('id', flat=True)[:self.batch_size]
+            )
+            SentMessage.objects.filter(id__in=ids).update(
+                status='dispatching', claimed_by=self.name, claimed_at=timezone.now(),
+            )
+        return list(SentMessage.objects.filter(id__in=ids).order_by('start_time', 'id'))
+
+    def send(self, sm):
+        """
+        Forwards one claimed message. Before the first attempt its uuid is set
+        to the Idempotency-Key sent with it, so a message requeued after a
+        dispatcher died mid-send goes out again under the same key and a
+        provider that honours the key won't deliver it twice.
+
+        A message whose lease was lost, requeued while it waited in this
+        batch, is left to whichever dispatcher has it now. A message that
+        fails for any other reason than running out of retries is marked
+        failed_to_send rather than stopping the batch.
+        """
+        sm.uuid = sm.uuid or uuid.uuid4().hex
+        renewed = (
+            SentMessage.objects
+            .filter(id=sm.id, status='dispatching', claimed_by=self.name)
+            .update(uuid=sm.uuid, claimed_at=timezone.now())
+        )
+        if not renewed:
+            return sm
+        try:
+            sm.start_time = timezone.now()
+            # Nobody is waiting on a queued send, so it waits for room up to
+            # the deadline rather than THROTTLE_MAX_WAIT.
+            response = forward(
+                self.balancer, build_request(sm.number, sm.message), idempotency_key=sm.uuid, max_wait=math.inf,
+            )
+            if response is None:
+                sm.status = 'failed_to_send'
+                sm.uuid = None
+            else:
+                sm.status = 'pending'
+                sm.uuid = response.json()["message_id"]
+                target = REGISTRY.snapshot().get(self.balancer.targeted_url)
+                sm.server_id = target.id if target else None
+            sm.save(update_fields=['status', 'uuid', 'server', 'start_time'])
+        except Exception as e:
+            logger.error(f'The following exception occured:\n{e}')
+            sm.status = 'failed_to_send'
+            try:
+                SentMessage.objects.filter(id=sm.id).update(status=sm.status)
+            except Exception as e:
+                logger.error(f'The following exception occured:\n{e}')
+        return sm
+
+    def run_once(self):
+        """
+        Dispatches one batch and returns the messages it handled.
+        """
+        claimed = self.claim()
+        if self.executor is None:
+            return [self.send(sm) for sm in claimed]
+        return list(self.executor.map(self._send_in_worker, claimed))
+
+    def run(self, should_stop=lambda: False):
+        while not should_stop():
+            if not self.run_once():
+                time.sleep(self.poll_interval)
+
+    def requeue_dispatching(self, now=None):
+        """
+        Returns rows left in the dispatching state by a dispatcher that
+        stopped mid-batch to the queue, once their lease has expired. Rows
+        other dispatchers are still sending are left alone.
+        """
+        expired = (now or timezone.now()) - timedelta(seconds=self.lease)
+        return (
+            SentMessage.objects
+            .filter(status='dispatching')
+            .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=expired))
+            .update(status='queued', claimed_by=None, claimed_at=None)
+        )
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    # private
+
+    def _send_in_worker(self, sm):
+        try:
+            return self.send(sm)
+        finally:
+            close_old_connections()
@@ -0,0 +1,296 @@
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+from django.db import close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_failure(status_code):
+    """
+    Whether a provider response counts against its health. Server errors
+    and throttling do; other client errors are about the request, not the
+    provider.
+    """
+    return status_code >= 500 or status_code == 429
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of the last `window` requests to one provider.
+
+    closed     requests flow; once at least `min_requests` outcomes are
+               recorded and the failure rate reaches `error_threshold`, the
+               breaker opens.
+    open       the provider is skipped for `open_seconds`, then the breaker
+               goes half open.
+    half_open  up to `half_open_probes` requests are let through at once;
+               a success closes the breaker and a failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=20, error_threshold=0.5, min_requests=5, open_seconds=30,
+                 half_open_probes=1, clock=time.monotonic, on_change=None):
+        self.on_change = on_change
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.clock = clock
+        self._outcomes = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = 0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and self.clock() - self._opened_at >= self.open_seconds:
+            return self.HALF_OPEN
+        return self._state
+
+    @property
+    def error_rate(self):
+        """
+        Share of the remembered requests that failed; 1 while open.
+        """
+        if self.state != self.CLOSED:
+            return 1.0
+        outcomes = list(self._outcomes)
+        return outcomes.count(False) / len(outcomes) if outcomes else 0.0
+
+    def available(self):
+        """
+        Whether routing may pick this provider. Does not reserve anything.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            return self._probes < self.half_open_probes
+        return False
+
+    def acquire(self):
+        """
+        Reserves the right to send one request, taking a probe slot when
+        half open. Returns False if the provider should not be used.
+        """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probes < self.half_open_probes:
+                self._state = self.HALF_OPEN
+                self._probes += 1
+                return True
+            return False
+
+    def release_probe(self):
+        """
+        Gives back a probe slot taken by acquire() for a request that was
+        never sent, so the breaker can still be probed.
+        """
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_success(self):
+        with self._lock:
+            closing = self._state != self.CLOSED
+            if closing:
+                self._close()
+            else:
+                self._outcomes.append(True)
+        if closing:
+            self._changed(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            was_open = self._state == self.OPEN
+            if self._state == self.OPEN:
+                # A request sent before the breaker opened, failing late;
+                # re-opening would push the cool-down back.
+                return
+            if self._state == self.HALF_OPEN:
+                self._open()
+            else:
+                self._outcomes.append(False)
+                failures = self._outcomes.count(False)
+                if len(self._outcomes) >= self.min_requests and failures / len(self._outcomes) >= self.error_threshold:
+                    self._open()
+            opened = self._state == self.OPEN and not was_open
+        if opened:
+            self._changed(self.OPEN)
+
+    def force(self, state):
+        """
+        Opens or closes the breaker because another process's breaker for
+        the same provider did, without reporting the change back.
+        """
+        with self._lock:
+            if state == self.OPEN:
+                self._open()
+            elif state == self.CLOSED and self._state != self.CLOSED:
+                self._close()
+
+    def half_open(self):
+        """
+        Lets probe traffic through an open breaker before its cool-down ends,
+        e.g. once a health check shows the provider answering again.
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                self._state = self.HALF_OPEN
+                self._probes = 0
+
+    def _changed(self, state):
+        if self.on_change is not None:
+            self.on_change(state)
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = self.clock()
+        self._probes = 0
+
+    def _close(self):
+        self._state = self.CLOSED
+        self._outcomes.clear()
+        self._probes = 0
+
+
+class HealthRegistry:
+    """
+    One CircuitBreaker per provider url, configured from the environment:
+        CB_WINDOW           outcomes remembered per provider (20)
+        CB_ERROR_THRESHOLD  failure rate that opens the breaker (0.5)
+        CB_MIN_REQUESTS     outcomes needed before it can open (5)
+        CB_OPEN_SECONDS     seconds a provider is skipped once open (30)
+        CB_HALF_OPEN_PROBES concurrent trial requests when half open (1)
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.settings = {
+            'window': int(os.getenv('CB_WINDOW', '20')),
+            'error_threshold': float(os.getenv('CB_ERROR_THRESHOLD', '0.5')),
+            'min_requests': int(os.getenv('CB_MIN_REQUESTS', '5')),
+            'open_seconds': float(os.getenv('CB_OPEN_SECONDS', '30')),
+            'half_open_probes': int(os.getenv('CB_HALF_OPEN_PROBES', '1')),
+        }
+        self.clock = clock
+        # Called with (url, state) when a breaker opens or closes.
+        self.on_change = None
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def breaker(self, url):
+        breaker = self._breakers.get(url)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(url)
+                if breaker is None:
+                    breaker = self._breakers[url] = CircuitBreaker(
+                        clock=self.clock, on_change=lambda state: self._changed(url, state), **self.settings
+                    )
+        return breaker
+
+    def unavailable(self, servers):
+        """
+        Returns the ids of the servers in `servers` that routing should skip.
+        """
+        return frozenset(
+            server.id for server in servers
+            if server.url in self._breakers and not self._breakers[server.url].available()
+        )
+
+    def record(self, url, status_code=None, error=False):
+        breaker = self.breaker(url)
+        if error or is_failure(status_code):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def states(self):
+        return {url: breaker.state for url, breaker in list(self._breakers.items())}
+
+    def apply(self, url, state):
+        """
+        Mirrors a breaker change made in another process.
+        """
+        self.breaker(url).force(state)
+
+    def error_rate(self, url):
+        breaker = self._breakers.get(url)
+        return breaker.error_rate if breaker else 0.0
+
+    def reset(self):
+        with self._lock:
+            self._breakers = {}
+
+    def _changed(self, url, state):
+        if self.on_change is not None:
+            self.on_change(url, state)
+
+
+class HealthProber:
+    """
+    Background thread that checks every provider each `interval` seconds.
+    A failed check counts as a failed request, so a dead provider is taken
+    out of rotation without waiting for real traffic to fail; a provider
+    answering again is moved to half open so that traffic can confirm it.
+    Any response below 500 counts as the provider being up.
+    """
+
+    def __init__(self, registry, health, sessions, interval, timeout=2):
+        self.registry = registry
+        self.health = health
+        self.sessions = sessions
+        self.interval = interval
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='health-prober', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def probe(self, server):
+        breaker = self.health.breaker(server.url)
+        try:
+            response = self.sessions.session(server.url).head(server.url, timeout=self.timeout)
+            healthy = not is_failure(response.status_code)
+        except Exception as e:
+            logger.error(f'Health check of {server.url} failed:\n{e}')
+            healthy = False
+        if not healthy:
+            breaker.record_failure()
+        elif breaker.state == CircuitBreaker.OPEN:
+            breaker.half_open()
+        return healthy
+
+    def probe_all(self):
+        try:
+            servers = self.registry.snapshot()
+        finally:
+            close_old_connections()
+        return {server.url: self.probe(server) for server in servers}
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error(f'The following exception occured:\n{e}')
+
+
+HEALTH = HealthRegistry()
@@ -0,0 +1,56 @@
+from contextlib import contextmanager
+import threading
+
+
+class InFlightCounter:
+    """
+    Number of requests currently outstanding to each provider url in this
+    process. LoadBalancer counts a request from the moment it is routed
+    until the provider answers or the request fails.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def acquire(self, url, limit=None):
+        """
+        Counts one more request to `url`, unless `limit` are already in
+        flight. Returns whether the request was counted.
+        """
+        with self._lock:
+            count = self._counts.get(url, 0)
+            if limit is not None and count >= limit:
+                return False
+            self._counts[url] = count + 1
+            return True
+
+    def release(self, url):
+        with self._lock:
+            count = self._counts.get(url, 0) - 1
+            if count > 0:
+                self._counts[url] = count
+            else:
+                self._counts.pop(url, None)
+
+    @contextmanager
+    def track(self, url):
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def get(self, url):
+        return self._counts.get(url, 0)
+
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+
+
+IN_FLIGHT = InFlightCounter()
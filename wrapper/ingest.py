@@ -0,0 +1,359 @@
+import atexit
+from datetime import timedelta
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+
+from django.db import DataError, IntegrityError, close_old_connections, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from wrapper.blocklist import INVALID_NUMBERS
+from wrapper.latency import TRACKER
+from wrapper.metrics import DELIVERY_SECONDS, INVALID_NUMBERS_TOTAL
+from wrapper.models import InvalidNumber, SentMessage
+from wrapper.registry import REGISTRY
+
+
+logger = logging.getLogger(__name__)
+
+# Errors that come from a callback itself rather than from the database
+# being unavailable, so retrying it can never succeed.
+BAD_CALLBACK_ERRORS = (TypeError, ValueError, KeyError, DataError, IntegrityError)
+
+
+class CallbackJournal:
+    """
+    Append-only record of callbacks that have been acknowledged but not
+    yet written to the database, so they survive a crashed worker.
+
+    Each journal appends to its own callbacks-<pid>-<token>.ndjson in
+    `directory`; the random token keeps a process that reuses the pid of a
+    crashed one from taking over its journal. On start, journals left
+    behind by processes that are no longer running are claimed and their
+    callbacks replayed, as are other journals under this process's pid,
+    which a process can only have inherited from a dead one.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'callbacks-{os.getpid()}-{uuid.uuid4().hex[:12]}.ndjson')
+        self._file = open(self.path, 'a')
+
+    def append(self, callback):
+        self._file.write(json.dumps(callback) + '\n')
+        self._file.flush()
+
+    def rewrite(self, callbacks):
+        """
+        Replaces the journal with the callbacks still waiting to be written.
+        """
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as temp:
+            temp.writelines(json.dumps(callback) + '\n' for callback in callbacks)
+        os.replace(temp_path, self.path)
+        self._file.close()
+        self._file = open(self.path, 'a')
+
+    def recover(self):
+        """
+        Returns the callbacks recorded in journals of dead processes and
+        removes those journals.
+        """
+        callbacks = []
+        for path in glob.glob(os.path.join(self.directory, 'callbacks-*.ndjson')):
+            if path == self.path or _process_alive(path):
+                continue
+            claimed = f'{self.path}.recovering'
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue  # another process claimed it first
+            callbacks.extend(_drain(claimed))
+        return callbacks
+
+    def dead_letter(self, callback, error):
+        """
+        Records a callback that could not be written in dead-letters.ndjson,
+        which is never replayed.
+        """
+        with open(os.path.join(self.directory, 'dead-letters.ndjson'), 'a') as dead_letters:
+            dead_letters.write(json.dumps({'callback': callback, 'error': f'{error}'}) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+def _drain(path):
+    """
+    Returns the callbacks in the journal at `path` and removes it.
+    """
+    try:
+        with open(path) as journal:
+            callbacks = [json.loads(line) for line in journal if line.strip()]
+    except FileNotFoundError:
+        return []
+    os.remove(path)
+    return callbacks
+
+
+def _process_alive(path):
+    try:
+        # Journals written before the token was added are callbacks-<pid>.ndjson.
+        pid = int(os.path.basename(path)[len('callbacks-'):-len('.ndjson')].split('-')[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class CallbackBuffer:
+    """
+    Buffers delivery receipts so CallbackView can acknowledge them
+    immediately, and writes them to the database in micro-batches once
+    CALLBACK_BATCH_SIZE receipts are waiting or CALLBACK_FLUSH_INTERVAL
+    seconds have passed, whichever comes first.
+
+    Receipts still buffered when the process exits are flushed by an atexit
+    hook. Setting CALLBACK_JOURNAL_DIR also journals every receipt before it
+    is acknowledged, so those buffered by a worker that crashes are
+    replayed by the next one to start.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, journal_dir=None, autostart=True):
+        self.batch_size = int(batch_size or os.getenv('CALLBACK_BATCH_SIZE', '500'))
+        self.flush_interval = float(flush_interval or os.getenv('CALLBACK_FLUSH_INTERVAL', '0.5'))
+        journal_dir = journal_dir or os.getenv('CALLBACK_JOURNAL_DIR')
+        self.journal = CallbackJournal(journal_dir) if journal_dir else None
+        self.autostart = autostart
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._thread = None
+        self._closed = False
+        # atexit hooks are inherited across fork, so a child must not close
+        # (and flush, and rewrite the journal of) its parent's buffer.
+        self._pid = os.getpid()
+        if self.journal:
+            self._pending = self.journal.recover()
+            self.journal.rewrite(self._pending)
+        atexit.register(self.close)
+        if self._pending and self.autostart:
+            self._ensure_thread()
+
+    def add(self, message_id, status, end_time=None):
+        callback = {
+            'message_id': message_id,
+            'status': status,
+            'end_time': (end_time or timezone.now()).isoformat(),
+        }
+        with self._lock:
+            if self.journal:
+                self.journal.append(callback)
+            self._pending.append(callback)
+            full = len(self._pending) >= self.batch_size
+        if self.autostart:
+            self._ensure_thread()
+            if full:
+                self._wakeup.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Writes every buffered callback and returns how many were written.
+        If the batch fails because of a callback in it, the callbacks are
+        written one by one and those that fail are dead-lettered. On any
+        other failure the unwritten callbacks are put back at the head of
+        the buffer.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                write_callbacks(batch)
+                return len(batch)
+            except BAD_CALLBACK_ERRORS:
+                return self._write_each(batch)
+            except Exception:
+                with self._lock:
+                    self._pending = batch + self._pending
+                raise
+            finally:
+                if self.journal:
+                    with self._lock:
+                        self.journal.rewrite(self._pending)
+
+    def close(self):
+        if self._closed or os.getpid() != self._pid:
+            return
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval * 4)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f'Failed to flush buffered callbacks on shutdown:\n{e}')
+        if self.journal:
+            self.journal.close()
+
+    # private
+
+    def _write_each(self, batch):
+        written = 0
+        for i, callback in enumerate(batch):
+            try:
+                write_callbacks([callback])
+                written += 1
+            except BAD_CALLBACK_ERRORS as e:
+                self._dead_letter(callback, e)
+            except Exception:
+                with self._lock:
+                    self._pending = batch[i:] + self._pending
+                raise
+        return written
+
+    def _dead_letter(self, callback, error):
+        logger.error(f'Dropped a callback that cannot be written: {json.dumps(callback)}\n{error}')
+        if self.journal:
+            self.journal.dead_letter(callback, error)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='callback-flusher', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'The following exception occured:\n{e}')
+            finally:
+                close_old_connections()
+
+
+def callback_error(body):
+    """
+    Returns why a delivery receipt cannot be written, or None if it can:
+    its message_id and status must be strings that fit their columns.
+    """
+    if not isinstance(body, dict):
+        return 'The callback must be a JSON object.'
+    for key, field in (('message_id', 'uuid'), ('status', 'status')):
+        max_length = SentMessage._meta.get_field(field).max_length
+        if not isinstance(body.get(key), str) or len(body[key]) > max_length:
+            return f'{key} must be a string of at most {max_length} characters.'
+    return None
+
+
+def write_callbacks(callbacks):
+    """
+    Applies a batch of callbacks in one transaction: one statement to
+    update every SentMessage and one to record newly invalid numbers. When
+    a message has several callbacks in the batch the last one wins.
+    """
+    latest = {}
+    for callback in callbacks:
+        latest[callback['message_id']] = (callback['status'], parse_datetime(callback['end_time']))
+
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            updated = _update_from_values(latest)
+        else:
+            updated = _bulk_update(latest)
+        invalid = {number for _, number, status, _, _ in updated if status == 'invalid'}
+        InvalidNumber.objects.bulk_create(
+            [InvalidNumber(number=number) for number in invalid],
+            ignore_conflicts=True,
+        )
+
+    for server_id, _, _, start_time, end_time in updated:
+        if start_time and end_time:
+            TRACKER.observe(server_id, (end_time - start_time) / timedelta(microseconds=1))
+            DELIVERY_SECONDS.observe((end_time - start_time).total_seconds(), server=REGISTRY.url_for(server_id))
+    for number in invalid:
+        INVALID_NUMBERS.add(number)
+    if invalid:
+        INVALID_NUMBERS_TOTAL.inc(len(invalid), source='reported')
+    return updated
+
+
+def _update_from_values(latest):
+    values = ', '.join(['(%s, %s, %s::timestamptz)'] * len(latest))
+    params = [param for message_id, (status, end_time) in latest.items() for param in (message_id, status, end_time)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {SentMessage._meta.db_table} AS sm
+            SET status = v.status, end_time = v.end_time
+            FROM (VALUES {values}) AS v (uuid, status, end_time)
+            WHERE sm.uuid = v.uuid
+            RETURNING sm.server_id, sm.number, sm.status, sm.start_time, sm.end_time
+            """,
+            params,
+        )
+        return cursor.fetchall()
+
+
+def _bulk_update(latest):
+    messages = list(SentMessage.objects.filter(uuid__in=latest))
+    for sm in messages:
+        sm.status, sm.end_time = latest[sm.uuid]
+    SentMessage.objects.bulk_update(messages, ['status', 'end_time'])
+    return [(sm.server_id, sm.number, sm.status, sm.start_time, sm.end_time) for sm in messages]
+
+
+class LazyCallbackBuffer:
+    """
+    The process's CallbackBuffer, built on the first buffered callback
+    rather than at import, so that commands like migrate open no journal.
+    A forked child (gunicorn --preload) builds its own rather than sharing
+    its parent's journal.
+    """
+
+    def __init__(self, factory=CallbackBuffer):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._buffer = None
+        os.register_at_fork(after_in_child=self._forget)
+
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            with self._lock:
+                if self._buffer is None:
+                    self._buffer = self.factory()
+        return self._buffer
+
+    def add(self, message_id, status, end_time=None):
+        self.buffer.add(message_id, status, end_time=end_time)
+
+    # private
+
+    def _forget(self):
+        self._lock = threading.Lock()
+        self._buffer = None
+
+
+CALLBACKS = LazyCallbackBuffer()
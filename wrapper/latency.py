@@ -0,0 +1,174 @@
+import os
+import threading
+
+
+class EWMA:
+    """
+    Exponentially weighted moving average. `alpha` is the weight given to
+    each new observation.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class P2Quantile:
+    """
+    Streaming estimate of the `p` quantile in constant memory, using the P²
+    algorithm of Jain and Chlamtac (1985). Five markers track the minimum,
+    the p/2, p and (1+p)/2 quantiles and the maximum; each observation
+    nudges the middle markers along a piecewise-parabolic curve.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self._initial = []
+        self.heights = None
+        self.positions = None
+        self.desired = None
+        self.increments = (0, p / 2, p, (1 + p) / 2, 1)
+
+    def update(self, x):
+        if self.heights is None:
+            if len(self._initial) < 5:
+                self._initial.append(x)
+                return
+            # The markers start from the first five observations, which are
+            # also used for an exact answer until then.
+            self.heights = sorted(self._initial)
+            self.positions = [0, 1, 2, 3, 4]
+            self.desired = [0, 2 * self.p, 4 * self.p, 2 + 2 * self.p, 4]
+            self._initial = []
+
+        q, n = self.heights, self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = self._linear(i, d)
+                q[i] = height
+                n[i] += d
+
+    @property
+    def value(self):
+        if self.heights is not None:
+            return self.heights[2]
+        if not self._initial:
+            return None
+        initial = sorted(self._initial)
+        return initial[int(round(self.p * (len(initial) - 1)))]
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+
+class ServerLatency:
+    def __init__(self, alpha, quantile):
+        self.mean = EWMA(alpha)
+        self.quantile = P2Quantile(quantile)
+        self.count = 0
+
+    def observe(self, latency):
+        self.mean.update(latency)
+        self.quantile.update(latency)
+        self.count += 1
+
+    def estimate(self, metric='mean'):
+        if metric == 'mean':
+            return self.mean.value
+        return self.quantile.value
+
+
+class LatencyTracker:
+    """
+    Per-server delivery latency, in microseconds, updated in O(1) as
+    callbacks arrive. Each server keeps an EWMA of the mean and a P²
+    estimate of the `quantile` latency (p95 by default).
+    """
+
+    metrics = ['mean', 'p95']
+
+    def __init__(self, alpha=None, quantile=0.95):
+        self.alpha = float(alpha if alpha is not None else os.getenv('LB_LATENCY_ALPHA', '0.2'))
+        self.quantile = quantile
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def observe(self, server_id, latency):
+        if server_id is None or not latency:
+            return
+        with self._lock:
+            self._get(server_id).observe(latency)
+
+    def seed(self, latencies, server_ids):
+        """
+        Marks `server_ids` as known, starting any server that has no
+        observations yet from its historical average in `latencies`.
+        """
+        with self._lock:
+            for server_id in server_ids:
+                stats = self._get(server_id)
+                if stats.count == 0 and latencies.get(server_id):
+                    stats.observe(latencies[server_id])
+
+    def tracks(self, server_id):
+        return server_id in self._servers
+
+    def estimate(self, server_id, metric='mean'):
+        stats = self._servers.get(server_id)
+        return stats.estimate(metric) if stats else None
+
+    def estimates(self, metric='mean'):
+        with self._lock:
+            return {
+                server_id: stats.estimate(metric)
+                for server_id, stats in self._servers.items()
+                if stats.count
+            }
+
+    def reset(self):
+        with self._lock:
+            self._servers = {}
+
+    def _get(self, server_id):
+        stats = self._servers.get(server_id)
+        if stats is None:
+            stats = self._servers[server_id] = ServerLatency(self.alpha, self.quantile)
+        return stats
+
+
+TRACKER = LatencyTracker()
@@ -1,52 +1,345 @@
+import asyncio
+from contextvars import ContextVar
 import os
 import random
-import requests
+import threading
+import time
 
+from asgiref.sync import sync_to_async
+
+from wrapper.adaptive import WEIGHTS
+from wrapper.health import HEALTH, HealthProber, is_failure
+from wrapper.inflight import IN_FLIGHT
+from wrapper.latency import TRACKER
+from wrapper.metrics import PROVIDER_FAILURES, PROVIDER_SECONDS
 from wrapper.models import Server
+from wrapper.profiling import phase
+from wrapper.registry import REGISTRY
+from wrapper.rotation import rotation
+from wrapper.sessions import ASYNC_SESSIONS, SESSIONS
+from wrapper.throttle import THROTTLE, Saturated
 
 class LoadBalancer:
-    strategies = ['weighted_random', 'rolling_avg', 'round_robin']
-    index = 0
+    strategies = ['weighted_random', 'rolling_avg', 'round_robin', 'weighted_round_robin', 'least_outstanding', 'p2c']
+    # Strategies that rank servers on their tracked callback latency.
+    latency_strategies = ['rolling_avg', 'p2c']
+    # Strategies that take turns through the shared rotation.
+    rotating_strategies = ['round_robin', 'weighted_round_robin']
+    # Strategies that route by weight, adjusted by the weight controller.
+    weighted_strategies = ['weighted_random', 'weighted_round_robin']
 
 
-    def __init__(self, strategy=None):
+    def __init__(self, strategy=None, registry=None, tracker=None, sessions=None, async_sessions=None, health=None,
+                 in_flight=None, throttle=None, weights=None, rand=random.random):
         strategy = strategy or os.getenv('LB_STRAT', 'weighted_random')
         self.set_strat(strategy)
-        self.targeted_url = None
+        self.registry = registry or REGISTRY
+        self.tracker = tracker or TRACKER
+        self.sessions = sessions or SESSIONS
+        self.async_sessions = async_sessions or ASYNC_SESSIONS
+        self.health = health or HEALTH
+        self.in_flight = in_flight or IN_FLIGHT
+        self.throttle = throttle or THROTTLE
+        self.weights = weights or WEIGHTS
+        # Seconds arequest waits for a provider to have room before giving up.
+        self.max_wait = float(os.getenv('THROTTLE_MAX_WAIT', '10'))
+        self.rand = rand
+        # Health checks run in the background once the first request is
+        # sent, when HEALTH_PROBE_INTERVAL is set.
+        self.probe_interval = float(os.getenv('HEALTH_PROBE_INTERVAL', '0'))
+        self.prober = None
+        # The RoutingState keeping this balancer in step with other worker
+        # processes, set by RoutingState.attach().
+        self.shared = None
+        self._prober_lock = threading.Lock()
+        self.latency_metric = os.getenv('LB_LATENCY_METRIC', 'mean')
+        # The chosen url is kept per thread and per asyncio task so that
+        # concurrent sends sharing this balancer don't overwrite each other.
+        self._targeted_url = ContextVar(f'targeted_url_{id(self)}', default=None)
+        self._targeted_server = ContextVar(f'targeted_server_{id(self)}', default=None)
+        self.rotation = rotation()
+        self._reserved_position = ContextVar(f'reserved_position_{id(self)}', default=None)
+
+    @property
+    def targeted_url(self):
+        return self._targeted_url.get()
+
+    @targeted_url.setter
+    def targeted_url(self, url):
+        self._targeted_url.set(url)
+
+    @property
+    def targeted_server(self):
+        """
+        The ServerEntry the last request in this thread or task was routed to.
+        """
+        return self._targeted_server.get()
+
+    @targeted_server.setter
+    def targeted_server(self, server):
+        self._targeted_server.set(server)
+        self.targeted_url = server.url
 
     @property
     def targets(self):
-        return Server.objects.all()
+        return self.registry.snapshot()
 
     def set_strat(self, strategy=None):
         if strategy and strategy in self.strategies:
             self.strategy = strategy
 
-    def request(self, data, headers=None):
+    def choose(self, exclude=()):
+        """
+        Picks a server with the current strategy, avoiding the server ids in
+        `exclude` unless no other server is left, and returns it. The server
+        stays reserved, counted in flight and with its token taken, until it
+        is passed to request().
+        """
+        self._choose(exclude=exclude)
+        return self.targeted_server
+
+    def release(self, server):
+        """
+        Gives back the reservation of a server from choose() that will not
+        be sent to after all: its slot in flight, its rate limit token and,
+        if its breaker is half open, its probe.
+        """
+        self.in_flight.release(server.url)
+        self.throttle.refund(server)
+        self.health.breaker(server.url).release_probe()
+
+    def request(self, data, headers=None, exclude=(), server=None):
+        """
+        Posts `data` to `server`, which must come from choose(), or to the
+        server the current strategy picks while avoiding the ids in
+        `exclude`. Raises Saturated if every provider is at its limits.
+        """
         headers = {} if not headers else headers
-        getattr(self, f"_{self.strategy}")()
-        return requests.post(self.targeted_url, headers=headers, json=data)
+        self._ensure_prober()
+        self._ensure_shared()
+        with phase('route'):
+            if server is None:
+                self._choose(exclude=exclude)
+            else:
+                self._target(server)
+        url = self.targeted_url
+        started = time.perf_counter()
+        try:
+            with phase('provider'):
+                response = self.sessions.post(url, headers=headers, json=data)
+        except Exception:
+            self._record(url, started, error=True)
+            raise
+        finally:
+            self.in_flight.release(url)
+        self._record(url, started, response.status_code)
+        return response
 
-    # private
-            
-    def _weighted_random(self):
-        serv_list = []
-        for server in  self.targets:
-            weight = int(server.weight * 100)
-            weight_as_list = [server.url for i in range(weight)]
-            serv_list.extend(weight_as_list)
-        self.targeted_url = random.choice(serv_list)
-
-    def _rolling_avg(self):
+    async def arequest(self, data, headers=None, exclude=(), server=None):
+        """
+        Async twin of request(). While every provider is at its limits it
+        waits for one to have room, for up to THROTTLE_MAX_WAIT seconds.
+        """
+        headers = {} if not headers else headers
+        if server is None:
+            await self.achoose(exclude=exclude)
+        else:
+            with phase('route'):
+                self._target(server)
+        url = self.targeted_url
+        started = time.perf_counter()
+        try:
+            with phase('provider'):
+                response = await self.async_sessions.post(url, headers=headers, json=data)
+        except Exception:
+            self._record(url, started, error=True)
+            raise
+        finally:
+            self.in_flight.release(url)
+        self._record(url, started, response.status_code)
+        return response
+
+    async def achoose(self, exclude=()):
+        """
+        Async twin of choose(). While every provider is at its limits it
+        waits for one to have room, for up to THROTTLE_MAX_WAIT seconds,
+        then raises Saturated.
+        """
+        self._ensure_prober()
+        servers = self._warm_targets()
+        if servers is None:
+            servers = await sync_to_async(self.warm, thread_sensitive=True)()
+        give_up_at = time.monotonic() + self.max_wait
+        while True:
+            if (self.rotation.uses_database and self.strategy in self.rotating_strategies
+                    and self._reserved_position.get() is None):
+                # Drawn ahead of time so that routing stays off the event loop.
+                position = await sync_to_async(self.rotation.next, thread_sensitive=True)()
+                self._reserved_position.set(position)
+            try:
+                with phase('route'):
+                    self._choose(servers, exclude=exclude)
+                return self.targeted_server
+            except Saturated as e:
+                if time.monotonic() + e.retry_after > give_up_at:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+    def warm(self):
+        """
+        Does any database work the current strategy needs up front (loading
+        the server list, seeding latencies) and returns the server snapshot,
+        so that the async path can keep queries off the event loop.
+        """
+        self._ensure_shared()
         servers = self.targets
-        sorted(servers, key=lambda x: x.rolling_latency(limit=5))
-        self.targeted_url = servers[0].url
+        if self.strategy in self.latency_strategies:
+            self._seed_latencies(servers)
+        return servers
 
-    def _round_robin(self):
-        try:
-            server = self.targets[self.index]
-            self.index += 1
-        except IndexError:
-            self.index = 0
-            server = self.targets[self.index]
-        self.targeted_url = server.url
+    # private
+
+    def _choose(self, servers=None, exclude=()):
+        """
+        Routes with the current strategy among the servers whose circuit
+        breaker lets traffic through and that are below their rate limit and
+        concurrency cap, then reserves the chosen one. If another thread
+        fills the last slot in between, the choice is made again.
+
+        When every breaker is open all servers are considered, since trying
+        a provider beats failing outright. When every server is at its
+        limits, Saturated is raised.
+        """
+        servers = self.targets if servers is None else servers
+        if self.strategy in self.weighted_strategies:
+            servers = self.weights.apply(servers)
+        if exclude:
+            remaining = servers.without(exclude)
+            servers = remaining if len(remaining) else servers
+        strategy = getattr(self, f"_{self.strategy}")
+        while True:
+            healthy = servers.without(self.health.unavailable(servers))
+            check_breakers = bool(len(healthy))
+            healthy = healthy if check_breakers else servers
+            ready = healthy.without(self._saturated(healthy))
+            if not len(ready):
+                raise Saturated(max(self.throttle.wait_time(healthy), 0.01))
+            strategy(ready)
+            if self._reserve(ready.get(self.targeted_url), check_breakers):
+                return
+
+    def _record(self, url, started, status_code=None, error=False):
+        PROVIDER_SECONDS.observe(time.perf_counter() - started, server=url)
+        if error or is_failure(status_code):
+            PROVIDER_FAILURES.inc(server=url)
+        self.health.record(url, status_code, error=error)
+
+    def _saturated(self, servers):
+        return frozenset(
+            server.id for server in servers
+            if (server.max_concurrency is not None and self.in_flight.get(server.url) >= server.max_concurrency)
+            or not self.throttle.available(server)
+        )
+
+    def _reserve(self, server, check_breaker):
+        url = self.targeted_url
+        if not self.in_flight.acquire(url, server.max_concurrency if server else None):
+            return False
+        if server is not None and not self.throttle.try_acquire(server):
+            self.in_flight.release(url)
+            return False
+        if check_breaker and not self.health.breaker(url).acquire():
+            self.in_flight.release(url)
+            if server is not None:
+                self.throttle.refund(server)
+            return False
+        return True
+
+    def _ensure_prober(self):
+        if not self.probe_interval or self.prober is not None:
+            return
+        with self._prober_lock:
+            if self.prober is None:
+                self.prober = HealthProber(self.registry, self.health, self.sessions, self.probe_interval).start()
+
+    def _ensure_shared(self):
+        if self.shared is not None and not self.shared.started:
+            self.shared.start()
+
+    def _target(self, server):
+        self.targeted_server = server
+
+    def _warm_targets(self):
+        if self.shared is not None and not self.shared.started:
+            return None
+        servers = self.registry.peek()
+        if servers is None:
+            return None
+        if self.strategy in self.latency_strategies and not all(self.tracker.tracks(s.id) for s in servers):
+            return None
+        return servers
+
+    def _weighted_random(self, servers=None):
+        servers = self.targets if servers is None else servers
+        self._target(servers.weighted_choice())
+
+    def _rolling_avg(self, servers=None):
+        servers = self.targets if servers is None else servers
+        self._seed_latencies(servers)
+        latencies = self.tracker.estimates(self.latency_metric)
+        self._target(min(servers, key=lambda x: latencies.get(x.id, 0)))
+
+    def _seed_latencies(self, servers):
+        unseen = [server.id for server in servers if not self.tracker.tracks(server.id)]
+        if unseen:
+            self.tracker.seed(Server.objects.rolling_latencies(), unseen)
+
+    def _round_robin(self, servers=None):
+        servers = self.targets if servers is None else servers
+        self._target(servers[self._next_position() % len(servers)])
+
+    def _weighted_round_robin(self, servers=None):
+        servers = self.targets if servers is None else servers
+        sequence = servers.smooth_sequence
+        self._target(sequence[self._next_position() % len(sequence)])
+
+    def _next_position(self):
+        position = self._reserved_position.get()
+        if position is None:
+            return self.rotation.next()
+        self._reserved_position.set(None)
+        return position
+
+    def _least_outstanding(self, servers=None):
+        servers = self.targets if servers is None else servers
+        counts = self.in_flight.counts()
+        fewest = min(counts.get(server.url, 0) for server in servers)
+        # Ties are broken at random so idle servers share the traffic.
+        idle = [server for server in servers if counts.get(server.url, 0) == fewest]
+        self._target(idle[int(self.rand() * len(idle))])
+
+    def _p2c(self, servers=None):
+        """
+        Power of two choices: samples two distinct servers at random and
+        takes the one with the lower expected wait, its latency times the
+        requests already in flight to it plus this one. Servers with no
+        latency yet are assumed to be average.
+        """
+        servers = self.targets if servers is None else servers
+        if len(servers) == 1:
+            self._target(servers[0])
+            return
+        self._seed_latencies(servers)
+        latencies = self.tracker.estimates(self.latency_metric)
+        known = [latencies[s.id] for s in servers if latencies.get(s.id)]
+        default = sum(known) / len(known) if known else 1
+
+        first = int(self.rand() * len(servers))
+        second = int(self.rand() * (len(servers) - 1))
+        second += second >= first
+        candidates = (servers[first], servers[second])
+        counts = self.in_flight.counts()
+        self._target(min(
+            candidates,
+            key=lambda server: (latencies.get(server.id) or default) * (counts.get(server.url, 0) + 1),
+        ))
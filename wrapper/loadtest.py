@@ -0,0 +1,116 @@
+import statistics
+import threading
+import time
+
+import requests
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+
+
+class LoadResult:
+    def __init__(self, latencies, failures, elapsed):
+        self.latencies = sorted(latencies)
+        self.failures = failures
+        self.elapsed = elapsed
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        return self.requests / self.elapsed if self.elapsed else 0
+
+    def percentile(self, p):
+        """
+        The `p`th percentile latency in seconds, 0 if nothing was sent.
+        """
+        if not self.latencies:
+            return 0
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100, method='inclusive')[p - 1]
+
+
+class LoadGenerator:
+    """
+    Posts `total` messages to `url` from `concurrency` threads, each with
+    its own keep-alive session, and times every request. A request fails
+    if it errors or answers anything but 200. Each message goes to its own
+    number, counting up from `first_number`.
+    """
+
+    def __init__(self, url, total, concurrency, timeout=60, first_number=0):
+        self.url = url
+        self.total = total
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.first_number = first_number
+
+    def run(self):
+        latencies = []
+        failures = 0
+        lock = threading.Lock()
+        numbers = iter(range(self.total))
+
+        def client():
+            nonlocal failures
+            with requests.Session() as session:
+                while True:
+                    with lock:
+                        i = next(numbers, None)
+                    if i is None:
+                        return
+                    start = time.perf_counter()
+                    try:
+                        ok = session.post(self.url, json=self.body(i), timeout=self.timeout).status_code == 200
+                    except requests.RequestException:
+                        ok = False
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        failures += not ok
+
+        threads = [threading.Thread(target=client) for _ in range(self.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return LoadResult(latencies, failures, time.perf_counter() - start)
+
+    def body(self, i):
+        return {'number': f'555{self.first_number + i:07d}', 'message': 'load test'}
+
+
+class AppServer:
+    """
+    Serves the app on a local port from a background thread, the way
+    runserver does, so that load tests and stub providers' callbacks reach
+    the real views and middleware.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = ThreadedWSGIServer((host, port), _QuietHandler, allow_reuse_address=True)
+        self._server.daemon_threads = True
+        self._server.set_app(get_wsgi_application())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,51 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from wrapper.dispatch import Dispatcher
+from wrapper.load_balancer import LoadBalancer
+from wrapper.routing_state import ROUTING
+
+class Command(BaseCommand):
+    help = 'Forwards messages accepted by /send/ in queue mode (SEND_MODE=queue) to the SMS providers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Concurrent provider requests')
+        parser.add_argument('--batch-size', type=int, default=50, help='Messages claimed per pass')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Dispatch a single batch and exit')
+        parser.add_argument(
+            '--requeue-dispatching', action='store_true',
+            help='Return messages left mid-dispatch by a stopped dispatcher, whose lease has expired, to the queue first',
+        )
+
+    def handle(self, *args, **options):
+        balancer = LoadBalancer()
+        ROUTING.attach(balancer)
+        dispatcher = Dispatcher(
+            balancer,
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            poll_interval=options['poll_interval'],
+        )
+        stopping = threading.Event()
+
+        def stop(signum, frame):
+            self.stdout.write('Finishing the current batch before exiting')
+            stopping.set()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            if options['requeue_dispatching']:
+                requeued = dispatcher.requeue_dispatching()
+                self.stdout.write(f'Requeued {requeued} messages')
+
+            if options['once']:
+                sent = dispatcher.run_once()
+                self.stdout.write(self.style.SUCCESS(f'Dispatched {len(sent)} messages'))
+            else:
+                dispatcher.run(should_stop=stopping.is_set)
+        finally:
+            dispatcher.shutdown()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from wrapper.archive import export_messages, file_format
+from wrapper.models import SentMessage
+from wrapper.pagination import InvalidQuery, parse_time
+
+class Command(BaseCommand):
+    help = 'Exports sent messages to a compressed Parquet (.parquet) or Arrow IPC (.arrow) file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to write, its extension picking the format')
+        parser.add_argument('--since', help='Only messages started at or after this ISO 8601 datetime')
+        parser.add_argument('--until', help='Only messages started before this ISO 8601 datetime')
+        parser.add_argument('--batch-size', type=int, default=50000, help='Rows read and written at a time')
+        parser.add_argument(
+            '--compression', default='zstd', choices=['zstd', 'lz4', 'snappy', 'gzip', 'none'],
+            help='Arrow files support zstd, lz4 or none; leave them uncompressed to read them memory mapped',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            file_format(options['path'])
+            messages = SentMessage.objects.order_by('id')
+            since = parse_time(options, 'since')
+            if since:
+                messages = messages.filter(start_time__gte=since)
+            until = parse_time(options, 'until')
+            if until:
+                messages = messages.filter(start_time__lt=until)
+            written = export_messages(messages, options['path'], options['batch_size'], options['compression'])
+        except (ImportError, InvalidQuery, OSError, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f"Exported {written} messages to {options['path']}"))
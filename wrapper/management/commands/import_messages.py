@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from wrapper.archive import file_format, import_messages
+
+class Command(BaseCommand):
+    help = 'Loads messages exported by export_messages back into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Parquet (.parquet) or Arrow IPC (.arrow) export to load')
+        parser.add_argument('--batch-size', type=int, default=50000, help='Rows loaded at a time')
+        parser.add_argument(
+            '--new-ids', action='store_true',
+            help='Give the messages new ids instead of their exported ones, e.g. to replay them alongside others',
+        )
+        parser.add_argument(
+            '--skip-existing', action='store_true',
+            help='Leave out messages whose exported id is already taken instead of failing',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            file_format(options['path'])
+            loaded = import_messages(
+                options['path'], options['batch_size'],
+                keep_ids=not options['new_ids'], skip_existing=options['skip_existing'],
+            )
+        except (ImportError, OSError, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f"Imported {loaded} messages from {options['path']}"))
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import tempfile
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from wrapper.health import HEALTH
+from wrapper.latency import TRACKER
+from wrapper.load_balancer import LoadBalancer
+from wrapper.loadtest import AppServer, LoadGenerator
+from wrapper.models import SentMessage, Server
+from wrapper.profiling import read_profiles, summarize
+from wrapper.stubs import StubProvider
+
+class Command(BaseCommand):
+    help = (
+        'Load tests /send/ against local stub providers, once per load balancer strategy, and reports '
+        'throughput, latency percentiles and database queries per request. Replaces the Server table, '
+        'so run it against a scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--providers', nargs='+', default=['0.05:16', '0.1:16:0.02', '0.3:8'],
+            help='Stub providers as latency[:concurrency[:error_rate]], latency being the mean in seconds',
+        )
+        parser.add_argument('--distribution', choices=StubProvider.distributions, default='lognormal')
+        parser.add_argument('--callback-delay', type=float, default=0.5, help='Mean seconds before a delivery callback')
+        parser.add_argument('--invalid-rate', type=float, default=0, help='Share of callbacks reporting an invalid number')
+        parser.add_argument('--strategies', nargs='+', choices=LoadBalancer.strategies, default=LoadBalancer.strategies)
+        parser.add_argument('--requests', type=int, default=500, help='Sends per strategy')
+        parser.add_argument('--concurrency', type=int, default=16, help='Concurrent senders')
+        parser.add_argument('--seed', type=int, help='Seed for the stub providers, for repeatable runs')
+        parser.add_argument('--output', help='Also write the results to this file as JSON')
+        parser.add_argument(
+            '--replace-servers', action='store_true',
+            help='Confirms the Server table, and every message sent through it, may be replaced',
+        )
+
+    def handle(self, *args, **options):
+        if not options['replace_servers']:
+            raise CommandError(
+                'loadtest replaces the Server table and deletes the messages sent through it. '
+                'Run it against a scratch database and pass --replace-servers.'
+            )
+
+        stubs = [
+            self.stub(spec, i, options) for i, spec in enumerate(options['providers'])
+        ]
+        app = AppServer().start()
+        environ = {key: os.environ.get(key) for key in ['CALLBACK_URL', 'SEND_MODE', 'CALLBACK_MODE']}
+        os.environ.update(CALLBACK_URL=f'{app.url}/ingest/', SEND_MODE='sync', CALLBACK_MODE='direct')
+        log_dir = tempfile.mkdtemp(prefix='loadtest')
+        results = []
+        if options['verbosity'] < 2:
+            # Failures are counted in the report rather than logged one by one.
+            logging.disable(logging.CRITICAL)
+        try:
+            Server.objects.all().delete()
+            for stub in stubs:
+                Server.objects.create(url=stub.url, weight=1)
+
+            self.stdout.write(
+                f"{'strategy':<21} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+                f"{'failed':>7} {'q/send':>7} {'q/ingest':>8} {'cb failed':>9}"
+            )
+            for i, strategy in enumerate(options['strategies']):
+                log = os.path.join(log_dir, f'{strategy}.jsonl')
+                with override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_LOG=log):
+                    results.append(self.run(strategy, i, app, stubs, log, options))
+                self.report(results[-1])
+        finally:
+            logging.disable(logging.NOTSET)
+            app.stop()
+            for stub in stubs:
+                stub.stop()
+            for key, value in environ.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def stub(self, spec, i, options):
+        try:
+            latency, concurrency, error_rate = (spec.split(':') + [None, None])[:3]
+            return StubProvider(
+                latency=float(latency),
+                concurrency=int(concurrency) if concurrency else None,
+                error_rate=float(error_rate) if error_rate else 0,
+                distribution=options['distribution'],
+                callback_delay=options['callback_delay'],
+                invalid_rate=options['invalid_rate'],
+                seed=None if options['seed'] is None else options['seed'] + i,
+            ).start()
+        except ValueError:
+            raise CommandError(f'Invalid provider spec: {spec}')
+
+    def run(self, strategy, i, app, stubs, log, options):
+        # Each strategy starts from a clean slate: no messages, latency
+        # estimates or breaker state left by the one before.
+        SentMessage.objects.all().delete()
+        TRACKER.reset()
+        HEALTH.reset()
+        response = requests.post(f'{app.url}/update_lb_strat/', json={'strategy': strategy}, timeout=10)
+        if response.status_code != 200:
+            raise CommandError(f'Could not switch to {strategy}: {response.text}')
+
+        callbacks_failed = sum(stub.callbacks_failed for stub in stubs)
+        result = LoadGenerator(
+            f'{app.url}/send/', options['requests'], options['concurrency'],
+            first_number=i * options['requests'],
+        ).run()
+        for stub in stubs:
+            stub.drain(timeout=60)
+        profiles = summarize(read_profiles(log))
+
+        def queries(path):
+            return profiles[path]['queries'] if path in profiles else 0
+
+        return {
+            'strategy': strategy,
+            'requests': result.requests,
+            'throughput': result.throughput,
+            'p50': result.percentile(50),
+            'p95': result.percentile(95),
+            'p99': result.percentile(99),
+            'failures': result.failures,
+            'queries_per_send': queries('/send/'),
+            'queries_per_callback': queries('/ingest/'),
+            'callbacks_failed': sum(stub.callbacks_failed for stub in stubs) - callbacks_failed,
+        }
+
+    def report(self, result):
+        self.stdout.write(
+            f"{result['strategy']:<21} {result['throughput']:>8.1f} {result['p50'] * 1000:>8.1f} "
+            f"{result['p95'] * 1000:>8.1f} {result['p99'] * 1000:>8.1f} {result['failures']:>7} "
+            f"{result['queries_per_send']:>7.2f} {result['queries_per_callback']:>8.2f} {result['callbacks_failed']:>9}"
+        )
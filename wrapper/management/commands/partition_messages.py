@@ -0,0 +1,36 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from wrapper.partitions import create_partitions, drop_partition, expired_partitions
+
+class Command(BaseCommand):
+    help = (
+        'Creates the coming days\' partitions of the message table and drops, or archives and drops, '
+        'those past retention. Run it daily.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days-ahead', type=int, default=int(os.getenv('MESSAGE_PARTITIONS_AHEAD', '7')),
+            help='Days of partitions to keep created ahead of today',
+        )
+        parser.add_argument(
+            '--retention-days', type=int, default=int(os.getenv('MESSAGE_RETENTION_DAYS', '0')),
+            help='Drop partitions whose messages are all older than this; 0 keeps every partition',
+        )
+        parser.add_argument('--archive-dir', help='Copy each partition to a gzipped CSV file here before dropping it')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Messages are only partitioned on PostgreSQL')
+        if options['archive_dir'] and not os.path.isdir(options['archive_dir']):
+            raise CommandError(f"No such directory: {options['archive_dir']}")
+
+        for name in create_partitions(options['days_ahead']):
+            self.stdout.write(f'Created {name}')
+
+        if options['retention_days'] > 0:
+            for partition in expired_partitions(options['retention_days']):
+                path = drop_partition(partition, options['archive_dir'])
+                self.stdout.write(f'Dropped {partition.name}' + (f', archived to {path}' if path else ''))
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from wrapper.profiling import read_profiles, summarize
+
+class Command(BaseCommand):
+    help = 'Summarises the request profiles sampled into PROFILING_LOG, per path and phase'
+
+    def add_arguments(self, parser):
+        parser.add_argument('log', nargs='?', help='Profile log to read (defaults to PROFILING_LOG)')
+        parser.add_argument('--path', help='Only report on this request path')
+
+    def handle(self, *args, **options):
+        log = options['log'] or settings.PROFILING_LOG
+        if not log:
+            raise CommandError('Give a profile log or set PROFILING_LOG')
+        try:
+            profiles = read_profiles(log)
+        except FileNotFoundError:
+            raise CommandError(f'No profile log at {log}')
+        if options['path']:
+            profiles = [profile for profile in profiles if profile['path'] == options['path']]
+
+        for path, summary in summarize(profiles).items():
+            self.stdout.write(self.style.SUCCESS(
+                f"{path}  {summary['requests']} requests  mean {summary['mean'] * 1000:.1f}ms  "
+                f"p50 {summary['p50'] * 1000:.1f}ms  p95 {summary['p95'] * 1000:.1f}ms  "
+                f"{_queries(summary['queries'])} queries"
+            ))
+            for name, phase in summary['phases'].items():
+                self.stdout.write(
+                    f"  {name:<16} {phase['mean'] * 1000:>8.2f}ms {phase['share']:>6.1%} {_queries(phase['queries']):>6} queries"
+                )
+
+
+def _queries(count):
+    # None when only async requests were profiled, which count no queries.
+    return 'n/a' if count is None else f'{count:.1f}'
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from wrapper.models import LatencyRollup
+
+class Command(BaseCommand):
+    help = 'Rolls up message counts and latencies per server and minute into LatencyRollup. Run it every minute.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lookback', type=int, default=60,
+            help='Minutes to recompute, so that callbacks received since the last run are counted',
+        )
+
+    def handle(self, *args, **options):
+        # Only whole minutes are rolled up; the current one is left to
+        # SentMessage until it is over.
+        until = timezone.now().replace(second=0, microsecond=0)
+        since = until - timedelta(minutes=options['lookback'])
+        rows = LatencyRollup.objects.roll_up(since, until)
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {rows} rows from {since:%H:%M} to {until:%H:%M}'))
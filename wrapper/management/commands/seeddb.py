@@ -12,13 +12,23 @@ class Command(BaseCommand):
 
             all_servers = os.getenv('SERVERS').split(',')
 
-            new_servers = [server for server in all_servers if server.split("|")[0] not in existing_servers]
+            for server in all_servers:
+                # url|weight, optionally followed by |rate_limit|max_concurrency
+                url, weight, *limits = server.split('|')
+                limits = dict(zip(['rate_limit', 'max_concurrency'], limits))
+                rate_limit = float(limits['rate_limit']) if limits.get('rate_limit') else None
+                max_concurrency = int(limits['max_concurrency']) if limits.get('max_concurrency') else None
+
+                if url in existing_servers:
+                    if limits:
+                        Server.objects.filter(url=url).update(rate_limit=rate_limit, max_concurrency=max_concurrency)
+                    continue
 
-            for server in new_servers:
-                url, weight = server.split('|')
                 new_server = Server(
                     url=url,
-                    weight=weight
+                    weight=weight,
+                    rate_limit=rate_limit,
+                    max_concurrency=max_concurrency,
                 )
                 new_server.save()
 
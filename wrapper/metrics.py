@@ -0,0 +1,272 @@
+from bisect import bisect_left
+import threading
+import time
+
+from wrapper.inflight import IN_FLIGHT
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+DELIVERY_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+
+class Metric:
+    """
+    Base for metrics that are recorded on hot paths. Every thread writes to
+    its own shard, a plain dict only that thread ever updates, so recording
+    takes no lock; the lock is only taken the first time a thread records
+    and when shards are summed for a scrape. Both also fold the shards of
+    threads that have finished into a retired total, so servers starting
+    a thread per request don't accumulate shards.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        # (thread, shard) pairs for the threads that have recorded.
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """
+        Returns (suffix, labels, value) triples for the exposition format.
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        with self._lock:
+            for _, shard in self._shards:
+                shard.clear()
+            self._retired = {}
+
+    # private
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _merge(self, total, value):
+        raise NotImplementedError
+
+    def _zero(self):
+        raise NotImplementedError
+
+    def _merged(self):
+        with self._lock:
+            self._retire()
+            totals = dict(self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            for key, value in list(shard.items()):
+                totals[key] = self._merge(totals.get(key, self._zero()), value)
+        return totals
+
+    def _retire(self):
+        # Called with the lock held. A finished thread's shard no longer
+        # changes, so it can be added up once and dropped.
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+            for key, value in shard.items():
+                self._retired[key] = self._merge(self._retired.get(key, self._zero()), value)
+        self._shards = live
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._merged().get(self._key(labels), 0)
+
+    def samples(self):
+        return [('_total', key, value) for key, value in sorted(self._merged().items())]
+
+    def _merge(self, total, value):
+        return total + value
+
+    def _zero(self):
+        return 0
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # One slot per bucket plus +Inf, then the sum.
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, **labels):
+        counts = self._merged().get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        samples = []
+        for key, counts in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key + (_format_value(bound),), cumulative))
+            samples.append(('_sum', key, counts[-1]))
+            samples.append(('_count', key, cumulative))
+        return samples
+
+    def _merge(self, total, value):
+        return [x + y for x, y in zip(total, value)]
+
+    def _zero(self):
+        return [0] * (len(self.buckets) + 2)
+
+
+class Gauge(Metric):
+    """
+    A gauge read from `collect` at scrape time, which returns a dict
+    mapping label tuples to values, so nothing is recorded on hot paths.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=dict):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        return [('', key, value) for key, value in sorted(self.collect().items())]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            labelnames = metric.labelnames + (('le',) if metric.kind == 'histogram' else ())
+            for suffix, key, value in metric.samples():
+                labels = ','.join(
+                    f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)
+                )
+                labels = f'{{{labels}}}' if labels else ''
+                lines.append(f'{metric.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every database connection (see
+    wrapper.signals) to time each query.
+    """
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - start)
+
+
+def instrument_connection(connection):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+METRICS = MetricsRegistry()
+
+SEND_SECONDS = METRICS.register(Histogram(
+    'text_api_send_seconds',
+    'Time to forward a message to a provider, retries included.',
+    ['outcome'],
+))
+SEND_RETRIES = METRICS.register(Counter(
+    'text_api_send_retries',
+    'Attempts made after the first one for a message.',
+))
+SEND_FAILURES = METRICS.register(Counter(
+    'text_api_send_failures',
+    'Messages that could not be forwarded to any provider.',
+))
+PROVIDER_SECONDS = METRICS.register(Histogram(
+    'text_api_provider_request_seconds',
+    'Round trip of a single request to a provider.',
+    ['server'],
+))
+PROVIDER_FAILURES = METRICS.register(Counter(
+    'text_api_provider_failures',
+    'Provider requests that errored or answered with a server error or 429.',
+    ['server'],
+))
+DELIVERY_SECONDS = METRICS.register(Histogram(
+    'text_api_delivery_seconds',
+    'Time from sending a message to its delivery callback.',
+    # The server url, as for the provider metrics, so they can be joined.
+    ['server'],
+    buckets=DELIVERY_BUCKETS,
+))
+INVALID_NUMBERS_TOTAL = METRICS.register(Counter(
+    'text_api_invalid_numbers',
+    'Sends rejected for an invalid number, and numbers newly reported invalid by callbacks.',
+    ['source'],
+))
+DB_QUERY_SECONDS = METRICS.register(Histogram(
+    'text_api_db_query_seconds',
+    'Time spent executing each database query.',
+    buckets=DB_BUCKETS,
+))
+IN_FLIGHT_REQUESTS = METRICS.register(Gauge(
+    'text_api_in_flight_requests',
+    'Requests currently outstanding to each provider from this process.',
+    ['server'],
+    collect=lambda: {(url,): count for url, count in IN_FLIGHT.counts().items()},
+))
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0003_invalidnumber'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sentmessage',
+            name='message',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:30
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    """
+    Keeps the oldest row for every repeated InvalidNumber.number and
+    Server.url so that 0006 can add unique constraints. Messages
+    sent through a duplicate server are moved onto the one that is kept.
+    """
+    InvalidNumber = apps.get_model('wrapper', 'InvalidNumber')
+    Server = apps.get_model('wrapper', 'Server')
+    SentMessage = apps.get_model('wrapper', 'SentMessage')
+
+    duplicates = (
+        InvalidNumber.objects.values('number')
+        .annotate(keep=Min('id'), rows=Count('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        InvalidNumber.objects.filter(number=duplicate['number']).exclude(id=duplicate['keep']).delete()
+
+    duplicates = (
+        Server.objects.values('url')
+        .annotate(keep=Min('id'), rows=Count('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        extra = Server.objects.filter(url=duplicate['url']).exclude(id=duplicate['keep'])
+        SentMessage.objects.filter(server__in=extra).update(server_id=duplicate['keep'])
+        extra.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0004_sentmessage_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
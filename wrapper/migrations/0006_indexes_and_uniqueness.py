@@ -0,0 +1,32 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0005_remove_duplicates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invalidnumber',
+            name='number',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='sentmessage',
+            name='uuid',
+            field=models.CharField(db_index=True, max_length=200, null=True),
+        ),
+        migrations.AlterField(
+            model_name='server',
+            name='url',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='sentmessage',
+            index=models.Index(fields=['server', 'start_time'], name='sentmessage_server_start_idx'),
+        ),
+    ]
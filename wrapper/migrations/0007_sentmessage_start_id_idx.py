@@ -0,0 +1,17 @@
+# Generated by Django 3.1.2 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0006_indexes_and_uniqueness'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sentmessage',
+            index=models.Index(fields=['start_time', 'id'], name='sentmessage_start_id_idx'),
+        ),
+    ]
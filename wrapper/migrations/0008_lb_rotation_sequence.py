@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE SEQUENCE IF NOT EXISTS wrapper_lb_rotation MINVALUE 1 CYCLE')
+
+
+def drop_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP SEQUENCE IF EXISTS wrapper_lb_rotation')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0007_sentmessage_start_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_sequence, drop_sequence),
+    ]
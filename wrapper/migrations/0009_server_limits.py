@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0008_lb_rotation_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='server',
+            name='max_concurrency',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='server',
+            name='rate_limit',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.2 on 2026-10-18 11:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0009_server_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatencyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minute', models.DateTimeField()),
+                ('status', models.CharField(max_length=200, null=True)),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('latency_total', models.FloatField(default=0)),
+                ('server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wrapper.server')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='latencyrollup',
+            index=models.Index(fields=['minute'], name='latencyrollup_minute_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='latencyrollup',
+            constraint=models.UniqueConstraint(fields=('server', 'minute', 'status'), name='latencyrollup_server_minute_status'),
+        ),
+    ]
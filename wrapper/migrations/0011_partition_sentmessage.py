@@ -0,0 +1,109 @@
+from datetime import datetime, time, timedelta, timezone
+
+from django.db import migrations
+
+
+TABLE = 'wrapper_sentmessage'
+OLD = 'wrapper_sentmessage_unpartitioned'
+DAYS_AHEAD = 7
+
+
+def _indexes(cursor, table):
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT LIKE %s",
+        [table, '%_pkey'],
+    )
+    return cursor.fetchall()
+
+
+def _foreign_keys(cursor, table):
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+        [table],
+    )
+    return cursor.fetchall()
+
+
+def _swap(schema_editor, create, copy_keys):
+    """
+    Moves the rows of the message table into the table `create` makes,
+    then gives that one the original's name, indexes and foreign keys.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        indexes = _indexes(cursor, TABLE)
+        foreign_keys = _foreign_keys(cursor, TABLE)
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        sequence = cursor.fetchone()[0]
+
+    schema_editor.execute(f'ALTER TABLE {TABLE} RENAME TO {OLD}')
+    create(schema_editor)
+    schema_editor.execute(f'INSERT INTO {TABLE} SELECT * FROM {OLD}')
+    # The id sequence belongs to the old table's column and would be
+    # dropped with it.
+    schema_editor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id')
+    schema_editor.execute(f'DROP TABLE {OLD}')
+
+    # The old table's indexes went with it, so their definitions now
+    # create them, under the same names, on the new one.
+    for name, definition in indexes:
+        schema_editor.execute(definition)
+    for name, definition in foreign_keys:
+        schema_editor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}')
+    copy_keys(schema_editor)
+
+
+def _create_partitioned(schema_editor):
+    # Unique constraints on a partitioned table must include start_time,
+    # which is nullable, so id is indexed rather than made the primary key.
+    schema_editor.execute(
+        f'CREATE TABLE {TABLE} (LIKE {OLD} INCLUDING DEFAULTS INCLUDING STORAGE) PARTITION BY RANGE (start_time)'
+    )
+    today = datetime.combine(datetime.now(timezone.utc).date(), time(), tzinfo=timezone.utc)
+    # Everything sent before today goes to one partition, dropped as a
+    # whole once it is past retention. Rows without a start_time go to the
+    # default partition.
+    schema_editor.execute(
+        f"CREATE TABLE {TABLE}_history PARTITION OF {TABLE} FOR VALUES FROM (MINVALUE) TO ('{today.isoformat()}')"
+    )
+    for day in range(DAYS_AHEAD + 1):
+        start = today + timedelta(days=day)
+        end = start + timedelta(days=1)
+        schema_editor.execute(
+            f"CREATE TABLE {TABLE}_p{start:%Y%m%d} PARTITION OF {TABLE} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    schema_editor.execute(f'CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT')
+
+
+def _index_id(schema_editor):
+    schema_editor.execute(f'CREATE INDEX {TABLE}_id_idx ON {TABLE} (id)')
+
+
+def _create_plain(schema_editor):
+    schema_editor.execute(f'CREATE TABLE {TABLE} (LIKE {OLD} INCLUDING DEFAULTS INCLUDING STORAGE)')
+
+
+def _primary_key(schema_editor):
+    schema_editor.execute(f'DROP INDEX IF EXISTS {TABLE}_id_idx')
+    schema_editor.execute(f'ALTER TABLE {TABLE} ADD PRIMARY KEY (id)')
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _swap(schema_editor, _create_partitioned, _index_id)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _swap(schema_editor, _create_plain, _primary_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0010_latencyrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
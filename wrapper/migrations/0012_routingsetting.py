@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0011_partition_sentmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoutingSetting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+                ('value', models.CharField(max_length=200)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0012_routingsetting'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sentmessage',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='sentmessage',
+            name='claimed_by',
+            field=models.CharField(max_length=200, null=True),
+        ),
+    ]
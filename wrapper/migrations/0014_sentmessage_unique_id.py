@@ -0,0 +1,38 @@
+from django.db import migrations
+
+
+TABLE = 'wrapper_sentmessage'
+
+
+def _partitioned(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [TABLE])
+        return cursor.fetchone()[0] == 'p'
+
+
+def unique_ids(apps, schema_editor):
+    # A partitioned table can only enforce uniqueness on keys that include
+    # start_time, so (id, start_time) stands in for the primary key 0011
+    # dropped: it rejects a message inserted twice, and ids taken from the
+    # sequence are unique anyway. wrapper.archive checks imported ids,
+    # which don't come from the sequence, against the whole table.
+    if schema_editor.connection.vendor == 'postgresql' and _partitioned(schema_editor):
+        schema_editor.execute(f'CREATE UNIQUE INDEX {TABLE}_id_start_uniq ON {TABLE} (id, start_time)')
+        schema_editor.execute(f'DROP INDEX IF EXISTS {TABLE}_id_idx')
+
+
+def plain_ids(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql' and _partitioned(schema_editor):
+        schema_editor.execute(f'CREATE INDEX {TABLE}_id_idx ON {TABLE} (id)')
+        schema_editor.execute(f'DROP INDEX IF EXISTS {TABLE}_id_start_uniq')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrapper', '0013_sentmessage_claim'),
+    ]
+
+    operations = [
+        migrations.RunPython(unique_ids, plain_ids),
+    ]
@@ -2,33 +2,101 @@ from datetime import timedelta
 import logging
 import os
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Max, Q, Sum
+from django.db.models.functions import Trunc
 from django.utils import timezone
 
 
 logger = logging.getLogger(__name__)
 
 
+class ServerManager(models.Manager):
+    def rolling_latencies(self, window=5):
+        """
+        Returns a dict mapping server id to the average latency, in
+        microseconds, of its completed messages started within the last
+        `window` minutes; servers without completed messages in the window
+        are omitted.
+
+        Minutes already rolled up into LatencyRollup are read from there,
+        and only the messages started after each server's latest rollup
+        are aggregated from SentMessage, so the query touches a bounded
+        number of rows however busy the window was.
+        """
+        dt = timezone.now() - timedelta(minutes=window)
+        totals = {}
+        tails = []
+        for row in LatencyRollup.objects.latencies(dt):
+            totals[row['server']] = [row['completed'], row['latency_total']]
+            tails.append(Q(server=row['server'], start_time__gte=row['last_minute'] + timedelta(minutes=1)))
+        tail = Q(start_time__gte=dt) & ~Q(server__in=list(totals))
+        for condition in tails:
+            tail |= condition
+
+        rows = (
+            SentMessage.objects
+            .filter(tail, end_time__isnull=False, server__isnull=False)
+            .values('server')
+            .annotate(completed=Count('id'), latency_total=_LATENCY_SUM)
+            .order_by()
+        )
+        for row in rows:
+            completed, latency_total = totals.setdefault(row['server'], [0, 0.0])
+            totals[row['server']] = [
+                completed + row['completed'],
+                latency_total + row['latency_total'] / timedelta(microseconds=1),
+            ]
+        return {
+            server: latency_total / completed
+            for server, (completed, latency_total) in totals.items()
+            if completed
+        }
+
+
 class Server(models.Model):
-    url = models.CharField(max_length=200)
+    url = models.CharField(max_length=200, unique=True)
     weight = models.DecimalField(max_digits=3, decimal_places=2)
+    # Provider account limits: messages per second and requests in flight
+    # at once. Left empty, the provider is not throttled.
+    rate_limit = models.FloatField(null=True, blank=True)
+    max_concurrency = models.PositiveIntegerField(null=True, blank=True)
+
+    objects = ServerManager()
 
     def rolling_latency(self, limit=1, window=5):
         dt = timezone.now() - timedelta(minutes=window)
-        sent_messages = self.sentmessage_set.filter(start_time__gte=dt)[:limit]
-        latencies = [sent_message.latency() for sent_message in sent_messages if sent_message.latency() != 0]
+        durations = (
+            self.sentmessage_set
+            .filter(start_time__gte=dt, end_time__isnull=False)
+            .order_by('-start_time', '-id')
+            .values_list('start_time', 'end_time')[:limit]
+        )
+        latencies = [(end - start) / timedelta(microseconds=1) for start, end in durations]
+        latencies = [latency for latency in latencies if latency != 0]
         if len(latencies) == 0:
             return 0
         return sum(latencies) / len(latencies)
 
 
 class SentMessage(models.Model):
-    uuid = models.CharField(max_length=200, null=True)
+    uuid = models.CharField(max_length=200, null=True, db_index=True)
     number = models.CharField(max_length=200)
+    message = models.TextField(null=True)
     status = models.CharField(max_length=200, null=True)
     start_time = models.DateTimeField('time started', null=True)
     end_time = models.DateTimeField('time finished', null=True)
     server = models.ForeignKey(Server, on_delete=models.CASCADE, null=True)
+    # The dispatcher holding a queued message's lease, and when it was
+    # last renewed.
+    claimed_by = models.CharField(max_length=200, null=True)
+    claimed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['server', 'start_time'], name='sentmessage_server_start_idx'),
+            models.Index(fields=['start_time', 'id'], name='sentmessage_start_id_idx'),
+        ]
 
     def latency(self):
         """
@@ -43,5 +111,101 @@ class SentMessage(models.Model):
             return 0
 
 class InvalidNumber(models.Model):
-    number = models.CharField(max_length=200)
+    number = models.CharField(max_length=200, unique=True)
+
+
+
+class RoutingSetting(models.Model):
+    """
+    Routing settings changed at runtime, such as the strategy set through
+    /update_lb_strat/, kept so that workers started later pick them up.
+    """
+    name = models.CharField(max_length=200, unique=True)
+    value = models.CharField(max_length=200)
+
+
+class LatencyRollupManager(models.Manager):
+    def roll_up(self, since, until):
+        """
+        Recomputes the rollups of every minute from `since` up to `until`
+        from SentMessage, replacing those already stored, so that callbacks
+        received since the last run are counted. Returns the rows written.
+        """
+        rows = (
+            SentMessage.objects
+            .filter(start_time__gte=since, start_time__lt=until, server__isnull=False)
+            .annotate(minute=Trunc('start_time', 'minute'))
+            .values('server', 'minute', 'status')
+            .annotate(messages=Count('id'), completed=Count('end_time'), latency_total=_LATENCY_SUM)
+            .order_by()
+        )
+        rollups = [
+            LatencyRollup(
+                server_id=row['server'],
+                minute=row['minute'],
+                status=row['status'],
+                messages=row['messages'],
+                completed=row['completed'],
+                latency_total=(row['latency_total'] or timedelta(0)) / timedelta(microseconds=1),
+            )
+            for row in rows
+        ]
+        with transaction.atomic():
+            self.filter(minute__gte=since, minute__lt=until).delete()
+            self.bulk_create(rollups)
+        return len(rollups)
+
+    def latencies(self, since):
+        """
+        Completed messages, their total latency in microseconds and the
+        latest minute rolled up, per server, for the minutes from `since`.
+        """
+        return (
+            self.filter(minute__gte=since, completed__gt=0)
+            .values('server')
+            .annotate(completed=Sum('completed'), latency_total=Sum('latency_total'), last_minute=Max('minute'))
+            .order_by()
+        )
+
+    def status_counts(self, since, until=None):
+        """
+        Returns a dict mapping server id to a dict of message counts by
+        status, for the messages started in the rolled up minutes from
+        `since` up to `until`.
+        """
+        rollups = self.filter(minute__gte=since)
+        if until is not None:
+            rollups = rollups.filter(minute__lt=until)
+        counts = {}
+        for row in rollups.values('server', 'status').annotate(messages=Sum('messages')).order_by():
+            counts.setdefault(row['server'], {})[row['status']] = row['messages']
+        return counts
+
+
+class LatencyRollup(models.Model):
+    """
+    Messages sent through a server in one minute, by status, with the
+    total latency of those completed. Kept up to date by the
+    rollup_messages command, and read instead of SentMessage wherever
+    whole minutes will do.
+    """
+    server = models.ForeignKey(Server, on_delete=models.CASCADE)
+    minute = models.DateTimeField()
+    status = models.CharField(max_length=200, null=True)
+    messages = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    # Summed latency, in microseconds, of the completed messages.
+    latency_total = models.FloatField(default=0)
+
+    objects = LatencyRollupManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['server', 'minute', 'status'], name='latencyrollup_server_minute_status'),
+        ]
+        indexes = [
+            models.Index(fields=['minute'], name='latencyrollup_minute_idx'),
+        ]
+
 
+_LATENCY_SUM = Sum(ExpressionWrapper(F('end_time') - F('start_time'), output_field=DurationField()))
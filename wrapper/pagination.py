@@ -0,0 +1,93 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from wrapper.models import SentMessage
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def encode_cursor(message):
+    """
+    Returns an opaque cursor pointing just past `message`, a dict holding
+    its start_time and id.
+    """
+    position = [message['start_time'].isoformat(), message['id']]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        start_time, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        start_time = parse_datetime(start_time)
+        message_id = int(message_id)
+    except (ValueError, TypeError):
+        raise InvalidQuery('cursor is not valid')
+    if start_time is None:
+        raise InvalidQuery('cursor is not valid')
+    return start_time, message_id
+
+
+def parse_time(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        # None when the format is wrong, ValueError when a field is out of range.
+        parsed = parse_datetime(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise InvalidQuery(f'{name} must be an ISO 8601 datetime')
+    return parsed
+
+
+def filter_messages(params):
+    """
+    Builds the SentMessage queryset described by the query `params`:
+    optional status, server, number, since and until filters plus a
+    keyset cursor, ordered by (start_time, id).
+
+    Keyset pagination seeks straight to the cursor position through the
+    (start_time, id) index instead of counting past an OFFSET, so every
+    page costs the same regardless of depth.
+    """
+    messages = SentMessage.objects.filter(start_time__isnull=False)
+
+    for field in ['status', 'number']:
+        if params.get(field):
+            messages = messages.filter(**{field: params[field]})
+    if params.get('server'):
+        try:
+            messages = messages.filter(server_id=int(params['server']))
+        except ValueError:
+            raise InvalidQuery('server must be a server id')
+
+    since = parse_time(params, 'since')
+    if since:
+        messages = messages.filter(start_time__gte=since)
+    until = parse_time(params, 'until')
+    if until:
+        messages = messages.filter(start_time__lt=until)
+
+    if params.get('cursor'):
+        start_time, message_id = decode_cursor(params['cursor'])
+        messages = messages.filter(
+            Q(start_time__gt=start_time) | Q(start_time=start_time, id__gt=message_id)
+        )
+
+    return messages.order_by('start_time', 'id')
+
+
+def page_limit(params, default=100, maximum=1000):
+    try:
+        limit = int(params.get('limit', default))
+    except ValueError:
+        raise InvalidQuery('limit must be an integer')
+    if limit < 1:
+        raise InvalidQuery('limit must be positive')
+    return min(limit, maximum)
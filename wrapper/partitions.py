@@ -0,0 +1,128 @@
+from collections import namedtuple
+from datetime import datetime, time, timedelta, timezone
+import gzip
+import os
+import re
+
+from django.db import connection, transaction
+
+from wrapper.models import SentMessage
+
+
+TABLE = SentMessage._meta.db_table
+
+# A partition of the message table and the range of start_time it holds.
+# `start` is None for the partition holding everything before `end`, and
+# both are None for the default partition.
+Partition = namedtuple('Partition', ['name', 'start', 'end'])
+
+_BOUND = re.compile(r"FROM \((?:MINVALUE|'([^']+)')\) TO \('([^']+)'\)")
+
+
+def parse_bound(bound):
+    """
+    Parses a partition bound as pg_get_expr prints it into (start, end),
+    (None, None) for the default partition.
+    """
+    if bound == 'DEFAULT':
+        return None, None
+    match = _BOUND.search(bound)
+    if match is None:
+        raise ValueError(f'Unexpected partition bound: {bound}')
+    start, end = match.groups()
+    return (_timestamp(start) if start else None), _timestamp(end)
+
+
+def partitions():
+    """
+    Returns the partitions of the message table, oldest first, with the
+    default partition last.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+            """,
+            [TABLE],
+        )
+        found = [Partition(name, *parse_bound(bound)) for name, bound in cursor.fetchall()]
+    return sorted(found, key=lambda p: (p.end is None, p.end or datetime.min.replace(tzinfo=timezone.utc)))
+
+
+def partition_name(day):
+    return f'{TABLE}_p{day:%Y%m%d}'
+
+
+def create_partitions(days_ahead, today=None):
+    """
+    Creates a partition for each day from `today` through `days_ahead`
+    days later that no partition covers yet. Rows that had already landed
+    in the default partition for one of those days are moved into it.
+    Returns the names of the partitions created.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    existing = [p for p in partitions() if p.end is not None]
+    created = []
+    for offset in range(days_ahead + 1):
+        start = datetime.combine(today + timedelta(days=offset), time(), tzinfo=timezone.utc)
+        end = start + timedelta(days=1)
+        if any((p.start is None or p.start < end) and start < p.end for p in existing):
+            continue
+        _attach(partition_name(start), start, end)
+        created.append(partition_name(start))
+    return created
+
+
+def expired_partitions(retention_days, now=None):
+    """
+    Partitions whose every message started more than `retention_days` ago.
+    """
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=retention_days)
+    return [p for p in partitions() if p.end is not None and p.end <= cutoff]
+
+
+def drop_partition(partition, archive_dir=None):
+    """
+    Detaches and drops `partition`, first copying its rows to a gzipped
+    CSV file in `archive_dir` if one is given. Returns the archive's path.
+    """
+    path = None
+    if archive_dir:
+        path = os.path.join(archive_dir, f'{partition.name}.csv.gz')
+        with connection.cursor() as cursor, gzip.open(path, 'wt') as archive:
+            cursor.copy_expert(f'COPY {partition.name} TO STDOUT WITH CSV HEADER', archive)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {partition.name}')
+        cursor.execute(f'DROP TABLE {partition.name}')
+    return path
+
+
+# private
+
+def _attach(name, start, end):
+    # Built standalone and attached rather than created as a partition, so
+    # that rows for the range can first be moved out of the default
+    # partition; attaching fails while it still holds any.
+    bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING STORAGE)')
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {TABLE}_default WHERE start_time >= %s AND start_time < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """,
+            [start, end],
+        )
+        cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES {bounds}')
+
+
+def _timestamp(value):
+    # pg_get_expr prints bounds in the session time zone, e.g.
+    # '2026-10-18 00:00:00+00'.
+    if re.search(r'[+-]\d\d$', value):
+        value += ':00'
+    return datetime.fromisoformat(value)
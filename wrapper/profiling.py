@@ -0,0 +1,236 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import random
+import statistics
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.decorators import sync_and_async_middleware
+
+
+_current = ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    """
+    Timings and query counts for one profiled request, broken down by the
+    phases marked with `phase()`. Queries run outside of any phase are
+    counted against the request as a whole. With `count_queries` off the
+    query counts are None, and left out of the Server-Timing header.
+    """
+
+    def __init__(self, path, count_queries=True):
+        self.path = path
+        self.count_queries = count_queries
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.queries = 0 if count_queries else None
+        self.query_seconds = 0.0 if count_queries else None
+        self.duration = None
+        self._active = None
+
+    def add(self, name, seconds):
+        phase = self.phases.setdefault(name, {'seconds': 0.0, 'queries': 0 if self.count_queries else None})
+        phase['seconds'] += seconds
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - start
+            if self._active is not None:
+                self.phases.setdefault(self._active, {'seconds': 0.0, 'queries': 0})['queries'] += 1
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def server_timing(self):
+        """
+        The profile as a Server-Timing header value, durations in ms.
+        """
+        if not self.count_queries:
+            entries = [f'{name};dur={phase["seconds"] * 1000:.2f}' for name, phase in self.phases.items()]
+            entries.append(f'total;dur={self.duration * 1000:.2f}')
+            return ', '.join(entries)
+        entries = [
+            f'{name};dur={phase["seconds"] * 1000:.2f};desc="{phase["queries"]} queries"'
+            for name, phase in self.phases.items()
+        ]
+        entries.append(f'db;dur={self.query_seconds * 1000:.2f};desc="{self.queries} queries"')
+        entries.append(f'total;dur={self.duration * 1000:.2f}')
+        return ', '.join(entries)
+
+    def as_dict(self):
+        return {
+            'time': time.time(),
+            'path': self.path,
+            'duration': self.duration,
+            'queries': self.queries,
+            'query_seconds': self.query_seconds,
+            'phases': self.phases,
+        }
+
+
+@contextmanager
+def phase(name):
+    """
+    Attributes the time spent, and queries run, in the block to `name` in
+    the current request's profile. Does nothing when the request is not
+    being profiled.
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    outer, profile._active = profile._active, name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+        profile._active = outer
+
+
+class ProfileLog:
+    """
+    Appends one JSON line per profiled request to `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, profile):
+        line = json.dumps(profile.as_dict()) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as log:
+                log.write(line)
+
+
+def read_profiles(path):
+    with open(path) as log:
+        return [json.loads(line) for line in log if line.strip()]
+
+
+def summarize(profiles):
+    """
+    Aggregates logged profiles per request path: how many were sampled,
+    the mean, p50 and p95 duration and mean query count, and for each
+    phase its mean duration, mean query count and share of the total time.
+    Query counts are averaged over the profiles that counted queries, and
+    are None when none did.
+    """
+    by_path = {}
+    for profile in profiles:
+        by_path.setdefault(profile['path'], []).append(profile)
+
+    summary = {}
+    for path, samples in sorted(by_path.items()):
+        durations = sorted(sample['duration'] for sample in samples)
+        total = sum(durations)
+        counted = [sample for sample in samples if sample.get('queries') is not None]
+        phases = {}
+        for sample in samples:
+            for name, phase in sample['phases'].items():
+                totals = phases.setdefault(name, {'seconds': 0.0, 'queries': 0})
+                totals['seconds'] += phase['seconds']
+                totals['queries'] += phase.get('queries') or 0
+        summary[path] = {
+            'requests': len(samples),
+            'mean': total / len(samples),
+            'p50': _percentile(durations, 0.5),
+            'p95': _percentile(durations, 0.95),
+            'queries': statistics.mean(sample['queries'] for sample in counted) if counted else None,
+            'phases': {
+                name: {
+                    'mean': totals['seconds'] / len(samples),
+                    'queries': totals['queries'] / len(counted) if counted else None,
+                    'share': totals['seconds'] / total if total else 0,
+                }
+                for name, totals in sorted(phases.items(), key=lambda item: -item[1]['seconds'])
+            },
+        }
+    return summary
+
+
+def _percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def should_profile(request):
+    if getattr(settings, 'PROFILING_HEADER', False) and request.headers.get('X-Profile'):
+        return True
+    rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def profile_log():
+    global _log
+    path = getattr(settings, 'PROFILING_LOG', None)
+    if not path:
+        return None
+    with _log_lock:
+        if _log is None or _log.path != path:
+            _log = ProfileLog(path)
+        return _log
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """
+    Profiles a sample of requests, PROFILING_SAMPLE_RATE of them, plus any
+    sent with an X-Profile header when PROFILING_HEADER is on. Profiled
+    responses carry a Server-Timing header with the time and queries of
+    each phase, and each profile is appended to PROFILING_LOG.
+
+    Queries are counted through an execute wrapper on the request thread's
+    connection. On the async path they run in sync_to_async threads that
+    it can't see, so profiles taken there have no query counts or `db`
+    entry; the queries' time still shows up in the enclosing phase.
+    """
+
+    def start(request, count_queries=True):
+        profile = RequestProfile(request.path, count_queries=count_queries)
+        return profile, _current.set(profile)
+
+    def finish(profile, response):
+        profile.finish()
+        response['Server-Timing'] = profile.server_timing()
+        log = profile_log()
+        if log is not None:
+            log.write(profile)
+        return response
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not should_profile(request):
+                return await get_response(request)
+            profile, token = start(request, count_queries=False)
+            try:
+                response = await get_response(request)
+            finally:
+                _current.reset(token)
+            return finish(profile, response)
+    else:
+        def middleware(request):
+            if not should_profile(request):
+                return get_response(request)
+            profile, token = start(request)
+            try:
+                with connection.execute_wrapper(profile.query_wrapper):
+                    response = get_response(request)
+            finally:
+                _current.reset(token)
+            return finish(profile, response)
+
+    return middleware
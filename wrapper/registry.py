@@ -0,0 +1,172 @@
+from bisect import bisect_right
+from collections import namedtuple
+from decimal import Decimal
+from fractions import Fraction
+from functools import reduce
+import math
+import os
+import random
+import threading
+import time
+
+from wrapper.models import Server
+
+
+ServerEntry = namedtuple(
+    'ServerEntry',
+    ['id', 'url', 'weight', 'rate_limit', 'max_concurrency'],
+    defaults=[None, None],
+)
+
+
+class ServerSnapshot:
+    """
+    Immutable view of the provider list as it was when the snapshot was
+    loaded. Everything a routing strategy needs is computed up front so
+    that choosing a target never touches the database.
+    """
+
+    def __init__(self, servers):
+        self.servers = tuple(servers)
+        self.by_url = {server.url: server for server in self.servers}
+        self.by_id = {server.id: server for server in self.servers}
+
+        # Running totals are summed as Decimals so no precision is lost
+        # before the single float conversion used for selection.
+        running = Decimal(0)
+        cumulative = []
+        for server in self.servers:
+            running += max(Decimal(server.weight), Decimal(0))
+            cumulative.append(float(running))
+        self.cumulative_weights = tuple(cumulative)
+        self.total_weight = float(running)
+        self._subsets = {}
+        self._smooth_sequence = None
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __getitem__(self, index):
+        return self.servers[index]
+
+    def get(self, url):
+        return self.by_url.get(url)
+
+    def without(self, server_ids):
+        """
+        Returns a snapshot of the servers not in `server_ids`. Subsets are
+        memoised, since the same few servers tend to be excluded over and
+        over while a breaker stays open.
+        """
+        if not server_ids:
+            return self
+        key = frozenset(server_ids)
+        subset = self._subsets.get(key)
+        if subset is None:
+            if len(self._subsets) >= 64:
+                self._subsets.clear()
+            subset = self._subsets[key] = ServerSnapshot(s for s in self.servers if s.id not in key)
+        return subset
+
+    @property
+    def smooth_sequence(self):
+        """
+        One full period of nginx's smooth weighted round-robin over these
+        servers: each server appears in proportion to its weight, spread out
+        as evenly as possible rather than in runs. Worked out once per
+        snapshot so that picking the next server is just an index.
+        """
+        if self._smooth_sequence is None:
+            self._smooth_sequence = tuple(self._smooth_weighted())
+        return self._smooth_sequence
+
+    def weighted_choice(self, rand=random.random):
+        """
+        Picks a server with probability proportional to its weight in
+        O(log n) by bisecting the cumulative weights. Servers with a zero
+        weight are never picked unless every weight is zero, in which case
+        the choice is uniform.
+        """
+        if not self.servers:
+            raise IndexError('Cannot choose from an empty server list')
+        if self.total_weight <= 0:
+            return self.servers[int(rand() * len(self.servers))]
+        index = bisect_right(self.cumulative_weights, rand() * self.total_weight)
+        return self.servers[min(index, len(self.servers) - 1)]
+
+
+    def _smooth_weighted(self):
+        if not self.servers:
+            return
+        # The smallest whole numbers in the same ratio as the weights.
+        weights = [max(Fraction(Decimal(server.weight)), Fraction(0)) for server in self.servers]
+        if not any(weights):
+            weights = [Fraction(1)] * len(self.servers)
+        scale = reduce(lambda a, b: a * b // math.gcd(a, b), (w.denominator for w in weights))
+        weights = [int(weight * scale) for weight in weights]
+        divisor = reduce(math.gcd, weights)
+        weights = [weight // divisor for weight in weights]
+        total = sum(weights)
+        current = [0] * len(self.servers)
+        for _ in range(total):
+            for i, weight in enumerate(weights):
+                current[i] += weight
+            best = max(range(len(current)), key=lambda i: (current[i], -i))
+            current[best] -= total
+            yield self.servers[best]
+
+
+class ServerRegistry:
+    """
+    Caches a ServerSnapshot for up to `ttl` seconds. Saving or deleting a
+    Server invalidates the cache (see wrapper.signals), so the TTL only
+    bounds staleness for changes made outside of this process.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = float(ttl if ttl is not None else os.getenv('LB_REGISTRY_TTL', '30'))
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._loaded_at = 0
+
+    def peek(self):
+        """
+        Returns the cached snapshot if it is still within its TTL, or None,
+        without ever touching the database.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return snapshot
+        return None
+
+    def snapshot(self):
+        snapshot = self.peek()
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self._snapshot = self.load()
+                self._loaded_at = time.monotonic()
+            return self._snapshot
+
+    def load(self):
+        servers = Server.objects.order_by('id').values_list(*ServerEntry._fields)
+        return ServerSnapshot(ServerEntry(*server) for server in servers)
+
+    def url_for(self, server_id):
+        """
+        The url of the server with id `server_id`, which is how metrics
+        label providers, or an empty string if there is no such server.
+        """
+        server = self.snapshot().by_id.get(server_id)
+        return server.url if server else ''
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+
+REGISTRY = ServerRegistry()
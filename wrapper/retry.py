@@ -0,0 +1,326 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from wrapper.latency import P2Quantile
+from wrapper.metrics import SEND_FAILURES, SEND_RETRIES, SEND_SECONDS
+from wrapper.models import SentMessage
+from wrapper.profiling import phase
+from wrapper.throttle import Saturated
+
+
+logger = logging.getLogger(__name__)
+
+
+class SendFailed(Exception):
+    pass
+
+
+class RetryPolicy:
+    """
+    How a message is forwarded to the providers. Configured once from the
+    environment:
+        MAX_RETRY           attempts per message (2)
+        RETRY_BASE_DELAY    backoff before the second attempt, doubling after (0.1)
+        RETRY_MAX_DELAY     cap on the backoff (2)
+        SEND_DEADLINE       seconds after which no new attempt is started (30)
+        SEND_HEDGE          `on` to enable hedged sends (off)
+        SEND_HEDGE_CONCURRENCY
+                            provider requests in flight for hedged sends at
+                            once; past it sends are not hedged (32)
+
+    Every retry goes to a server that has not been tried for this message,
+    as long as one is left, after sleeping a random fraction of the backoff
+    ("full jitter") so that retries from many senders don't arrive in step.
+
+    With hedging on, an attempt still unanswered after the p95 of recent
+    provider round trips is duplicated to a second server, and whichever
+    answers successfully first wins. The copies go to different providers,
+    so the shared Idempotency-Key does not keep both from delivering: a
+    hedged message can reach the recipient twice. A copy accepted after
+    the winner, or after the deadline, is saved as a SentMessage of its
+    own so that its delivery callback is still matched.
+    """
+
+    def __init__(self, attempts=None, base_delay=None, max_delay=None, deadline=None, hedge=None,
+                 hedge_concurrency=None, rand=random.random, sleep=time.sleep, asleep=asyncio.sleep,
+                 clock=time.monotonic):
+        self.attempts = int(attempts if attempts is not None else os.getenv('MAX_RETRY', '2'))
+        self.base_delay = float(base_delay if base_delay is not None else os.getenv('RETRY_BASE_DELAY', '0.1'))
+        self.max_delay = float(max_delay if max_delay is not None else os.getenv('RETRY_MAX_DELAY', '2'))
+        self.deadline = float(deadline if deadline is not None else os.getenv('SEND_DEADLINE', '30'))
+        self.hedge = hedge if hedge is not None else os.getenv('SEND_HEDGE', 'off') == 'on'
+        self.hedge_concurrency = int(
+            hedge_concurrency if hedge_concurrency is not None else os.getenv('SEND_HEDGE_CONCURRENCY', '32')
+        )
+        self.rand = rand
+        self.sleep = sleep
+        self.asleep = asleep
+        self.clock = clock
+        # Hedging waits for this many round trips before trusting the p95.
+        self.min_samples = 20
+        self._round_trips = P2Quantile(0.95)
+        self._samples = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        # One slot per thread of the hedge pool, taken before submitting to
+        # it, so an attempt never waits in its queue while its hedge timer
+        # is already running.
+        self._hedge_slots = threading.BoundedSemaphore(self.hedge_concurrency)
+
+    def backoff(self, retry):
+        """
+        Seconds to sleep before retry number `retry` (0 for the first).
+        """
+        return self.rand() * min(self.max_delay, self.base_delay * 2 ** retry)
+
+    def hedge_delay(self):
+        """
+        Seconds to wait on an attempt before hedging it, or None while too
+        few round trips have been seen to tell.
+        """
+        with self._lock:
+            if self._samples < self.min_samples:
+                return None
+            return self._round_trips.value
+
+    def observe(self, seconds):
+        with self._lock:
+            self._round_trips.update(seconds)
+            self._samples += 1
+
+    def send(self, balancer, payload, idempotency_key=None, max_wait=None):
+        """
+        Forwards `payload` through `balancer`. Returns the first successful
+        response, or None once attempts or the deadline run out, or once
+        every provider has stayed at its limits for `max_wait` seconds
+        (the balancer's THROTTLE_MAX_WAIT by default).
+        """
+        started = time.perf_counter()
+        max_wait = balancer.max_wait if max_wait is None else max_wait
+        response = self._send(balancer, payload, idempotency_key, max_wait)
+        if response is None:
+            SEND_FAILURES.inc()
+        SEND_SECONDS.observe(time.perf_counter() - started, outcome='failed' if response is None else 'ok')
+        return response
+
+    async def asend(self, balancer, payload, idempotency_key=None):
+        """
+        Async twin of send(), through balancer.arequest(), with the same
+        failover, backoff and deadline. Sends are not hedged.
+        """
+        started = time.perf_counter()
+        response = await self._asend(balancer, payload, idempotency_key)
+        if response is None:
+            SEND_FAILURES.inc()
+        SEND_SECONDS.observe(time.perf_counter() - started, outcome='failed' if response is None else 'ok')
+        return response
+
+    # private
+
+    async def _asend(self, balancer, payload, idempotency_key):
+        headers = self._headers(idempotency_key)
+        give_up_at = self.clock() + self.deadline
+        tried = set()
+
+        attempt = 0
+        while attempt < self.attempts:
+            try:
+                server = await balancer.achoose(exclude=frozenset(tried))
+                tried.add(server.id)
+                started = self.clock()
+                return self._check(await balancer.arequest(payload, headers=headers, server=server), started)
+            except Saturated as e:
+                delay, retrying = e.retry_after, False
+            except Exception as e:
+                logger.error(f'The following exception occured:\n{e}')
+                attempt += 1
+                if attempt == self.attempts:
+                    break
+                delay, retrying = self.backoff(attempt - 1), True
+            if self.clock() + delay >= give_up_at:
+                logger.error('Deadline reached before the message could be forwarded.')
+                break
+            await self.asleep(delay)
+            if retrying:
+                SEND_RETRIES.inc()
+
+        return None
+
+    def _headers(self, idempotency_key):
+        return {
+            "Content-Type": "application/json",
+            "Idempotency-Key": idempotency_key or uuid.uuid4().hex,
+        }
+
+    def _send(self, balancer, payload, idempotency_key, max_wait):
+        headers = self._headers(idempotency_key)
+        give_up_at = self.clock() + self.deadline
+        tried = set()
+        saturated_until = None
+
+        attempt = 0
+        while attempt < self.attempts:
+            try:
+                return self._attempt(balancer, payload, headers, tried, give_up_at)
+            except Saturated as e:
+                # Waiting for a provider to have room doesn't use up an
+                # attempt, but only goes on for max_wait seconds at a stretch.
+                if saturated_until is None:
+                    saturated_until = self.clock() + max_wait
+                if self.clock() + e.retry_after > saturated_until:
+                    logger.error('Every provider stayed at its limits; giving up.')
+                    break
+                delay, retrying = e.retry_after, False
+            except Exception as e:
+                saturated_until = None
+                logger.error(f'The following exception occured:\n{e}')
+                attempt += 1
+                if attempt == self.attempts:
+                    break
+                delay, retrying = self.backoff(attempt - 1), True
+            if self.clock() + delay >= give_up_at:
+                logger.error('Deadline reached before the message could be forwarded.')
+                break
+            self.sleep(delay)
+            if retrying:
+                SEND_RETRIES.inc()
+
+        return None
+
+    def _attempt(self, balancer, payload, headers, tried, give_up_at):
+        delay = self.hedge_delay() if self.hedge else None
+        if delay is None or not self._hedge_slots.acquire(blocking=False):
+            return self._send_once(balancer, payload, headers, tried)
+
+        try:
+            with phase('route'):
+                first = balancer.choose(exclude=frozenset(tried))
+        except BaseException:
+            self._hedge_slots.release()
+            raise
+        tried.add(first.id)
+        executor = self._hedge_executor()
+        race = _Race()
+        pending = {executor.submit(self._send_to, balancer, first, payload, headers, race, give_up_at)}
+        done, _ = wait(pending, timeout=max(0, min(delay, give_up_at - self.clock())))
+        if not done:
+            second = self._hedge_target(balancer, tried)
+            if second is not None:
+                pending.add(executor.submit(self._send_to, balancer, second, payload, headers, race, give_up_at))
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0, give_up_at - self.clock()), return_when=FIRST_COMPLETED)
+            if not done:
+                with race.lock:
+                    if race.winner is None:
+                        # Copies still in flight are saved if they succeed.
+                        race.abandoned = True
+                        raise SendFailed('Deadline reached waiting on the providers.')
+                continue  # a copy won just now and is about to return
+            for future in done:
+                try:
+                    response, server = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if server is race.winner:
+                    balancer.targeted_server = server
+                    return response
+        raise error
+
+    def _hedge_target(self, balancer, tried):
+        if not self._hedge_slots.acquire(blocking=False):
+            return None
+        try:
+            server = balancer.choose(exclude=frozenset(tried))
+        except Saturated:
+            self._hedge_slots.release()
+            return None
+        if server.id in tried:
+            # Only servers already tried are left, so there is nothing to hedge with.
+            balancer.release(server)
+            self._hedge_slots.release()
+            return None
+        tried.add(server.id)
+        return server
+
+    def _send_once(self, balancer, payload, headers, tried):
+        with phase('route'):
+            server = balancer.choose(exclude=frozenset(tried))
+        # Only recorded once routing has succeeded: when choose() raises
+        # Saturated, no server was tried for this message.
+        tried.add(server.id)
+        started = self.clock()
+        response = balancer.request(payload, headers=headers, server=server)
+        return self._check(response, started)
+
+    def _send_to(self, balancer, server, payload, headers, race, give_up_at):
+        try:
+            if self.clock() >= give_up_at:
+                balancer.release(server)
+                raise SendFailed('Deadline reached before the attempt started.')
+            started = self.clock()
+            response = self._check(balancer.request(payload, headers=headers, server=server), started)
+            with race.lock:
+                won = race.winner is None and not race.abandoned
+                if won:
+                    race.winner = server
+            if not won:
+                self._save_duplicate(payload, server, response)
+            return response, server
+        finally:
+            self._hedge_slots.release()
+            close_old_connections()
+
+    def _save_duplicate(self, payload, server, response):
+        try:
+            SentMessage.objects.create(
+                uuid=response.json()["message_id"],
+                number=payload.get("to_number"),
+                message=payload.get("message"),
+                status="pending",
+                start_time=timezone.now(),
+                server_id=server.id,
+            )
+        except Exception as e:
+            logger.error(f'The following exception occured:\n{e}')
+
+    def _check(self, response, started):
+        if response.status_code != 200:
+            raise SendFailed(response.json()["message"])
+        self.observe(self.clock() - started)
+        return response
+
+    def _hedge_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.hedge_concurrency,
+                    thread_name_prefix='send-hedge',
+                )
+            return self._executor
+
+
+class _Race:
+    """
+    The copies of one hedged send: the first to succeed sets `winner`, and
+    once the caller stops waiting `abandoned` is set.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.winner = None
+        self.abandoned = False
+
+
+RETRY_POLICY = RetryPolicy()
@@ -0,0 +1,48 @@
+import itertools
+import os
+
+from django.db import connection
+
+
+class LocalRotation:
+    """
+    Position in the round-robin rotation, shared by the threads of this
+    process. Advancing an itertools.count is a single atomic step under the
+    GIL, so concurrent threads never draw the same position and no lock is
+    needed.
+    """
+
+    uses_database = False
+
+    def __init__(self):
+        self._count = itertools.count()
+
+    def next(self):
+        return next(self._count)
+
+
+class SequenceRotation:
+    """
+    Position in the round-robin rotation shared by every process using the
+    database, drawn from a PostgreSQL sequence (created by migration 0008).
+    Costs one round trip per choice, in exchange for an even rotation
+    across all gunicorn workers rather than one rotation per worker.
+    """
+
+    uses_database = True
+
+    def __init__(self, sequence='wrapper_lb_rotation'):
+        self.sequence = sequence
+
+    def next(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT nextval(%s)', [self.sequence])
+            return cursor.fetchone()[0] - 1
+
+
+def rotation(mode=None):
+    """
+    Returns the rotation for LB_RR_MODE: `local` (the default) or `postgres`.
+    """
+    mode = mode or os.getenv('LB_RR_MODE', 'local')
+    return SequenceRotation() if mode == 'postgres' else LocalRotation()
@@ -0,0 +1,253 @@
+from decimal import Decimal
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import uuid
+
+from django.db import close_old_connections, connections, transaction
+
+from wrapper.models import RoutingSetting
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'text_api_routing'
+
+
+class LocalBackend:
+    """
+    Stand-in for PostgresBackend that only reaches the RoutingStates of
+    this process, for a single worker, development and tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def start(self, deliver, resync):
+        with self._lock:
+            self._subscribers.append(deliver)
+
+    def publish(self, payload, using=None):
+        if using is not None:
+            transaction.on_commit(lambda: self.publish(payload), using=using)
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for deliver in subscribers:
+            deliver(payload)
+
+    def stop(self):
+        with self._lock:
+            self._subscribers = []
+
+
+class PostgresBackend:
+    """
+    Carries messages between every process using the database through
+    PostgreSQL LISTEN/NOTIFY. One thread per process, on its own
+    connection, both listens and sends, so publishing never blocks a
+    request or touches the event loop. Whenever it has to reconnect,
+    messages may have been missed, so the state is resynced from the
+    database.
+
+    Messages about a change made in a transaction are instead sent on the
+    connection making it, where PostgreSQL holds them until the commit;
+    that also works in processes that never start listening.
+    """
+
+    def __init__(self, channel=CHANNEL, alias='default', reconnect_delay=1):
+        self.channel = channel
+        self.alias = alias
+        self.reconnect_delay = reconnect_delay
+        self._outbox = queue.Queue()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_write, False)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self, deliver, resync):
+        self._thread = threading.Thread(target=self._run, args=(deliver, resync), daemon=True, name='routing-state')
+        self._thread.start()
+
+    def publish(self, payload, using=None):
+        if using is not None:
+            with connections[using].cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, payload])
+            return
+        self._outbox.put(payload)
+        self._wake()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+
+    # private
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the thread is due to wake anyway.
+            pass
+
+    def _run(self, deliver, resync):
+        import psycopg2
+
+        reconnecting = False
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**connections[self.alias].get_connection_params())
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+                if reconnecting:
+                    resync()
+                    close_old_connections()
+                self._listen(conn, deliver)
+            except Exception as e:
+                logger.error(f'The following exception occured:\n{e}')
+                reconnecting = True
+                self._stopping.wait(self.reconnect_delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _listen(self, conn, deliver):
+        while not self._stopping.is_set():
+            readable, _, _ = select.select([conn, self._wake_read], [], [])
+            if self._wake_read in readable:
+                os.read(self._wake_read, 4096)
+                self._send(conn)
+            if conn in readable:
+                conn.poll()
+                while conn.notifies:
+                    deliver(conn.notifies.pop(0).payload)
+
+    def _send(self, conn):
+        while True:
+            try:
+                payload = self._outbox.get_nowait()
+            except queue.Empty:
+                return
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, payload])
+
+
+class RoutingState:
+    """
+    Keeps the routing state of every worker process in step. Each process
+    still routes from its own memory, with no database reads per request;
+    changes are broadcast through LB_SHARED_STATE, `local` (the default,
+    this process only) or `postgres` (LISTEN/NOTIFY), and applied by every
+    other process as they arrive:
+
+        strategy  set through /update_lb_strat/; with `postgres` it is also
+                  persisted for workers started later, and then takes
+                  precedence over LB_STRAT
+        servers   a Server saved or deleted, so snapshots are reloaded
+        breaker   a provider's circuit breaker opening or closing
+        weights   the effective weights of the adaptive weight controller
+
+    Latency estimates and in-flight counts stay per process.
+    """
+
+    def __init__(self, backend=None, persist=None):
+        mode = os.getenv('LB_SHARED_STATE', 'local')
+        self.backend = backend or backend_for(mode)
+        # A single process has no later workers to hand the strategy to, and
+        # persisting it there would override LB_STRAT on every restart.
+        self.persist = mode == 'postgres' if persist is None else persist
+        self.origin = uuid.uuid4().hex
+        self.started = False
+        self._lock = threading.Lock()
+        self._handlers = {}
+
+    def on(self, kind, handler):
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def attach(self, balancer):
+        """
+        Applies the changes other processes make to `balancer`, and
+        broadcasts its breaker and weight changes to them.
+        """
+        self.on('strategy', lambda message: balancer.set_strat(message['strategy']))
+        self.on('servers', lambda message: balancer.registry.invalidate())
+        self.on('breaker', lambda message: balancer.health.apply(message['url'], message['state']))
+        self.on('weights', lambda message: balancer.weights.receive(
+            {int(server_id): Decimal(weight) for server_id, weight in message['weights'].items()}
+        ))
+        balancer.health.on_change = lambda url, state: self.publish('breaker', url=url, state=state)
+        balancer.weights.on_change = lambda weights: self.publish(
+            'weights', weights={server_id: str(weight) for server_id, weight in weights.items()}
+        )
+        balancer.shared = self
+
+    def start(self):
+        """
+        Loads the persisted state and starts listening for changes. Reads
+        the database once, so call it where queries are allowed.
+        """
+        if self.started:
+            return
+        with self._lock:
+            if not self.started:
+                self.resync()
+                self.backend.start(self.receive, self.resync)
+                self.started = True
+
+    def publish(self, kind, using=None, **data):
+        """
+        Broadcasts a change this process has already applied to itself. A
+        change saved through the `using` database alias is only broadcast
+        once its transaction commits.
+        """
+        self.backend.publish(json.dumps({'origin': self.origin, 'kind': kind, **data}), using=using)
+
+    def receive(self, payload):
+        message = json.loads(payload)
+        if message.get('origin') != self.origin:
+            self._dispatch(message)
+
+    def resync(self):
+        """
+        Reloads what could have changed while messages were not being
+        received: the persisted strategy, if any, and the server list.
+        """
+        strategy = None
+        if self.persist:
+            strategy = RoutingSetting.objects.filter(name='strategy').values_list('value', flat=True).first()
+        self._dispatch({'kind': 'servers'})
+        if strategy:
+            self._dispatch({'kind': 'strategy', 'strategy': strategy})
+
+    def save_strategy(self, strategy):
+        """
+        Broadcasts `strategy` to the other processes, and persists it when
+        state is shared between them.
+        """
+        if self.persist:
+            RoutingSetting.objects.update_or_create(name='strategy', defaults={'value': strategy})
+        self.publish('strategy', strategy=strategy)
+
+    # private
+
+    def _dispatch(self, message):
+        for handler in self._handlers.get(message['kind'], []):
+            try:
+                handler(message)
+            except Exception as e:
+                logger.error(f'The following exception occured:\n{e}')
+
+
+def backend_for(mode):
+    return PostgresBackend() if mode == 'postgres' else LocalBackend()
+
+
+ROUTING = RoutingState()
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def pool_settings(pool_size=None, connect_timeout=None, read_timeout=None):
+    """
+    Returns the pool size and (connect, read) timeout pair for provider
+    connections, falling back to the environment for anything not given.
+    """
+    pool_size = int(pool_size or os.getenv('PROVIDER_POOL_SIZE', '10'))
+    timeout = (
+        float(connect_timeout or os.getenv('PROVIDER_CONNECT_TIMEOUT', '3.05')),
+        float(read_timeout or os.getenv('PROVIDER_READ_TIMEOUT', '10')),
+    )
+    return pool_size, timeout
+
+
+class SessionPool:
+    """
+    Keeps one requests.Session per provider url so that TCP and TLS
+    connections are kept alive and reused between messages instead of
+    being opened for every call.
+
+    Configured from the environment:
+        PROVIDER_POOL_SIZE        connections kept alive per provider (10)
+        PROVIDER_CONNECT_TIMEOUT  seconds to establish a connection (3.05)
+        PROVIDER_READ_TIMEOUT     seconds to wait for the provider (10)
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.pool_size, self.timeout = pool_settings(pool_size, connect_timeout, read_timeout)
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def session(self, url):
+        session = self._sessions.get(url)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(url)
+                if session is None:
+                    session = self._sessions[url] = self._build_session()
+        return session
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).post(url, **kwargs)
+
+    def stats(self):
+        """
+        Returns per-provider connection counters: requests sent,
+        connections opened, connections currently idle in the pool and the
+        share of requests that reused an existing connection.
+        """
+        stats = {}
+        for url, session in list(self._sessions.items()):
+            sent = opened = idle = 0
+            for pool in self._connection_pools(session):
+                sent += pool.num_requests
+                opened += pool.num_connections
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            stats[url] = {
+                'requests': sent,
+                'connections_opened': opened,
+                'connections_idle': idle,
+                'reuse_ratio': (sent - opened) / sent if sent else 0,
+            }
+        return stats
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    # private
+
+    def _build_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=0,
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _connection_pools(self, session):
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    yield pool
+
+
+class AsyncSessionPool:
+    """
+    The asyncio counterpart of SessionPool: one httpx.AsyncClient per
+    provider url, sharing the same pool size and timeout settings.
+
+    httpx clients are bound to the event loop they were first used on, so
+    clients are kept per running loop. Under ASGI there is a single loop;
+    async views served through WSGI get a short-lived loop per request and
+    their clients are dropped along with it.
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.pool_size, (connect, read) = pool_settings(pool_size, connect_timeout, read_timeout)
+        self.timeout = httpx.Timeout(read, connect=connect)
+        self._clients = weakref.WeakKeyDictionary()
+
+    def client(self, url):
+        clients = self._clients.setdefault(asyncio.get_running_loop(), {})
+        client = clients.get(url)
+        if client is None:
+            client = clients[url] = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=None,
+                    max_keepalive_connections=self.pool_size,
+                ),
+            )
+        return client
+
+    async def post(self, url, **kwargs):
+        return await self.client(url).post(url, **kwargs)
+
+    async def aclose(self):
+        clients = self._clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+
+SESSIONS = SessionPool()
+ASYNC_SESSIONS = AsyncSessionPool()
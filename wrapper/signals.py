@@ -0,0 +1,31 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from wrapper.blocklist import INVALID_NUMBERS
+from wrapper.metrics import instrument_connection
+from wrapper.models import InvalidNumber, Server
+from wrapper.registry import REGISTRY
+from wrapper.routing_state import ROUTING
+
+
+@receiver(post_save, sender=Server)
+@receiver(post_delete, sender=Server)
+def invalidate_server_registry(sender, using, **kwargs):
+    # Other workers are told on the saving connection, and this process
+    # reloads, only once the change is committed, so no one caches the old
+    # rows in between.
+    ROUTING.publish('servers', using=using)
+    transaction.on_commit(REGISTRY.invalidate, using=using)
+
+
+@receiver(post_save, sender=InvalidNumber)
+def add_to_invalid_number_cache(sender, instance, **kwargs):
+    INVALID_NUMBERS.add(instance.number)
+
+
+
+@receiver(connection_created)
+def time_database_queries(sender, connection, **kwargs):
+    instrument_connection(connection)
@@ -0,0 +1,213 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import heapq
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+
+class StubProvider:
+    """
+    A local stand-in for an SMS provider, for benchmarks and load tests.
+    Every POST sleeps for a latency drawn from `distribution` around a
+    mean of `latency` seconds (`fixed`, `exponential` or `lognormal`) and
+    then answers 200 with a fresh message_id, the way the real providers
+    acknowledge a message. An `error_rate` share of them answer 500
+    instead.
+
+    With `concurrency` set, at most that many messages are worked on at
+    once and the rest wait their turn, like a provider at capacity.
+
+    With `callback_delay` set, each accepted message is reported delivered
+    (or invalid, for an `invalid_rate` share) to its callback_url after an
+    exponentially distributed delay of that mean, as the providers do.
+    """
+
+    distributions = ['fixed', 'exponential', 'lognormal']
+
+    def __init__(self, latency=0.05, host='127.0.0.1', port=0, concurrency=None, distribution='fixed',
+                 error_rate=0, callback_delay=None, invalid_rate=0, seed=None):
+        if distribution not in self.distributions:
+            raise ValueError(f'Unknown latency distribution: {distribution}')
+        self.latency = latency
+        self.distribution = distribution
+        self.error_rate = error_rate
+        self.callback_delay = callback_delay
+        self.invalid_rate = invalid_rate
+        self._random = random.Random(seed)
+        self._slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.received = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._callbacks = _CallbackSender() if callback_delay is not None else None
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    @property
+    def callbacks_sent(self):
+        return self._callbacks.sent if self._callbacks else 0
+
+    @property
+    def callbacks_failed(self):
+        return self._callbacks.failed if self._callbacks else 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        if self._callbacks:
+            self._callbacks.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._callbacks:
+            self._callbacks.stop()
+
+    def drain(self, timeout=None):
+        """
+        Waits until every scheduled callback has been sent. Returns whether
+        they all were before `timeout`.
+        """
+        return self._callbacks.drain(timeout) if self._callbacks else True
+
+    def respond(self, payload):
+        """
+        Returns the (status, body) pair for a message `payload`.
+        """
+        with self._lock:
+            delay = self._sample_latency()
+            failed = self._random.random() < self.error_rate
+        if self._slots is not None:
+            with self._slots:
+                time.sleep(delay)
+        else:
+            time.sleep(delay)
+        with self._lock:
+            self.received += 1
+            if failed:
+                self.errors += 1
+        if failed:
+            return 500, {'message': 'Stub provider error.'}
+
+        message_id = uuid.uuid4().hex
+        if self._callbacks and payload.get('callback_url'):
+            with self._lock:
+                status = 'invalid' if self._random.random() < self.invalid_rate else 'delivered'
+                after = self._random.expovariate(1 / self.callback_delay) if self.callback_delay else 0
+            self._callbacks.schedule(after, payload['callback_url'], {'message_id': message_id, 'status': status})
+        return 200, {'message_id': message_id}
+
+    # private
+
+    def _sample_latency(self):
+        if self.latency <= 0 or self.distribution == 'fixed':
+            return self.latency
+        if self.distribution == 'exponential':
+            return self._random.expovariate(1 / self.latency)
+        # A lognormal with this mean: heavier tailed than the exponential.
+        sigma = 0.8
+        return self._random.lognormvariate(math.log(self.latency) - sigma ** 2 / 2, sigma)
+
+    def _handler(self):
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                status, body = provider.respond(payload)
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class _CallbackSender:
+    """
+    Posts delivery callbacks once they are due, from a few worker threads
+    so that a slow /ingest/ delays callbacks rather than provider answers.
+    """
+
+    def __init__(self, workers=4):
+        self.sent = 0
+        self.failed = 0
+        self._due = []
+        self._pending = 0
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._session = requests.Session()
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._session.close()
+
+    def schedule(self, delay, url, body):
+        with self._condition:
+            self._sequence += 1
+            self._pending += 1
+            heapq.heappush(self._due, (time.monotonic() + delay, self._sequence, url, body))
+            self._condition.notify()
+
+    def drain(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout)
+
+    # private
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping and (not self._due or self._due[0][0] > time.monotonic()):
+                    self._condition.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                if self._stopping:
+                    return
+                _, _, url, body = heapq.heappop(self._due)
+            try:
+                ok = self._session.post(url, json=body, timeout=10).status_code == 200
+            except requests.RequestException as e:
+                logger.error(f'The following exception occured:\n{e}')
+                ok = False
+            with self._condition:
+                self._pending -= 1
+                self.sent += 1
+                self.failed += not ok
+                self._condition.notify_all()
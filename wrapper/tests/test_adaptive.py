@@ -0,0 +1,103 @@
+from decimal import Decimal
+import json
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from wrapper.adaptive import WeightController
+from wrapper.health import HealthRegistry
+from wrapper.inflight import InFlightCounter
+from wrapper.latency import LatencyTracker
+from wrapper.load_balancer import LoadBalancer
+from wrapper.models import Server
+from wrapper.registry import REGISTRY, ServerEntry, ServerSnapshot
+from wrapper.throttle import Throttle
+from wrapper.views import LBWeightsView
+
+
+class TestWeightController(SimpleTestCase):
+    def setUp(self):
+        self.servers = ServerSnapshot([ServerEntry(1, 'fast', Decimal('0.5')), ServerEntry(2, 'slow', Decimal('0.5'))])
+        self.tracker = LatencyTracker(alpha=1)
+        self.health = HealthRegistry()
+        self.now = 0
+        self.controller = WeightController(
+            tracker=self.tracker, health=self.health, enabled=True, interval=10, damping=0.5, floor=0.1,
+            clock=lambda: self.now,
+        )
+
+    def weights(self):
+        return [server.weight for server in self.controller.apply(self.servers)]
+
+    def test_disabled_controller_keeps_configured_weights(self):
+        self.controller.enabled = False
+        self.tracker.observe(2, 1000)
+        self.assertIs(self.controller.apply(self.servers), self.servers)
+
+    def test_shifts_weight_away_from_slow_server_step_by_step(self):
+        self.tracker.observe(1, 100)
+        self.tracker.observe(2, 300)
+        # The median is 200, so the targets are 1 and 0.33, reached halfway.
+        self.assertEqual(self.weights(), [Decimal('0.75'), Decimal('0.42')])
+        # Nothing changes until the interval is up.
+        self.assertEqual(self.weights(), [Decimal('0.75'), Decimal('0.42')])
+        self.now = 10
+        self.assertEqual(self.weights(), [Decimal('0.88'), Decimal('0.38')])
+
+    def test_floors_servers_that_keep_failing(self):
+        for _ in range(4):
+            self.health.record('slow', 500)
+        self.health.record('slow', 200)
+        for tick in range(20):
+            self.now = tick * 10
+            weights = self.weights()
+        # The target, 0.5 * (1 - 0.8) ** 2, is below the floor of 0.05.
+        self.assertEqual(weights[0], Decimal('0.50'))
+        self.assertAlmostEqual(float(weights[1]), 0.05, delta=0.01)
+
+    def test_reuses_the_adjusted_snapshot_until_weights_change(self):
+        adjusted = self.controller.apply(self.servers)
+        self.now = 10
+        self.assertIs(self.controller.apply(self.servers), adjusted)
+        self.tracker.observe(1, 100)
+        self.tracker.observe(2, 300)
+        self.now = 20
+        self.assertIsNot(self.controller.apply(self.servers), adjusted)
+
+    def test_describe_reads_weights_without_adjusting_them(self):
+        self.controller.on_change = mock.MagicMock()
+        self.tracker.observe(1, 100)
+        self.tracker.observe(2, 300)
+        described = self.controller.describe(self.servers)
+        self.assertEqual([server['effective_weight'] for server in described], [0.5, 0.5])
+        self.controller.on_change.assert_not_called()
+        self.weights()
+        described = self.controller.describe(self.servers)
+        self.assertEqual([server['effective_weight'] for server in described], [0.75, 0.42])
+
+    def test_weighted_random_follows_adjusted_weights(self):
+        registry = mock.MagicMock()
+        registry.snapshot.return_value = self.servers
+        self.tracker.observe(1, 100)
+        self.tracker.observe(2, 10000)
+        lb = LoadBalancer(
+            strategy='weighted_random', registry=registry, tracker=self.tracker, health=self.health,
+            in_flight=InFlightCounter(), throttle=Throttle(), weights=self.controller,
+        )
+        picks = []
+        for _ in range(200):
+            server = lb.choose()
+            lb.release(server)
+            picks.append(server.url)
+        # One step in, the weights are 0.75 and 0.28: about 146 picks of fast.
+        self.assertGreater(picks.count('fast'), 120)
+
+
+class TestLBWeightsView(TestCase):
+    def test_lists_configured_and_effective_weights(self):
+        REGISTRY.invalidate()
+        server = Server.objects.create(url='server1', weight=0.3)
+        body = json.loads(LBWeightsView().get(None).content)
+        self.assertEqual(body['data']['servers'][0]['id'], server.id)
+        self.assertEqual(body['data']['servers'][0]['weight'], 0.3)
+        self.assertEqual(body['data']['servers'][0]['effective_weight'], 0.3)
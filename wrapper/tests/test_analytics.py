@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+import json
+from unittest import mock
+
+import numpy as np
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+
+from wrapper.analytics import Deliveries, StatsCache, delivery_stats, grouped_quantiles
+from wrapper.models import SentMessage, Server
+from wrapper.views import STATS, StatsView
+
+
+class TestAnalytics(SimpleTestCase):
+    def test_grouped_quantiles_match_numpy(self):
+        rng = np.random.default_rng(1)
+        groups = rng.integers(0, 5, 1000)
+        values = rng.exponential(1, 1000)
+        result = grouped_quantiles(groups, values, 6, [0.5, 0.95])
+        for group in range(5):
+            expected = np.quantile(values[groups == group], [0.5, 0.95])
+            np.testing.assert_allclose(result[:, group], expected)
+        self.assertTrue(np.isnan(result[:, 5]).all())
+
+    def test_delivery_stats_buckets_rates_and_latency(self):
+        since = datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc)
+        t = since.timestamp()
+        deliveries = Deliveries(
+            server=np.array([1, 1, 1, 2]),
+            start=np.array([t + 10, t + 20, t + 70, t + 5]),
+            end=np.array([t + 11, t + 23, np.nan, t + 6]),
+            status=np.array(['delivered', 'failed', 'pending', 'delivered'], dtype=object),
+        )
+        stats = delivery_stats(deliveries, since, since + timedelta(minutes=2), 60)
+        self.assertEqual(len(stats['buckets']), 2)
+        server = stats['servers'][1]
+        self.assertEqual((server['sent'], server['completed']), (3, 2))
+        self.assertAlmostEqual(server['delivery_rate'], 1 / 3)
+        self.assertAlmostEqual(server['failure_rate'], 1 / 3)
+        self.assertEqual(server['latency']['p50'], 2)
+        self.assertEqual(server['series']['sent'], [2, 1])
+        self.assertEqual(server['series']['delivery_rate'], [0.5, 0])
+        self.assertEqual(server['series']['p95'], [2.9, None])
+
+    def test_cache_computes_once_per_window_until_expired(self):
+        now = [0]
+        cache = StatsCache(ttl=30, clock=lambda: now[0])
+        with mock.patch.object(cache, 'compute', side_effect=lambda w, b: {'window': w}) as compute:
+            cache.get(60, 60)
+            cache.get(60, 60)
+            cache.get(120, 60)
+            now[0] = 31
+            cache.get(60, 60)
+        self.assertEqual(compute.call_count, 3)
+
+
+class TestDeliveriesLoad(TestCase):
+    def test_loads_epoch_seconds_across_chunks(self):
+        server = Server.objects.create(url='server1', weight=1)
+        since = datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc)
+        for i in range(3):
+            start = since + timedelta(seconds=i, microseconds=250000)
+            end = start + timedelta(seconds=1, microseconds=500) if i else None
+            SentMessage.objects.create(number=str(i), server=server, status='sent', start_time=start, end_time=end)
+        SentMessage.objects.create(number='9', server=server, start_time=since + timedelta(hours=1))
+        deliveries = Deliveries.load(since, since + timedelta(minutes=1), chunk_size=2)
+        order = np.argsort(deliveries.start)
+        np.testing.assert_array_equal(deliveries.server, [server.id] * 3)
+        np.testing.assert_allclose(deliveries.start[order] - since.timestamp(), [0.25, 1.25, 2.25])
+        np.testing.assert_allclose(deliveries.latency[order][1:], [1.0005, 1.0005])
+        self.assertTrue(np.isnan(deliveries.end[order][0]))
+        self.assertEqual(list(deliveries.status), ['sent'] * 3)
+
+    def test_loads_nothing(self):
+        since = datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc)
+        deliveries = Deliveries.load(since, since + timedelta(minutes=1))
+        self.assertEqual((len(deliveries.server), deliveries.start.dtype), (0, np.float64))
+
+
+class TestStatsView(TestCase):
+    def setUp(self):
+        STATS.reset()
+
+    def get(self, **params):
+        return StatsView().get(RequestFactory().get('/stats/', params))
+
+    def test_reports_each_server(self):
+        server = Server.objects.create(url='server1', weight=1)
+        start = timezone.now() - timedelta(minutes=1)
+        SentMessage.objects.create(
+            number='1', server=server, status='delivered', start_time=start, end_time=start + timedelta(seconds=2),
+        )
+        body = json.loads(self.get(window='5', bucket='60').content)
+        self.assertEqual(body['status'], 200)
+        self.assertEqual(body['data']['servers'][str(server.id)]['latency']['p99'], 2)
+        self.assertEqual(len(body['data']['buckets']), 5)
+
+    def test_rejects_too_many_buckets(self):
+        response = self.get(window='1440', bucket='1')
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,71 @@
+from datetime import timedelta
+from io import StringIO
+import os
+import tempfile
+import unittest
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+
+from wrapper.models import SentMessage, Server
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+@unittest.skipUnless(pyarrow, 'needs the packages in requirements/analytics.txt')
+class TestArchive(TestCase):
+    def setUp(self):
+        self.server = Server.objects.create(url='server1', weight=1)
+        self.start = timezone.now().replace(microsecond=0)
+        SentMessage.objects.create(
+            uuid='abc', number='1112223333', message='hi, "there"', status='delivered', server=self.server,
+            start_time=self.start, end_time=self.start + timedelta(seconds=2),
+        )
+        SentMessage.objects.create(number='1112224444', message='', status='queued', start_time=self.start)
+        self.dir = tempfile.mkdtemp()
+
+    def rows(self):
+        return list(SentMessage.objects.order_by('id').values_list(
+            'uuid', 'number', 'message', 'status', 'start_time', 'end_time', 'server_id',
+        ))
+
+    def round_trip(self, name, *export_args):
+        path = os.path.join(self.dir, name)
+        before = self.rows()
+        call_command('export_messages', path, '--batch-size', '1', *export_args, stdout=StringIO())
+        SentMessage.objects.all().delete()
+        call_command('import_messages', path, stdout=StringIO())
+        self.assertEqual(self.rows(), before)
+
+    def test_round_trips_through_parquet(self):
+        self.round_trip('messages.parquet')
+
+    def test_round_trips_through_uncompressed_arrow(self):
+        self.round_trip('messages.arrow', '--compression', 'none')
+
+    def test_import_with_new_ids_appends(self):
+        path = os.path.join(self.dir, 'messages.parquet')
+        call_command('export_messages', path, '--since', (self.start - timedelta(minutes=1)).isoformat(), stdout=StringIO())
+        call_command('import_messages', path, '--new-ids', stdout=StringIO())
+        self.assertEqual(SentMessage.objects.count(), 4)
+        self.assertEqual(SentMessage.objects.filter(uuid='abc').count(), 2)
+
+    def test_import_rejects_ids_already_taken(self):
+        path = os.path.join(self.dir, 'messages.parquet')
+        call_command('export_messages', path, stdout=StringIO())
+        SentMessage.objects.filter(number='1112224444').delete()
+        with self.assertRaises(CommandError):
+            call_command('import_messages', path, stdout=StringIO())
+        self.assertEqual(SentMessage.objects.count(), 1)
+
+        call_command('import_messages', path, '--skip-existing', stdout=StringIO())
+        self.assertEqual(sorted(SentMessage.objects.values_list('number', flat=True)), ['1112223333', '1112224444'])
+
+    def test_rejects_unknown_formats(self):
+        with self.assertRaises(CommandError):
+            call_command('export_messages', os.path.join(self.dir, 'messages.csv'))
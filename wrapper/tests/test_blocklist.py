@@ -0,0 +1,83 @@
+from django.test import SimpleTestCase, TestCase
+
+from wrapper.blocklist import INVALID_NUMBERS, BloomFilter, InvalidNumberCache
+from wrapper.models import InvalidNumber
+
+
+class TestBloomFilter(SimpleTestCase):
+    def test_added_items_are_always_found(self):
+        bloom = BloomFilter(1000)
+        numbers = [f'555{i:07d}' for i in range(1000)]
+        for number in numbers:
+            bloom.add(number)
+        self.assertTrue(all(number in bloom for number in numbers))
+
+    def test_false_positive_rate_is_near_target(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f'555{i:07d}')
+        false_positives = sum(f'777{i:07d}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class TestInvalidNumberCache(TestCase):
+    def setUp(self):
+        InvalidNumber(number='2223334444').save()
+
+    def test_contains_confirms_possible_matches_in_the_database(self):
+        cache = InvalidNumberCache(ttl=60)
+        self.assertTrue(cache.contains('2223334444'))
+
+    def test_numbers_never_blocked_need_no_query_once_loaded(self):
+        cache = InvalidNumberCache(ttl=60)
+        cache.refresh()
+        with self.assertNumQueries(0):
+            self.assertFalse(cache.contains('9994440101'))
+
+    def test_stale_filter_entries_are_ruled_out_by_the_database(self):
+        cache = InvalidNumberCache(ttl=60)
+        cache.refresh()
+        InvalidNumber.objects.all().delete()
+        self.assertFalse(cache.contains('2223334444'))
+
+    def test_refresh_loads_rows_saved_elsewhere_after_ttl(self):
+        cache = InvalidNumberCache(ttl=0)
+        cache.refresh()
+        InvalidNumber.objects.bulk_create([InvalidNumber(number='6667778888')])
+        self.assertTrue(cache.contains('6667778888'))
+
+    def test_refresh_overlap_loads_rows_committed_out_of_id_order(self):
+        latest = InvalidNumber.objects.order_by('-id').first().id
+        InvalidNumber(id=latest + 10, number='6667778888').save()
+        cache = InvalidNumberCache(ttl=0, overlap=20)
+        cache.refresh()
+        InvalidNumber(id=latest + 5, number='6667778889').save()
+        self.assertTrue(cache.contains('6667778889'))
+
+    def test_periodic_rebuild_loads_rows_committed_long_out_of_order(self):
+        latest = InvalidNumber.objects.order_by('-id').first().id
+        InvalidNumber(id=latest + 10, number='6667778888').save()
+        cache = InvalidNumberCache(ttl=0, overlap=0, rebuild_every=3)
+        cache.refresh()
+        InvalidNumber(id=latest + 5, number='6667778889').save()
+        self.assertFalse(cache.might_contain('6667778889'))
+        self.assertTrue(cache.might_contain('6667778889'))
+
+    def test_saving_an_invalid_number_adds_it_to_the_shared_cache(self):
+        INVALID_NUMBERS.refresh()
+        InvalidNumber(number='6667778888').save()
+        with self.assertNumQueries(1):
+            self.assertTrue(INVALID_NUMBERS.contains('6667778888'))
+
+    def test_filter_returns_invalid_subset(self):
+        cache = InvalidNumberCache(ttl=60)
+        self.assertEqual(cache.filter(['2223334444', '9994440101']), {'2223334444'})
+
+    def test_filter_grows_past_its_capacity(self):
+        InvalidNumber.objects.bulk_create([InvalidNumber(number=f'555{i:07d}') for i in range(10)])
+        cache = InvalidNumberCache(ttl=60, capacity=4)
+        self.assertTrue(cache.contains('5550000009'))
+        self.assertEqual(cache.capacity, 22)
+
+    def tearDown(self):
+        InvalidNumber.objects.all().delete()
@@ -0,0 +1,148 @@
+from datetime import timedelta
+import json
+import os
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from wrapper.dispatch import Dispatcher, forward
+from wrapper.models import SentMessage, Server
+from wrapper.registry import REGISTRY
+from wrapper.views import SendView
+
+
+class MockRequest:
+    def __init__(self, body=None):
+        self.body = body
+
+class MockResponse:
+    def __init__(self, message_id="some_id", status_code=200):
+        self.message_id = message_id
+        self.status_code = status_code
+
+    def json(self):
+        return {"message_id": self.message_id, "message": "nope"}
+
+
+class TestForward(TestCase):
+    def test_forward_returns_first_successful_response(self):
+        balancer = mock.Mock()
+        balancer.request.side_effect = [MockResponse(status_code=500), MockResponse()]
+        response = forward(balancer, {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(balancer.request.call_count, 2)
+
+    def test_forward_returns_none_once_retries_are_exhausted(self):
+        balancer = mock.Mock()
+        balancer.request.side_effect = Exception('down')
+        self.assertIsNone(forward(balancer, {}))
+        self.assertEqual(balancer.request.call_count, 2)
+
+
+@mock.patch.dict(os.environ, {"SEND_MODE": "queue"})
+class TestQueueMode(TestCase):
+    def setUp(self):
+        REGISTRY.invalidate()
+        self.server = Server(url="server1", weight=1)
+        self.server.save()
+
+    @mock.patch("wrapper.views.LB")
+    def test_send_queues_message_and_returns_202(self, m_LB):
+        data = json.dumps({
+            "number": "9994440101",
+            "message": "Vote."
+        })
+        response = SendView().post(MockRequest(body=data))
+        self.assertEqual(response.status_code, 202)
+        m_LB.request.assert_not_called()
+        sm = SentMessage.objects.get()
+        self.assertEqual(sm.status, "queued")
+        self.assertEqual(sm.message, "Vote.")
+
+    def test_dispatcher_forwards_queued_messages(self):
+        SentMessage(number="9994440101", message="Vote.", status="queued", start_time=timezone.now()).save()
+        SentMessage(number="9994440102", message="Early.", status="queued", start_time=timezone.now()).save()
+        balancer = mock.Mock(targeted_url="server1")
+        balancer.request.side_effect = [MockResponse("a"), MockResponse("b")]
+
+        sent = Dispatcher(balancer, workers=1).run_once()
+
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(balancer.request.call_args_list[0][0][0]["message"], "Vote.")
+        for sm, uuid in zip(SentMessage.objects.order_by('id'), ["a", "b"]):
+            self.assertEqual(sm.status, "pending")
+            self.assertEqual(sm.uuid, uuid)
+            self.assertEqual(sm.server, self.server)
+
+    def test_dispatcher_marks_messages_failed_after_retries(self):
+        SentMessage(number="9994440101", message="Vote.", status="queued", start_time=timezone.now()).save()
+        balancer = mock.Mock()
+        balancer.request.side_effect = Exception('down')
+
+        Dispatcher(balancer, workers=1).run_once()
+
+        self.assertEqual(SentMessage.objects.get().status, "failed_to_send")
+
+    def test_dispatcher_resends_requeued_messages_under_the_same_key(self):
+        SentMessage(number="9994440101", message="Vote.", status="queued", start_time=timezone.now()).save()
+        balancer = mock.Mock(targeted_url="server1")
+        balancer.request.side_effect = [MockResponse("a")]
+        dispatcher = Dispatcher(balancer, workers=1)
+        sm = dispatcher.claim()[0]
+
+        with mock.patch("wrapper.dispatch.forward", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                dispatcher.send(sm)
+        key = SentMessage.objects.get().uuid
+        self.assertIsNotNone(key)
+
+        # The lease has to run out before the message can be requeued.
+        self.assertEqual(dispatcher.requeue_dispatching(), 0)
+        dispatcher.requeue_dispatching(now=timezone.now() + timedelta(seconds=dispatcher.lease + 1))
+        dispatcher.run_once()
+        headers = balancer.request.call_args[1]["headers"]
+        self.assertEqual(headers["Idempotency-Key"], key)
+        self.assertEqual(SentMessage.objects.get().uuid, "a")
+
+    def test_dispatcher_only_claims_queued_messages(self):
+        SentMessage(number="9994440101", status="pending", start_time=timezone.now()).save()
+        SentMessage(number="9994440102", message="Vote.", status="dispatching", start_time=timezone.now()).save()
+        dispatcher = Dispatcher(mock.Mock(), workers=1)
+        self.assertEqual(dispatcher.claim(), [])
+        self.assertEqual(dispatcher.requeue_dispatching(), 1)
+        self.assertEqual([sm.number for sm in dispatcher.claim()], ["9994440102"])
+
+    def test_requeue_leaves_messages_other_dispatchers_are_sending(self):
+        SentMessage(number="9994440101", message="Vote.", status="queued", start_time=timezone.now()).save()
+        Dispatcher(mock.Mock(), workers=1).claim()
+        restarted = Dispatcher(mock.Mock(), workers=1)
+        self.assertEqual(restarted.requeue_dispatching(), 0)
+        self.assertEqual(SentMessage.objects.get().status, "dispatching")
+
+    def test_dispatcher_skips_messages_whose_lease_was_lost(self):
+        SentMessage(number="9994440101", message="Vote.", status="queued", start_time=timezone.now()).save()
+        balancer = mock.Mock()
+        dispatcher = Dispatcher(balancer, workers=1)
+        sm = dispatcher.claim()[0]
+        SentMessage.objects.update(claimed_by="another dispatcher")
+        dispatcher.send(sm)
+        balancer.request.assert_not_called()
+
+    def test_dispatcher_marks_message_failed_when_sending_raises(self):
+        SentMessage(number="9994440101", message="Vote.", status="queued", start_time=timezone.now()).save()
+        SentMessage(number="9994440102", message="Early.", status="queued", start_time=timezone.now()).save()
+        balancer = mock.Mock(targeted_url="server1")
+        broken = mock.Mock(status_code=200)
+        broken.json.return_value = {}
+        balancer.request.side_effect = [broken, MockResponse("b")]
+
+        Dispatcher(balancer, workers=1).run_once()
+
+        self.assertEqual(
+            list(SentMessage.objects.order_by('id').values_list('status', flat=True)), ["failed_to_send", "pending"]
+        )
+
+    def tearDown(self):
+        Server.objects.all().delete()
+        SentMessage.objects.all().delete()
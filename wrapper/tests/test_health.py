@@ -0,0 +1,108 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from wrapper.health import CircuitBreaker, HealthProber, HealthRegistry
+from wrapper.registry import ServerEntry, ServerSnapshot
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(window=10, error_threshold=0.5, min_requests=4, open_seconds=30, clock=self.clock)
+
+    def test_opens_once_error_rate_reaches_threshold(self):
+        for _ in range(2):
+            self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.available())
+        self.assertFalse(self.breaker.acquire())
+
+    def test_needs_min_requests_before_opening(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_after_cool_down_lets_one_trial_through(self):
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.clock.now = 30
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.acquire())
+        self.assertFalse(self.breaker.available())
+        self.assertFalse(self.breaker.acquire())
+
+    def test_half_open_closes_on_success_and_reopens_on_failure(self):
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.clock.now = 30
+        self.breaker.acquire()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.clock.now = 60
+        self.breaker.acquire()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.available())
+
+
+    def test_late_failures_do_not_push_back_the_cool_down(self):
+        on_change = mock.MagicMock()
+        self.breaker.on_change = on_change
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.clock.now = 20
+        self.breaker.record_failure()
+        self.clock.now = 30
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        on_change.assert_called_once_with(CircuitBreaker.OPEN)
+
+
+class TestHealthRegistry(TestCase):
+    def test_record_counts_server_errors_throttling_and_exceptions(self):
+        health = HealthRegistry()
+        for outcome in [{'status_code': 500}, {'status_code': 429}, {'error': True}, {'status_code': 400}, {'status_code': 200}]:
+            health.record('server1', **outcome)
+        self.assertEqual(list(health.breaker('server1')._outcomes), [False, False, False, True, True])
+
+    def test_unavailable_lists_servers_with_open_breakers(self):
+        health = HealthRegistry()
+        for _ in range(5):
+            health.record('server2', error=True)
+        servers = ServerSnapshot([ServerEntry(1, 'server1', 1), ServerEntry(2, 'server2', 1)])
+        self.assertEqual(health.unavailable(servers), {2})
+        self.assertEqual([s.url for s in servers.without({2})], ['server1'])
+
+
+class TestHealthProber(TestCase):
+    def setUp(self):
+        self.health = HealthRegistry()
+        self.registry = mock.Mock()
+        self.registry.snapshot.return_value = ServerSnapshot([ServerEntry(1, 'server1', 1)])
+        self.sessions = mock.Mock()
+        self.prober = HealthProber(self.registry, self.health, self.sessions, interval=1)
+
+    def test_failed_checks_take_a_server_out_of_rotation(self):
+        self.sessions.session.return_value.head.side_effect = Exception('Connection refused.')
+        for _ in range(5):
+            self.assertEqual(self.prober.probe_all(), {'server1': False})
+        self.assertEqual(self.health.breaker('server1').state, CircuitBreaker.OPEN)
+
+    def test_passing_check_half_opens_an_open_breaker(self):
+        for _ in range(5):
+            self.health.record('server1', error=True)
+        self.sessions.session.return_value.head.return_value.status_code = 403
+        self.assertEqual(self.prober.probe_all(), {'server1': True})
+        self.assertEqual(self.health.breaker('server1').state, CircuitBreaker.HALF_OPEN)
@@ -0,0 +1,212 @@
+from datetime import timedelta
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from wrapper.blocklist import INVALID_NUMBERS
+from wrapper.ingest import CallbackBuffer, CallbackJournal, LazyCallbackBuffer
+from wrapper.latency import TRACKER
+from wrapper.metrics import DELIVERY_SECONDS
+from wrapper.models import InvalidNumber, SentMessage, Server
+from wrapper.registry import REGISTRY
+from wrapper.views import CallbackView
+
+
+class MockRequest:
+    def __init__(self, body=None):
+        self.body = body
+
+
+class TestCallbackBuffer(TestCase):
+    def setUp(self):
+        TRACKER.reset()
+        self.server = Server(url="server1", weight=1)
+        self.server.save()
+        self.start = timezone.now()
+        for uuid, number in [("1234", "4347672121"), ("5678", "0192019211")]:
+            SentMessage(
+                uuid=uuid,
+                number=number,
+                server=self.server,
+                status="pending",
+                start_time=self.start
+            ).save()
+        self.buffer = CallbackBuffer(batch_size=10, flush_interval=1, autostart=False)
+
+    def test_flush_writes_buffered_callbacks_in_a_batch(self):
+        end = self.start + timedelta(seconds=2)
+        self.buffer.add("1234", "delivered", end_time=end)
+        self.buffer.add("5678", "invalid", end_time=end)
+        self.buffer.add("unknown", "delivered", end_time=end)
+        REGISTRY.invalidate()
+        REGISTRY.snapshot()
+        delivered = DELIVERY_SECONDS.count(server="server1")
+
+        with self.assertNumQueries(5):
+            self.assertEqual(self.buffer.flush(), 3)
+        # Labelled by url, like the provider metrics.
+        self.assertEqual(DELIVERY_SECONDS.count(server="server1"), delivered + 2)
+
+        self.assertEqual(len(self.buffer), 0)
+        sm = SentMessage.objects.get(uuid="1234")
+        self.assertEqual((sm.status, sm.end_time), ("delivered", end))
+        self.assertEqual(SentMessage.objects.get(uuid="5678").status, "invalid")
+        self.assertTrue(InvalidNumber.objects.filter(number="0192019211").exists())
+        self.assertTrue(INVALID_NUMBERS.might_contain("0192019211"))
+        self.assertEqual(TRACKER.estimate(self.server.id), 2000000)
+
+    def test_last_callback_for_a_message_wins(self):
+        self.buffer.add("1234", "sent")
+        self.buffer.add("1234", "delivered")
+        self.buffer.flush()
+        self.assertEqual(SentMessage.objects.get(uuid="1234").status, "delivered")
+
+    def test_failed_flush_keeps_callbacks_buffered(self):
+        self.buffer.add("1234", "delivered")
+        with mock.patch("wrapper.ingest.write_callbacks", side_effect=Exception("db down")):
+            with self.assertRaises(Exception):
+                self.buffer.flush()
+        self.assertEqual(len(self.buffer), 1)
+        self.buffer.flush()
+        self.assertEqual(SentMessage.objects.get(uuid="1234").status, "delivered")
+
+    def test_callback_that_cannot_be_written_is_dead_lettered(self):
+        self.buffer.add(["x"], "delivered")
+        self.buffer.add("1234", "delivered")
+        with self.assertLogs("wrapper.ingest", level="ERROR"):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(SentMessage.objects.get(uuid="1234").status, "delivered")
+        self.buffer.add("5678", "delivered")
+        self.assertEqual(self.buffer.flush(), 1)
+
+    def test_close_flushes_remaining_callbacks(self):
+        self.buffer.add("1234", "delivered")
+        self.buffer.close()
+        self.assertEqual(SentMessage.objects.get(uuid="1234").status, "delivered")
+
+    @mock.patch.dict(os.environ, {"CALLBACK_MODE": "buffered"})
+    def test_callback_view_acknowledges_before_writing(self):
+        with mock.patch("wrapper.views.CALLBACKS", self.buffer):
+            data = json.dumps({"message_id": "1234", "status": "delivered"})
+            with self.assertNumQueries(0):
+                response = CallbackView().post(MockRequest(body=data))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(SentMessage.objects.get(uuid="1234").status, "pending")
+        self.buffer.flush()
+        self.assertEqual(SentMessage.objects.get(uuid="1234").status, "delivered")
+
+    @mock.patch.dict(os.environ, {"CALLBACK_MODE": "buffered"})
+    def test_callback_view_rejects_callbacks_that_cannot_be_written(self):
+        with mock.patch("wrapper.views.CALLBACKS", self.buffer):
+            for body in (["1234"], {"message_id": ["x"], "status": "delivered"}, {"message_id": "1234"},
+                         {"message_id": "1234", "status": "x" * 201}):
+                response = CallbackView().post(MockRequest(body=json.dumps(body)))
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.buffer), 0)
+
+    def tearDown(self):
+        SentMessage.objects.all().delete()
+        Server.objects.all().delete()
+        InvalidNumber.objects.all().delete()
+
+
+class TestCallbackJournal(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_journal_keeps_only_unwritten_callbacks(self):
+        buffer = CallbackBuffer(journal_dir=self.directory, autostart=False)
+        buffer.add("1234", "delivered")
+        with open(buffer.journal.path) as journal:
+            self.assertEqual(json.loads(journal.readline())["message_id"], "1234")
+        with mock.patch("wrapper.ingest.write_callbacks"):
+            buffer.flush()
+        with open(buffer.journal.path) as journal:
+            self.assertEqual(journal.read(), "")
+        buffer.close()
+
+    def test_dead_letters_are_recorded_and_not_replayed(self):
+        buffer = CallbackBuffer(journal_dir=self.directory, autostart=False)
+        buffer.add({"x": 1}, "delivered")
+        with self.assertLogs("wrapper.ingest", level="ERROR"):
+            buffer.flush()
+        with open(os.path.join(self.directory, "dead-letters.ndjson")) as dead_letters:
+            self.assertEqual(json.loads(dead_letters.readline())["callback"]["message_id"], {"x": 1})
+        with open(buffer.journal.path) as journal:
+            self.assertEqual(journal.read(), "")
+        buffer.close()
+
+    def test_callbacks_from_dead_processes_are_replayed(self):
+        orphan = os.path.join(self.directory, "callbacks-999999999.ndjson")
+        with open(orphan, "w") as journal:
+            journal.write(json.dumps({"message_id": "1234", "status": "delivered", "end_time": timezone.now().isoformat()}) + "\n")
+        buffer = CallbackBuffer(journal_dir=self.directory, autostart=False)
+        self.assertEqual(len(buffer), 1)
+        self.assertFalse(os.path.exists(orphan))
+        with open(buffer.journal.path) as journal:
+            self.assertEqual(json.loads(journal.readline())["message_id"], "1234")
+        with mock.patch("wrapper.ingest.write_callbacks"):
+            buffer.close()
+
+    def test_journal_left_under_a_reused_pid_is_replayed(self):
+        for orphan in (f"callbacks-{os.getpid()}.ndjson", f"callbacks-{os.getpid()}-0123456789ab.ndjson"):
+            with open(os.path.join(self.directory, orphan), "w") as journal:
+                journal.write(json.dumps({"message_id": orphan, "status": "delivered", "end_time": timezone.now().isoformat()}) + "\n")
+        buffer = CallbackBuffer(journal_dir=self.directory, autostart=False)
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(buffer.journal.path)])
+        with open(buffer.journal.path) as journal:
+            self.assertEqual(len(journal.readlines()), 2)
+        with mock.patch("wrapper.ingest.write_callbacks"):
+            buffer.close()
+
+    def test_replayed_callbacks_are_flushed_without_waiting_for_new_ones(self):
+        orphan = os.path.join(self.directory, "callbacks-999999999.ndjson")
+        with open(orphan, "w") as journal:
+            journal.write(json.dumps({"message_id": "1234", "status": "delivered", "end_time": timezone.now().isoformat()}) + "\n")
+        with mock.patch("wrapper.ingest.write_callbacks") as m_write:
+            buffer = CallbackBuffer(journal_dir=self.directory, flush_interval=0.01)
+            buffer.close()
+        m_write.assert_called_once()
+        self.assertIsNotNone(buffer._thread)
+
+    def test_buffer_is_built_on_first_callback_and_again_after_fork(self):
+        factory = mock.MagicMock()
+        callbacks = LazyCallbackBuffer(factory=factory)
+        factory.assert_not_called()
+        callbacks.add("1234", "delivered")
+        callbacks.add("5678", "delivered")
+        self.assertEqual(factory.call_count, 1)
+        callbacks._forget()
+        callbacks.add("1234", "delivered")
+        self.assertEqual(factory.call_count, 2)
+
+    def test_inherited_buffer_is_not_closed_by_the_child(self):
+        buffer = CallbackBuffer(journal_dir=self.directory, autostart=False)
+        buffer.add("1234", "delivered")
+        buffer._pid = -1
+        with mock.patch("wrapper.ingest.write_callbacks") as m_write:
+            buffer.close()
+        m_write.assert_not_called()
+        with open(buffer.journal.path) as journal:
+            self.assertEqual(len(journal.readlines()), 1)
+        buffer._pid = os.getpid()
+        with mock.patch("wrapper.ingest.write_callbacks"):
+            buffer.close()
+
+    def test_journals_of_live_processes_are_left_alone(self):
+        live = CallbackJournal(self.directory)
+        live.path = os.path.join(self.directory, f"callbacks-{os.getppid()}.ndjson")
+        with open(live.path, "w") as journal:
+            journal.write('{"message_id": "1"}\n')
+        self.assertEqual(CallbackJournal(self.directory).recover(), [])
+        live.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
@@ -0,0 +1,66 @@
+import random
+
+from django.test import SimpleTestCase
+
+from wrapper.latency import EWMA, LatencyTracker, P2Quantile
+
+
+class TestEWMA(SimpleTestCase):
+    def test_first_observation_sets_value(self):
+        ewma = EWMA(0.5)
+        self.assertEqual(ewma.update(10), 10)
+
+    def test_observations_move_value_by_alpha(self):
+        ewma = EWMA(0.5)
+        ewma.update(10)
+        self.assertEqual(ewma.update(20), 15)
+        self.assertEqual(ewma.update(15), 15)
+
+
+class TestP2Quantile(SimpleTestCase):
+    def test_value_is_none_without_observations(self):
+        self.assertIsNone(P2Quantile(0.95).value)
+
+    def test_value_uses_exact_quantile_until_markers_are_initialised(self):
+        quantile = P2Quantile(0.5)
+        for x in [3, 1, 2]:
+            quantile.update(x)
+        self.assertEqual(quantile.value, 2)
+
+    def test_estimates_p95_of_a_stream(self):
+        rng = random.Random(1234)
+        samples = [rng.expovariate(1 / 1000) for _ in range(20000)]
+        quantile = P2Quantile(0.95)
+        for x in samples:
+            quantile.update(x)
+        exact = sorted(samples)[int(0.95 * len(samples))]
+        self.assertAlmostEqual(quantile.value / exact, 1, delta=0.05)
+
+
+class TestLatencyTracker(SimpleTestCase):
+    def test_observe_ignores_missing_server_and_zero_latency(self):
+        tracker = LatencyTracker(alpha=0.5)
+        tracker.observe(None, 10)
+        tracker.observe(1, 0)
+        self.assertEqual(tracker.estimates(), {})
+
+    def test_estimates_report_mean_and_p95_per_server(self):
+        tracker = LatencyTracker(alpha=0.5)
+        for latency in [10, 20]:
+            tracker.observe(1, latency)
+        tracker.observe(2, 5)
+        self.assertEqual(tracker.estimates('mean'), {1: 15, 2: 5})
+        self.assertEqual(tracker.estimates('p95'), {1: 20, 2: 5})
+
+    def test_seed_marks_servers_known_without_overwriting_observations(self):
+        tracker = LatencyTracker(alpha=0.5)
+        tracker.observe(1, 10)
+        tracker.seed({1: 1000, 2: 30}, [1, 2, 3])
+        self.assertTrue(tracker.tracks(3))
+        self.assertEqual(tracker.estimates(), {1: 10, 2: 30})
+
+    def test_reset_forgets_every_server(self):
+        tracker = LatencyTracker(alpha=0.5)
+        tracker.observe(1, 10)
+        tracker.reset()
+        self.assertFalse(tracker.tracks(1))
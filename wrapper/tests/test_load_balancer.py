@@ -1,15 +1,28 @@
+import asyncio
+import threading
 from datetime import timedelta
 from unittest import mock
 
+from asgiref.sync import async_to_sync
 from django.test import TestCase
 from django.utils import timezone
 
+from wrapper.health import HEALTH, HealthRegistry
+from wrapper.inflight import IN_FLIGHT
+from wrapper.latency import TRACKER
 from wrapper.load_balancer import LoadBalancer
 from wrapper.models import Server, SentMessage
+from wrapper.registry import REGISTRY
+from wrapper.throttle import THROTTLE, Saturated
 
 
 class TestLoadBalancer(TestCase):
     def setUp(self):
+        REGISTRY.invalidate()
+        TRACKER.reset()
+        HEALTH.reset()
+        IN_FLIGHT.reset()
+        THROTTLE.reset()
         start_time = timezone.now()
         s1 = Server(url='server1', weight=0.3)
         s1.save()
@@ -51,9 +64,10 @@ class TestLoadBalancer(TestCase):
 
     @mock.patch('wrapper.load_balancer.LoadBalancer._weighted_random')
     @mock.patch('wrapper.load_balancer.LoadBalancer._rolling_avg')
-    @mock.patch('wrapper.load_balancer.requests.post')
-    def test_request_uses_selected_strategy(self, m_request, m_avg, m_rand):
+    @mock.patch('wrapper.load_balancer.SESSIONS')
+    def test_request_uses_selected_strategy(self, m_sessions, m_avg, m_rand):
         #Assert we have called the LB's default strategy
+        m_sessions.post.return_value.status_code = 200
         lb = LoadBalancer()
         lb.targeted_url = 'server1'
         lb.request('some_data')
@@ -67,7 +81,32 @@ class TestLoadBalancer(TestCase):
 
         #Assert our requests were made to the targeted_url each time
         expected = [mock.call('server1', headers={}, json='some_data'), mock.call('server2', headers={}, json='some_other_data')]
-        self.assertEqual(m_request.call_args_list, expected)
+        self.assertEqual(m_sessions.post.call_args_list, expected)
+
+    def test_arequest_keeps_each_tasks_target_separate(self):
+        lb = LoadBalancer(strategy='round_robin')
+        lb.warm()
+
+        class Sessions:
+            async def post(self, url, headers=None, json=None):
+                await asyncio.sleep(0)
+                return mock.Mock(url=url, status_code=200)
+
+        lb.async_sessions = Sessions()
+
+        async def send():
+            response = await lb.arequest('some_data')
+            return response.url, lb.targeted_url, lb.targeted_server.url
+
+        async def send_all():
+            return await asyncio.gather(send(), send(), send())
+
+        with self.assertNumQueries(0):
+            results = async_to_sync(send_all)()
+        self.assertEqual(sorted(r[0] for r in results), ['server1', 'server2', 'server3'])
+        for posted_url, targeted_url, server_url in results:
+            self.assertEqual(posted_url, targeted_url)
+            self.assertEqual(posted_url, server_url)
 
     def test__weighted_random_selects_random_target_from_list(self):
         lb = LoadBalancer()
@@ -75,9 +114,48 @@ class TestLoadBalancer(TestCase):
         self.assertTrue(lb.targeted_url in ['server1', 'server2', 'server3'])
 
     def test__rolling_avg_selects_target_with_least_latency(self):
+        lb = LoadBalancer()
+        REGISTRY.snapshot()
+        # Seeding reads the latency rollups, then the messages since them.
+        with self.assertNumQueries(2):
+            lb._rolling_avg()
+        self.assertEqual(lb.targeted_url, 'server1')
+
+    def test__rolling_avg_reads_tracked_latency_once_seeded(self):
         lb = LoadBalancer()
         lb._rolling_avg()
         self.assertEqual(lb.targeted_url, 'server1')
+        TRACKER.observe(self.servers[0].id, 100000000)
+        with self.assertNumQueries(0):
+            lb._rolling_avg()
+        self.assertEqual(lb.targeted_url, 'server2')
+
+    def test__rolling_avg_can_rank_on_p95(self):
+        for latency in [10, 10, 10, 10, 400]:
+            TRACKER.observe(self.servers[0].id, latency)
+        for latency in [100, 100, 100, 100, 100]:
+            TRACKER.observe(self.servers[1].id, latency)
+        TRACKER.observe(self.servers[2].id, 5000)
+        lb = LoadBalancer()
+        lb._rolling_avg()
+        self.assertEqual(lb.targeted_url, 'server1')
+        lb.latency_metric = 'p95'
+        lb._rolling_avg()
+        self.assertEqual(lb.targeted_url, 'server2')
+
+    def test__rolling_avg_ranks_by_latency_rather_than_table_order(self):
+        SentMessage.objects.all().delete()
+        start_time = timezone.now()
+        for server, seconds in zip(self.servers, [50, 20, 5]):
+            SentMessage(
+                number='1112226666',
+                server=server,
+                start_time=start_time,
+                end_time=start_time + timedelta(seconds=seconds)
+            ).save()
+        lb = LoadBalancer()
+        lb._rolling_avg()
+        self.assertEqual(lb.targeted_url, 'server3')
 
     def test__round_robin_selects_next_in_target_list(self):
         lb = LoadBalancer()
@@ -90,6 +168,185 @@ class TestLoadBalancer(TestCase):
         lb._round_robin()
         self.assertEqual(lb.targeted_url, 'server1')
 
+    def test__round_robin_reads_servers_from_registry_snapshot(self):
+        lb = LoadBalancer()
+        lb._round_robin()
+        with self.assertNumQueries(0):
+            lb._round_robin()
+            lb._round_robin()
+        self.assertEqual(lb.targeted_url, 'server3')
+
+    def test__round_robin_is_even_across_threads(self):
+        lb = LoadBalancer(strategy='round_robin')
+        lb.warm()
+        picks = []
+
+        def pick():
+            for _ in range(300):
+                lb._round_robin()
+                picks.append(lb.targeted_url)
+
+        threads = [threading.Thread(target=pick) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({url: picks.count(url) for url in set(picks)}, {'server1': 800, 'server2': 800, 'server3': 800})
+
+    def test__weighted_round_robin_follows_smooth_sequence(self):
+        lb = LoadBalancer(strategy='weighted_round_robin')
+        picks = []
+        for _ in range(20):
+            lb._weighted_round_robin()
+            picks.append(lb.targeted_url)
+        self.assertEqual(picks[:10], ['server3', 'server1', 'server2'] * 3 + ['server3'])
+        self.assertEqual(picks[10:], picks[:10])
+
+    @mock.patch('wrapper.load_balancer.rotation')
+    def test_rotation_can_come_from_the_database(self, m_rotation):
+        m_rotation.return_value.next.side_effect = [7, 8]
+        lb = LoadBalancer(strategy='round_robin')
+        lb._round_robin()
+        self.assertEqual(lb.targeted_url, 'server2')
+        lb._round_robin()
+        self.assertEqual(lb.targeted_url, 'server3')
+
+    def test_choose_routes_around_servers_at_their_limits(self):
+        Server.objects.filter(url='server1').update(rate_limit=1)
+        Server.objects.filter(url='server2').update(max_concurrency=1)
+        REGISTRY.invalidate()
+        lb = LoadBalancer(strategy='round_robin')
+
+        picks = [lb.choose().url for _ in range(5)]
+        self.assertEqual({url: picks.count(url) for url in picks}, {'server1': 1, 'server2': 1, 'server3': 3})
+
+        s3 = self.servers[2].id
+        with self.assertRaises(Saturated):
+            lb.choose(exclude={s3})
+        lb.release(lb.targets.get('server2'))
+        self.assertEqual(lb.choose(exclude={s3}).url, 'server2')
+
+    def test_release_gives_back_the_token_and_half_open_probe(self):
+        Server.objects.update(rate_limit=1)
+        REGISTRY.invalidate()
+        health = HealthRegistry()
+        lb = LoadBalancer(strategy='round_robin', health=health)
+        breaker = health.breaker('server1')
+        for _ in range(5):
+            breaker.record_failure()
+        breaker.half_open()
+
+        server = lb.choose(exclude={self.servers[1].id, self.servers[2].id})
+        self.assertEqual(server.url, 'server1')
+        self.assertFalse(breaker.available())
+        lb.release(server)
+
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.available())
+        self.assertEqual(lb.choose(exclude={self.servers[1].id, self.servers[2].id}).url, 'server1')
+
+    def test_choose_raises_saturated_when_every_server_is_at_its_limits(self):
+        Server.objects.update(max_concurrency=1)
+        REGISTRY.invalidate()
+        lb = LoadBalancer(strategy='least_outstanding')
+        self.assertEqual({lb.choose().url for _ in range(3)}, {'server1', 'server2', 'server3'})
+        with self.assertRaises(Saturated) as raised:
+            lb.choose()
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    def test_arequest_waits_for_a_server_to_have_room(self):
+        Server.objects.update(rate_limit=20)
+        REGISTRY.invalidate()
+        lb = LoadBalancer(strategy='round_robin')
+        lb.warm()
+        # Each choice spends a token, which release() would refund.
+        for _ in range(60):
+            lb.in_flight.release(lb.choose().url)
+
+        class Sessions:
+            async def post(self, url, headers=None, json=None):
+                return mock.Mock(url=url, status_code=200)
+
+        lb.async_sessions = Sessions()
+        response = async_to_sync(lb.arequest)('some_data')
+        self.assertEqual(response.status_code, 200)
+
+        lb.max_wait = 0
+        for _ in range(60):
+            try:
+                lb.in_flight.release(lb.choose().url)
+            except Saturated:
+                break
+        with self.assertRaises(Saturated):
+            async_to_sync(lb.arequest)('some_data')
+
+    def test_strategies_skip_servers_with_an_open_breaker(self):
+        for url in ['server1', 'server3']:
+            for _ in range(5):
+                HEALTH.breaker(url).record_failure()
+        for strategy in LoadBalancer.strategies:
+            lb = LoadBalancer(strategy=strategy)
+            for _ in range(3):
+                lb._choose()
+                self.assertEqual(lb.targeted_url, 'server2')
+
+    def test_choose_falls_back_to_every_server_when_all_breakers_are_open(self):
+        for server in self.servers:
+            for _ in range(5):
+                HEALTH.breaker(server.url).record_failure()
+        lb = LoadBalancer(strategy='round_robin')
+        lb._choose()
+        self.assertEqual(lb.targeted_url, 'server1')
+
+    @mock.patch('wrapper.load_balancer.SESSIONS')
+    def test_request_failures_open_the_targets_breaker(self, m_sessions):
+        m_sessions.post.return_value.status_code = 503
+        lb = LoadBalancer(strategy='round_robin')
+        for _ in range(15):
+            lb.request('some_data')
+        self.assertEqual(HEALTH.states(), {'server1': 'open', 'server2': 'open', 'server3': 'open'})
+
+        m_sessions.post.side_effect = Exception('Read timed out.')
+        HEALTH.reset()
+        for _ in range(15):
+            with self.assertRaises(Exception):
+                lb.request('some_data')
+        self.assertEqual(set(HEALTH.states().values()), {'open'})
+
+    def test__least_outstanding_selects_server_with_fewest_requests_in_flight(self):
+        for url, count in [('server1', 2), ('server2', 1), ('server3', 3)]:
+            for _ in range(count):
+                IN_FLIGHT.acquire(url)
+        lb = LoadBalancer(strategy='least_outstanding')
+        lb._least_outstanding()
+        self.assertEqual(lb.targeted_url, 'server2')
+
+    def test__p2c_weighs_latency_by_requests_in_flight(self):
+        TRACKER.seed({self.servers[0].id: 1000, self.servers[1].id: 3000}, [s.id for s in self.servers])
+        picks = iter([0.0, 0.0])  # samples server1 and server2
+        lb = LoadBalancer(strategy='p2c', rand=lambda: next(picks))
+        lb._p2c()
+        self.assertEqual(lb.targeted_url, 'server1')
+
+        for _ in range(3):
+            IN_FLIGHT.acquire('server1')
+        picks = iter([0.0, 0.0])
+        lb._p2c()
+        self.assertEqual(lb.targeted_url, 'server2')
+
+    @mock.patch('wrapper.load_balancer.SESSIONS')
+    def test_request_counts_requests_in_flight(self, m_sessions):
+        seen = []
+        def post(url, headers=None, json=None):
+            seen.append(IN_FLIGHT.get(url))
+            raise Exception('Read timed out.')
+        m_sessions.post.side_effect = post
+        lb = LoadBalancer(strategy='round_robin')
+        with self.assertRaises(Exception):
+            lb.request('some_data')
+        self.assertEqual(seen, [1])
+        self.assertEqual(IN_FLIGHT.counts(), {})
+
     def tearDown(self):
         for s in self.servers:
             s.delete()
@@ -0,0 +1,63 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+
+from wrapper.loadtest import LoadGenerator, LoadResult
+from wrapper.stubs import StubProvider
+
+
+class TestStubProvider(SimpleTestCase):
+    def test_error_rate_answers_500(self):
+        stub = StubProvider(latency=0, error_rate=1)
+        status, body = stub.respond({})
+        self.assertEqual(status, 500)
+        self.assertEqual(stub.errors, 1)
+
+    def test_latency_distributions_average_to_the_mean(self):
+        for distribution in ['exponential', 'lognormal']:
+            stub = StubProvider(latency=0.1, distribution=distribution, seed=1)
+            samples = [stub._sample_latency() for _ in range(5000)]
+            self.assertAlmostEqual(sum(samples) / len(samples), 0.1, delta=0.01)
+
+    def test_unknown_distribution_is_rejected(self):
+        with self.assertRaises(ValueError):
+            StubProvider(distribution='uniform')
+
+    def test_sends_delivery_callbacks(self):
+        ingest = StubProvider(latency=0).start()
+        provider = StubProvider(latency=0, callback_delay=0.01, invalid_rate=1, seed=1).start()
+        try:
+            status, body = provider.respond({'callback_url': ingest.url})
+            self.assertEqual(status, 200)
+            self.assertTrue(provider.drain(timeout=5))
+        finally:
+            provider.stop()
+            ingest.stop()
+        self.assertEqual(provider.callbacks_sent, 1)
+        self.assertEqual(provider.callbacks_failed, 0)
+        self.assertEqual(ingest.received, 1)
+
+
+class TestLoadGenerator(SimpleTestCase):
+    def test_times_every_request_and_counts_failures(self):
+        stub = StubProvider(latency=0, error_rate=0.5, seed=3).start()
+        try:
+            result = LoadGenerator(stub.url, total=40, concurrency=4).run()
+        finally:
+            stub.stop()
+        self.assertEqual(result.requests, 40)
+        self.assertEqual(result.failures, stub.errors)
+        self.assertGreater(result.failures, 0)
+
+    def test_percentiles(self):
+        result = LoadResult([i / 100 for i in range(1, 101)], failures=0, elapsed=2)
+        self.assertEqual(result.throughput, 50)
+        self.assertAlmostEqual(result.percentile(50), 0.505)
+        self.assertAlmostEqual(result.percentile(99), 0.9901)
+        self.assertEqual(LoadResult([], 0, 0).percentile(99), 0)
+
+
+class TestLoadTestCommand(SimpleTestCase):
+    def test_refuses_to_replace_servers_without_confirmation(self):
+        with self.assertRaises(CommandError):
+            call_command('loadtest')
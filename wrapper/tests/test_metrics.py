@@ -0,0 +1,80 @@
+import threading
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from wrapper.inflight import IN_FLIGHT
+from wrapper.metrics import DB_QUERY_SECONDS, Counter, Histogram, MetricsRegistry, instrument_connection
+from wrapper.models import Server
+from wrapper.views import MetricsView
+
+
+class TestMetrics(SimpleTestCase):
+    def test_counter_sums_every_threads_shard(self):
+        counter = Counter('sends', 'Sends.', ['server'])
+
+        def send():
+            for _ in range(1000):
+                counter.inc(server='server1')
+
+        threads = [threading.Thread(target=send) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(5, server='server2')
+        self.assertEqual(counter.value(server='server1'), 4000)
+        self.assertEqual(counter.value(server='server2'), 5)
+
+    def test_shards_of_finished_threads_are_folded_in(self):
+        counter = Counter('sends', 'Sends.', ['server'])
+        histogram = Histogram('latency_seconds', 'Latency.', ['server'], buckets=(1,))
+
+        def record():
+            counter.inc(server='server1')
+            histogram.observe(0.5, server='server1')
+
+        for _ in range(50):
+            thread = threading.Thread(target=record)
+            thread.start()
+            thread.join()
+        self.assertEqual(counter.value(server='server1'), 50)
+        self.assertEqual(histogram.count(server='server1'), 50)
+        self.assertEqual((len(counter._shards), len(histogram._shards)), (0, 0))
+        counter.inc(server='server1')
+        self.assertEqual(counter.value(server='server1'), 51)
+        counter.reset()
+        self.assertEqual(counter.value(server='server1'), 0)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        registry = MetricsRegistry()
+        histogram = registry.register(Histogram('latency_seconds', 'Latency.', ['server'], buckets=(0.1, 1)))
+        for value in [0.05, 0.1, 0.5, 3]:
+            histogram.observe(value, server='a"b')
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{server="a\\"b",le="0.1"} 2',
+            'latency_seconds_bucket{server="a\\"b",le="1"} 3',
+            'latency_seconds_bucket{server="a\\"b",le="+Inf"} 4',
+            'latency_seconds_sum{server="a\\"b"} 3.65',
+            'latency_seconds_count{server="a\\"b"} 4',
+        ]) + '\n')
+
+
+class TestMetricsView(TestCase):
+    def test_exports_query_times_and_in_flight_gauge(self):
+        instrument_connection(connection)
+        instrument_connection(connection)
+        before = DB_QUERY_SECONDS.count()
+        list(Server.objects.all())
+        self.assertEqual(DB_QUERY_SECONDS.count(), before + 1)
+
+        IN_FLIGHT.acquire('server1')
+        try:
+            body = MetricsView().get(None).content.decode()
+        finally:
+            IN_FLIGHT.release('server1')
+        self.assertIn('text_api_in_flight_requests{server="server1"} 1', body)
+        self.assertIn('# TYPE text_api_db_query_seconds histogram', body)
+        self.assertIn('# TYPE text_api_send_retries counter', body)
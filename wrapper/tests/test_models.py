@@ -4,7 +4,7 @@ from unittest import mock
 from django.test import TestCase
 from django.utils import timezone
 
-from wrapper.models import Server, SentMessage
+from wrapper.models import LatencyRollup, Server, SentMessage
 
 
 class TestServer(TestCase):
@@ -48,12 +48,84 @@ class TestServer(TestCase):
         self.assertEqual(self.s1.rolling_latency(limit=5, window=1), 3)
         self.assertEqual(self.s1.rolling_latency(limit=5, window=10), 4)
 
+    def test_rolling_latencies_averages_every_server_in_two_queries(self):
+        start_time = timezone.now()
+        SentMessage(
+            number='1112225555',
+            server=self.s2,
+            start_time=start_time,
+            end_time=start_time + timedelta(microseconds=10)
+        ).save()
+        with self.assertNumQueries(2):
+            latencies = Server.objects.rolling_latencies(window=5)
+        self.assertEqual(latencies, {self.s1.id: 3, self.s2.id: 10})
+
+    def test_rolling_latencies_restricts_by_window_and_skips_pending(self):
+        SentMessage(
+            number='1112225555',
+            server=self.s2,
+            start_time=timezone.now(),
+        ).save()
+        self.assertEqual(Server.objects.rolling_latencies(window=10), {self.s1.id: 4})
+
+    def test_rolling_latencies_reads_rollups_and_the_messages_after_them(self):
+        now = timezone.now()
+        minute = now.replace(second=0, microsecond=0) - timedelta(minutes=3)
+        LatencyRollup.objects.create(
+            server=self.s2, minute=minute, status='delivered', messages=2, completed=2, latency_total=40,
+        )
+        # Rolled up already, so not counted twice.
+        SentMessage(
+            number='1112225555', server=self.s2, start_time=minute, end_time=minute + timedelta(microseconds=20),
+        ).save()
+        SentMessage(
+            number='1112226666', server=self.s2, start_time=now, end_time=now + timedelta(microseconds=50),
+        ).save()
+        self.assertEqual(Server.objects.rolling_latencies(window=5), {self.s1.id: 3, self.s2.id: 30})
+
     def tearDown(self):
         self.s1.delete()
         self.s2.delete()
 
 
 
+class TestLatencyRollup(TestCase):
+    def setUp(self):
+        self.server = Server.objects.create(url='server1', weight=1)
+        self.minute = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=2)
+        for seconds, latency, status in [(5, 10, 'delivered'), (20, 30, 'delivered'), (40, None, 'pending')]:
+            start = self.minute + timedelta(seconds=seconds)
+            SentMessage(
+                number='1112223333',
+                server=self.server,
+                status=status,
+                start_time=start,
+                end_time=start + timedelta(microseconds=latency) if latency else None,
+            ).save()
+
+    def test_roll_up_counts_and_sums_latency_per_minute_and_status(self):
+        until = self.minute + timedelta(minutes=1)
+        self.assertEqual(LatencyRollup.objects.roll_up(self.minute, until), 2)
+        delivered = LatencyRollup.objects.get(status='delivered')
+        self.assertEqual((delivered.messages, delivered.completed, delivered.latency_total), (2, 2, 40))
+        self.assertEqual(delivered.minute, self.minute)
+        pending = LatencyRollup.objects.get(status='pending')
+        self.assertEqual((pending.messages, pending.completed, pending.latency_total), (1, 0, 0))
+        self.assertEqual(
+            LatencyRollup.objects.status_counts(self.minute),
+            {self.server.id: {'delivered': 2, 'pending': 1}},
+        )
+
+    def test_roll_up_replaces_earlier_rollups_of_the_same_minutes(self):
+        until = self.minute + timedelta(minutes=1)
+        LatencyRollup.objects.roll_up(self.minute, until)
+        SentMessage.objects.filter(status='pending').update(
+            status='delivered', end_time=self.minute + timedelta(seconds=41),
+        )
+        LatencyRollup.objects.roll_up(self.minute, until)
+        self.assertEqual(LatencyRollup.objects.get().completed, 3)
+
+
 class TestSentMessage(TestCase):
     def test_latency_returns_microseconds_between_start_and_end(self):
         start = timezone.now()
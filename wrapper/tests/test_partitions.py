@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from wrapper.partitions import parse_bound
+
+
+class TestPartitions(TestCase):
+    def test_parse_bound(self):
+        self.assertEqual(
+            parse_bound("FOR VALUES FROM ('2026-10-18 00:00:00+00') TO ('2026-10-19 00:00:00+00')"),
+            (datetime(2026, 10, 18, tzinfo=timezone.utc), datetime(2026, 10, 19, tzinfo=timezone.utc)),
+        )
+        self.assertEqual(
+            parse_bound("FOR VALUES FROM (MINVALUE) TO ('2026-10-18 00:00:00+00')"),
+            (None, datetime(2026, 10, 18, tzinfo=timezone.utc)),
+        )
+        self.assertEqual(parse_bound('DEFAULT'), (None, None))
+
+    def test_partition_command_needs_postgres(self):
+        with self.assertRaises(CommandError):
+            call_command('partition_messages')
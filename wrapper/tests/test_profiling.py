@@ -0,0 +1,107 @@
+from io import StringIO
+import json
+import os
+import tempfile
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from wrapper.profiling import _current, phase, profiling_middleware, read_profiles, summarize
+
+
+@override_settings(PROFILING_HEADER=True, PROFILING_SAMPLE_RATE=0)
+class TestProfilingMiddleware(TestCase):
+    def setUp(self):
+        self.log = os.path.join(tempfile.mkdtemp(), 'profiles.jsonl')
+
+    @mock.patch.dict(os.environ, {'SEND_MODE': 'queue'})
+    def test_profiled_request_gets_server_timing_and_is_logged(self):
+        body = json.dumps({'number': '5555555555', 'message': 'hi'})
+        with self.settings(PROFILING_LOG=self.log):
+            response = self.client.post('/send/', body, content_type='application/json', HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 202)
+        timing = response['Server-Timing']
+        self.assertIn('parse;dur=', timing)
+        self.assertIn('invalid_number;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        [profile] = read_profiles(self.log)
+        self.assertEqual(profile['path'], '/send/')
+        # The queued message is saved outside of any phase.
+        self.assertGreaterEqual(profile['queries'], 1)
+        self.assertEqual(profile['phases']['parse']['queries'], 0)
+
+    def test_async_profile_leaves_out_query_counts(self):
+        async def view(request):
+            with phase('route'):
+                pass
+            return HttpResponse()
+
+        request = RequestFactory().get('/send_async/', HTTP_X_PROFILE='1')
+        with self.settings(PROFILING_LOG=self.log):
+            response = async_to_sync(profiling_middleware(view))(request)
+        self.assertIn('route;dur=', response['Server-Timing'])
+        self.assertNotIn('db;', response['Server-Timing'])
+        self.assertNotIn('queries', response['Server-Timing'])
+        [profile] = read_profiles(self.log)
+        self.assertIsNone(profile['queries'])
+        self.assertIsNone(summarize([profile])['/send_async/']['phases']['route']['queries'])
+
+    def test_unprofiled_request_has_no_server_timing(self):
+        with self.settings(PROFILING_LOG=self.log):
+            response = self.client.get('/provider_health/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertFalse(os.path.exists(self.log))
+
+
+class TestProfileReport(SimpleTestCase):
+    profiles = [
+        {'path': '/send/', 'duration': 0.010, 'queries': 2,
+         'phases': {'parse': {'seconds': 0.001, 'queries': 0}, 'save': {'seconds': 0.006, 'queries': 2}}},
+        {'path': '/send/', 'duration': 0.030, 'queries': 4,
+         'phases': {'parse': {'seconds': 0.001, 'queries': 0}, 'save': {'seconds': 0.014, 'queries': 4}}},
+        {'path': '/ingest/', 'duration': 0.005, 'queries': 1, 'phases': {}},
+        {'path': '/send_async/', 'duration': 0.020, 'queries': None, 'query_seconds': None,
+         'phases': {'route': {'seconds': 0.001, 'queries': None}}},
+    ]
+
+    def test_phase_is_a_no_op_outside_a_profiled_request(self):
+        self.assertIsNone(_current.get())
+        with phase('parse'):
+            pass
+        self.assertIsNone(_current.get())
+
+    def test_summarize_aggregates_per_path_and_phase(self):
+        summary = summarize(self.profiles)
+        self.assertEqual(list(summary), ['/ingest/', '/send/', '/send_async/'])
+        self.assertIsNone(summary['/send_async/']['queries'])
+        send = summary['/send/']
+        self.assertEqual(send['requests'], 2)
+        self.assertAlmostEqual(send['mean'], 0.02)
+        self.assertEqual(send['p95'], 0.03)
+        self.assertEqual(send['queries'], 3)
+        self.assertEqual(list(send['phases']), ['save', 'parse'])
+        self.assertAlmostEqual(send['phases']['save']['share'], 0.5)
+        self.assertEqual(send['phases']['save']['queries'], 3)
+
+    def test_report_command_prints_each_path(self):
+        log = os.path.join(tempfile.mkdtemp(), 'profiles.jsonl')
+        with open(log, 'w') as f:
+            f.writelines(json.dumps(profile) + '\n' for profile in self.profiles)
+        out = StringIO()
+        call_command('profile_report', log, '--path', '/send/', stdout=out)
+        output = out.getvalue()
+        self.assertIn('/send/  2 requests', output)
+        self.assertIn('save', output)
+        self.assertNotIn('/ingest/', output)
+
+    def test_report_command_prints_na_for_uncounted_queries(self):
+        log = os.path.join(tempfile.mkdtemp(), 'profiles.jsonl')
+        with open(log, 'w') as f:
+            f.writelines(json.dumps(profile) + '\n' for profile in self.profiles)
+        out = StringIO()
+        call_command('profile_report', log, '--path', '/send_async/', stdout=out)
+        self.assertIn('n/a queries', out.getvalue())
@@ -0,0 +1,114 @@
+from decimal import Decimal
+from unittest import mock
+
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from wrapper.models import Server
+from wrapper.registry import REGISTRY, ServerEntry, ServerRegistry, ServerSnapshot
+
+
+class TestServerRegistry(TestCase):
+    def setUp(self):
+        REGISTRY.invalidate()
+        self.s1 = Server(url='server1', weight=0.3)
+        self.s1.save()
+        self.s2 = Server(url='server2', weight=0.7)
+        self.s2.save()
+
+    def test_snapshot_lists_servers_in_id_order(self):
+        registry = ServerRegistry(ttl=30)
+        snapshot = registry.snapshot()
+        self.assertEqual([s.url for s in snapshot], ['server1', 'server2'])
+        self.assertEqual(snapshot.get('server2').id, self.s2.id)
+        self.assertIsNone(snapshot.get('server3'))
+
+    def test_snapshot_is_cached_within_ttl(self):
+        registry = ServerRegistry(ttl=30)
+        snapshot = registry.snapshot()
+        with self.assertNumQueries(0):
+            self.assertIs(registry.snapshot(), snapshot)
+
+    def test_snapshot_reloads_after_ttl(self):
+        registry = ServerRegistry(ttl=0)
+        snapshot = registry.snapshot()
+        with self.assertNumQueries(1):
+            self.assertIsNot(registry.snapshot(), snapshot)
+
+    def tearDown(self):
+        Server.objects.all().delete()
+
+
+class TestServerChanges(TransactionTestCase):
+    def setUp(self):
+        self.s1 = Server.objects.create(url='server1', weight=0.3)
+        self.s2 = Server.objects.create(url='server2', weight=0.7)
+        REGISTRY.invalidate()
+
+    def test_saving_a_server_invalidates_the_shared_registry(self):
+        REGISTRY.snapshot()
+        Server(url='server3', weight=0.1).save()
+        self.assertEqual(len(REGISTRY.snapshot()), 3)
+
+    def test_deleting_a_server_invalidates_the_shared_registry(self):
+        REGISTRY.snapshot()
+        self.s2.delete()
+        self.assertEqual([s.url for s in REGISTRY.snapshot()], ['server1'])
+
+    def test_registry_is_invalidated_and_workers_told_only_on_commit(self):
+        REGISTRY.snapshot()
+        with mock.patch('wrapper.signals.ROUTING') as m_ROUTING:
+            with transaction.atomic():
+                Server(url='server3', weight=0.1).save()
+                self.assertEqual(len(REGISTRY.snapshot()), 2)
+        m_ROUTING.publish.assert_called_once_with('servers', using='default')
+        self.assertEqual(len(REGISTRY.snapshot()), 3)
+
+
+class TestServerSnapshot(SimpleTestCase):
+    def setUp(self):
+        self.snapshot = ServerSnapshot([
+            ServerEntry(1, 'server1', Decimal('0.25')),
+            ServerEntry(2, 'server2', Decimal('0')),
+            ServerEntry(3, 'server3', Decimal('0.75')),
+        ])
+
+    def test_weighted_choice_bisects_cumulative_weights(self):
+        self.assertEqual(self.snapshot.weighted_choice(rand=lambda: 0.0).url, 'server1')
+        self.assertEqual(self.snapshot.weighted_choice(rand=lambda: 0.24).url, 'server1')
+        self.assertEqual(self.snapshot.weighted_choice(rand=lambda: 0.25).url, 'server3')
+        self.assertEqual(self.snapshot.weighted_choice(rand=lambda: 0.9999).url, 'server3')
+
+    def test_weighted_choice_never_picks_zero_weight_servers(self):
+        picks = {self.snapshot.weighted_choice(rand=lambda: i / 100).url for i in range(100)}
+        self.assertEqual(picks, {'server1', 'server3'})
+
+    def test_weighted_choice_keeps_sub_hundredth_precision(self):
+        snapshot = ServerSnapshot([
+            ServerEntry(1, 'server1', Decimal('0.004')),
+            ServerEntry(2, 'server2', Decimal('0.004')),
+        ])
+        self.assertEqual(snapshot.weighted_choice(rand=lambda: 0.4).url, 'server1')
+        self.assertEqual(snapshot.weighted_choice(rand=lambda: 0.6).url, 'server2')
+
+    def test_weighted_choice_is_uniform_when_all_weights_are_zero(self):
+        snapshot = ServerSnapshot([
+            ServerEntry(1, 'server1', Decimal('0')),
+            ServerEntry(2, 'server2', Decimal('0')),
+        ])
+        self.assertEqual(snapshot.weighted_choice(rand=lambda: 0.7).url, 'server2')
+
+    def test_weighted_choice_raises_on_empty_snapshot(self):
+        with self.assertRaises(IndexError):
+            ServerSnapshot([]).weighted_choice()
+
+    def test_smooth_sequence_spreads_servers_by_weight(self):
+        snapshot = ServerSnapshot([
+            ServerEntry(1, 'a', Decimal('0.5')),
+            ServerEntry(2, 'b', Decimal('0.1')),
+            ServerEntry(3, 'c', Decimal('0.1')),
+        ])
+        self.assertEqual([s.url for s in snapshot.smooth_sequence], ['a', 'a', 'b', 'a', 'c', 'a', 'a'])
+
+    def test_smooth_sequence_skips_zero_weight_servers(self):
+        self.assertEqual([s.url for s in self.snapshot.smooth_sequence], ['server3', 'server1', 'server3', 'server3'])
@@ -0,0 +1,213 @@
+import threading
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+
+from wrapper.health import HEALTH
+from wrapper.load_balancer import LoadBalancer
+from wrapper.metrics import PROVIDER_FAILURES, SEND_RETRIES
+from wrapper.models import SentMessage, Server
+from wrapper.registry import REGISTRY
+from wrapper.retry import RetryPolicy, SendFailed, _Race
+from wrapper.throttle import Saturated
+
+
+class MockResponse:
+    def __init__(self, status_code=200, message_id="some_id"):
+        self.status_code = status_code
+        self.message_id = message_id
+
+    def json(self):
+        return {"message_id": self.message_id, "message": "nope"}
+
+
+class TestRetryPolicy(TestCase):
+    def setUp(self):
+        REGISTRY.invalidate()
+        HEALTH.reset()
+        for i in range(1, 4):
+            Server(url=f'server{i}', weight=1).save()
+        self.sleeps = []
+
+    def policy(self, **kwargs):
+        kwargs.setdefault('attempts', 3)
+        kwargs.setdefault('hedge', False)
+        return RetryPolicy(sleep=self.sleeps.append, rand=lambda: 1.0, **kwargs)
+
+    def test_backoff_grows_exponentially_up_to_the_cap(self):
+        policy = self.policy(base_delay=0.1, max_delay=0.5)
+        self.assertEqual([policy.backoff(n) for n in range(4)], [0.1, 0.2, 0.4, 0.5])
+        policy.rand = lambda: 0.5
+        self.assertEqual(policy.backoff(1), 0.1)
+
+    @mock.patch('wrapper.load_balancer.SESSIONS')
+    def test_retries_fail_over_to_servers_not_yet_tried(self, m_sessions):
+        m_sessions.post.side_effect = [MockResponse(500), MockResponse(500), MockResponse()]
+        lb = LoadBalancer(strategy='weighted_random')
+        retries = SEND_RETRIES.value()
+        failures = sum(PROVIDER_FAILURES.value(server=f'server{i}') for i in range(1, 4))
+
+        response = self.policy().send(lb, {}, idempotency_key='key')
+        self.assertEqual(SEND_RETRIES.value(), retries + 2)
+        self.assertEqual(sum(PROVIDER_FAILURES.value(server=f'server{i}') for i in range(1, 4)), failures + 2)
+
+        self.assertEqual(response.status_code, 200)
+        urls = [c[0][0] for c in m_sessions.post.call_args_list]
+        self.assertEqual(sorted(urls), ['server1', 'server2', 'server3'])
+        self.assertEqual({c[1]['headers']['Idempotency-Key'] for c in m_sessions.post.call_args_list}, {'key'})
+        self.assertEqual(self.sleeps, [0.1, 0.2])
+
+    def test_async_retries_fail_over_with_backoff(self):
+        async def post(url, headers=None, json=None):
+            return MockResponse(500) if len(lb.async_sessions.post.call_args_list) < 3 else MockResponse()
+
+        lb = LoadBalancer(strategy='weighted_random')
+        lb.async_sessions = mock.Mock()
+        lb.async_sessions.post.side_effect = post
+        sleeps = []
+
+        async def asleep(delay):
+            sleeps.append(delay)
+
+        response = async_to_sync(self.policy(asleep=asleep).asend)(lb, {}, idempotency_key='key')
+
+        self.assertEqual(response.status_code, 200)
+        urls = [c[0][0] for c in lb.async_sessions.post.call_args_list]
+        self.assertEqual(sorted(urls), ['server1', 'server2', 'server3'])
+        self.assertEqual(sleeps, [0.1, 0.2])
+        self.assertIn(lb.targeted_url, urls[-1:])
+
+    def test_async_send_stops_at_the_deadline(self):
+        balancer = mock.Mock()
+        balancer.achoose = mock.AsyncMock(return_value=mock.Mock(id=1))
+        balancer.arequest = mock.AsyncMock(side_effect=Exception('down'))
+        policy = self.policy(deadline=0.15, clock=lambda: 0, asleep=mock.AsyncMock())
+
+        self.assertIsNone(async_to_sync(policy.asend)(balancer, {}))
+        self.assertEqual(balancer.arequest.call_count, 2)
+
+    def test_gives_up_when_the_next_backoff_would_pass_the_deadline(self):
+        balancer = mock.Mock()
+        balancer.request.side_effect = Exception('down')
+        policy = self.policy(deadline=0.15, clock=lambda: 0)
+
+        self.assertIsNone(policy.send(balancer, {}))
+        self.assertEqual(balancer.request.call_count, 2)
+
+    def test_waiting_for_a_saturated_provider_does_not_use_an_attempt(self):
+        balancer = mock.Mock(max_wait=10)
+        balancer.request.side_effect = [Saturated(0.25), Saturated(0.25), MockResponse()]
+
+        response = self.policy(attempts=1).send(balancer, {})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sleeps, [0.25, 0.25])
+
+    def test_stops_waiting_for_room_after_max_wait(self):
+        balancer = mock.Mock(max_wait=1)
+        balancer.request.side_effect = Saturated(0.4)
+        policy = self.policy(clock=lambda: sum(self.sleeps))
+
+        self.assertIsNone(policy.send(balancer, {}))
+        self.assertEqual(self.sleeps, [0.4, 0.4])
+
+    def test_queued_sends_may_wait_for_room_until_the_deadline(self):
+        balancer = mock.Mock(max_wait=1)
+        balancer.request.side_effect = [Saturated(0.4)] * 5 + [MockResponse()]
+        policy = self.policy(clock=lambda: sum(self.sleeps), deadline=30)
+
+        self.assertEqual(policy.send(balancer, {}, max_wait=float('inf')).status_code, 200)
+        self.assertEqual(len(self.sleeps), 5)
+
+    @mock.patch('wrapper.load_balancer.SESSIONS')
+    def test_saturation_before_routing_excludes_no_server(self, m_sessions):
+        m_sessions.post.side_effect = [MockResponse(500), MockResponse()]
+        lb = LoadBalancer(strategy='round_robin')
+        # The previous message on this thread went to server1.
+        lb.release(lb.choose(exclude={2, 3}))
+        saturated_once = [Saturated(0.25)]
+
+        def choose(exclude=()):
+            if saturated_once:
+                raise saturated_once.pop()
+            return LoadBalancer.choose(lb, exclude=exclude)
+
+        with mock.patch.object(lb, 'choose', side_effect=choose) as m_choose:
+            response = self.policy(attempts=2).send(lb, {})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(m_sessions.post.call_args_list), 2)
+        # Only the server that actually failed is avoided on the retry.
+        self.assertEqual(len(m_choose.call_args_list[2][1]['exclude']), 1)
+
+    def test_hedge_waits_for_enough_round_trips(self):
+        policy = self.policy()
+        for _ in range(policy.min_samples - 1):
+            policy.observe(0.05)
+        self.assertIsNone(policy.hedge_delay())
+        policy.observe(0.05)
+        self.assertAlmostEqual(policy.hedge_delay(), 0.05)
+
+    @mock.patch('wrapper.load_balancer.SESSIONS')
+    def test_hedged_send_returns_the_first_success(self, m_sessions):
+        release = threading.Event()
+
+        def post(url, headers=None, json=None):
+            if url == 'server1':
+                release.wait(5)
+                return MockResponse(message_id='slow')
+            return MockResponse(message_id='fast')
+
+        m_sessions.post.side_effect = post
+        lb = LoadBalancer(strategy='round_robin')
+        lb.warm()
+        policy = self.policy(hedge=True)
+        for _ in range(policy.min_samples):
+            policy.observe(0.01)
+
+        payload = {'to_number': '9994440101', 'message': 'Vote.'}
+        with mock.patch.object(policy, '_save_duplicate') as m_save:
+            try:
+                response = policy.send(lb, payload)
+            finally:
+                release.set()
+            policy._hedge_executor().shutdown(wait=True)
+
+        self.assertEqual(response.json()['message_id'], 'fast')
+        self.assertIn(lb.targeted_url, ['server2', 'server3'])
+        # The slow copy is still delivered, so it is saved for its callback.
+        (saved_payload, server, duplicate), _ = m_save.call_args
+        self.assertEqual((saved_payload, server.url, duplicate.message_id), (payload, 'server1', 'slow'))
+
+    def test_duplicate_copies_are_saved_for_their_callbacks(self):
+        server = Server.objects.get(url='server1')
+        payload = {'to_number': '9994440101', 'message': 'Vote.'}
+        self.policy()._save_duplicate(payload, REGISTRY.snapshot().get('server1'), MockResponse(message_id='slow'))
+        duplicate = SentMessage.objects.get(uuid='slow')
+        self.assertEqual((duplicate.server, duplicate.number, duplicate.status), (server, '9994440101', 'pending'))
+
+    def test_hedged_send_falls_back_to_a_plain_send_when_the_pool_is_busy(self):
+        balancer = mock.Mock()
+        balancer.request.return_value = MockResponse()
+        policy = self.policy(hedge=True, hedge_concurrency=1)
+        for _ in range(policy.min_samples):
+            policy.observe(0.01)
+        policy._hedge_slots.acquire()
+
+        with mock.patch.object(policy, '_hedge_executor') as m_executor:
+            self.assertEqual(policy.send(balancer, {}).status_code, 200)
+        m_executor.assert_not_called()
+
+    def test_hedged_copy_is_not_started_after_the_deadline(self):
+        balancer = mock.Mock()
+        policy = self.policy(hedge=True, clock=lambda: 10)
+        policy._hedge_slots.acquire()
+        with self.assertRaises(SendFailed):
+            policy._send_to(balancer, mock.Mock(), {}, {}, _Race(), give_up_at=10)
+        balancer.request.assert_not_called()
+        balancer.release.assert_called_once()
+
+    def tearDown(self):
+        SentMessage.objects.all().delete()
+        Server.objects.all().delete()
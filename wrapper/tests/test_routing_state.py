@@ -0,0 +1,152 @@
+from decimal import Decimal
+import json
+from unittest import mock
+
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from wrapper.adaptive import WeightController
+from wrapper.health import CircuitBreaker, HealthRegistry
+from wrapper.inflight import InFlightCounter
+from wrapper.latency import LatencyTracker
+from wrapper.load_balancer import LoadBalancer
+from wrapper.models import RoutingSetting
+from wrapper.registry import ServerEntry, ServerSnapshot
+from wrapper.routing_state import LocalBackend, RoutingState
+from wrapper.throttle import Throttle
+from wrapper.views import LBView
+
+
+SERVERS = ServerSnapshot([ServerEntry(1, 'server1', Decimal('0.5')), ServerEntry(2, 'server2', Decimal('0.5'))])
+
+
+def worker(backend, registry=None, persist=True):
+    """
+    A balancer and its RoutingState, standing in for one worker process.
+    """
+    registry = registry or mock.MagicMock()
+    registry.snapshot.return_value = SERVERS
+    registry.peek.return_value = SERVERS
+    tracker = LatencyTracker()
+    health = HealthRegistry()
+    health.settings['min_requests'] = 2
+    balancer = LoadBalancer(
+        strategy='weighted_random', registry=registry, tracker=tracker, health=health, in_flight=InFlightCounter(),
+        throttle=Throttle(), weights=WeightController(tracker=tracker, health=health, enabled=True, damping=1),
+    )
+    state = RoutingState(backend, persist=persist)
+    state.attach(balancer)
+    return balancer, state
+
+
+class TestRoutingState(TestCase):
+    def setUp(self):
+        backend = LocalBackend()
+        self.first, self.first_state = worker(backend)
+        self.second, self.second_state = worker(backend)
+        self.first_state.start()
+        self.second_state.start()
+
+    def test_saved_strategy_reaches_other_workers(self):
+        self.first.set_strat('round_robin')
+        self.first_state.save_strategy('round_robin')
+        self.assertEqual(self.second.strategy, 'round_robin')
+        self.assertEqual(RoutingSetting.objects.get(name='strategy').value, 'round_robin')
+
+    def test_worker_started_later_loads_saved_strategy(self):
+        self.first_state.save_strategy('p2c')
+        late, late_state = worker(LocalBackend())
+        self.assertEqual(late.strategy, 'weighted_random')
+        late_state.start()
+        self.assertEqual(late.strategy, 'p2c')
+
+    def test_local_mode_does_not_persist_strategy(self):
+        RoutingSetting.objects.create(name='strategy', value='p2c')
+        with mock.patch.dict('os.environ', {'LB_SHARED_STATE': 'local'}):
+            balancer, state = worker(LocalBackend(), persist=None)
+        state.start()
+        self.assertEqual(balancer.strategy, 'weighted_random')
+        state.save_strategy('round_robin')
+        self.assertEqual(RoutingSetting.objects.get(name='strategy').value, 'p2c')
+
+    def test_opened_breaker_opens_on_other_workers(self):
+        self.first.health.record('server1', 500)
+        self.first.health.record('server1', 500)
+        self.assertEqual(self.first.health.breaker('server1').state, CircuitBreaker.OPEN)
+        self.assertEqual(self.second.health.breaker('server1').state, CircuitBreaker.OPEN)
+        self.assertEqual(self.second.health.breaker('server2').state, CircuitBreaker.CLOSED)
+
+    def test_closed_breaker_closes_on_other_workers(self):
+        self.first.health.record('server1', 500)
+        self.first.health.record('server1', 500)
+        self.first.health.breaker('server1').half_open()
+        self.first.health.record('server1', 200)
+        self.assertEqual(self.second.health.breaker('server1').state, CircuitBreaker.CLOSED)
+
+    def test_adjusted_weights_reach_other_workers(self):
+        self.first.tracker.observe(1, 100)
+        self.first.tracker.observe(2, 300)
+        adjusted = [server.weight for server in self.first.weights.apply(SERVERS)]
+        self.assertEqual(adjusted, [Decimal('1.00'), Decimal('0.33')])
+        # The other worker takes them on rather than adjusting from its own
+        # latencies, which it has none of.
+        self.assertEqual([server.weight for server in self.second.weights.apply(SERVERS)], adjusted)
+
+    def test_server_changes_invalidate_other_workers_registries(self):
+        self.first.registry.reset_mock()
+        self.second.registry.reset_mock()
+        self.first_state.publish('servers')
+        self.second.registry.invalidate.assert_called_once()
+        self.first.registry.invalidate.assert_not_called()
+
+    def test_ignores_its_own_messages(self):
+        with mock.patch.object(self.first, 'set_strat') as m_set_strat:
+            self.first_state.save_strategy('round_robin')
+        m_set_strat.assert_not_called()
+
+    def test_failing_handler_does_not_stop_the_others(self):
+        handler = mock.MagicMock()
+        self.second_state.on('servers', mock.MagicMock(side_effect=Exception('boom')))
+        self.second_state.on('servers', handler)
+        self.first_state.publish('servers')
+        handler.assert_called_once()
+
+    def test_request_starts_shared_state(self):
+        balancer, state = worker(LocalBackend())
+        balancer.sessions = mock.MagicMock()
+        balancer.sessions.post.return_value.status_code = 200
+        self.assertIsNone(balancer._warm_targets())
+        balancer.request({})
+        self.assertTrue(state.started)
+        self.assertEqual(balancer._warm_targets(), SERVERS)
+
+
+class TestLocalBackend(SimpleTestCase):
+    def test_publish_reaches_every_subscriber(self):
+        backend = LocalBackend()
+        received = []
+        backend.start(received.append, None)
+        backend.start(received.append, None)
+        backend.publish(json.dumps({'kind': 'servers'}))
+        self.assertEqual(len(received), 2)
+
+
+class TestLocalBackendOnCommit(TransactionTestCase):
+    def test_publish_for_a_transaction_waits_for_its_commit(self):
+        backend = LocalBackend()
+        received = []
+        backend.start(received.append, None)
+        with transaction.atomic():
+            backend.publish(json.dumps({'kind': 'servers'}), using='default')
+            self.assertEqual(received, [])
+        self.assertEqual(len(received), 1)
+
+
+class TestLBViewPersistsStrategy(TestCase):
+    def test_update_lb_strat_saves_strategy(self):
+        request = mock.MagicMock(body=json.dumps({'strategy': 'least_outstanding'}))
+        balancer = LoadBalancer(registry=mock.MagicMock())
+        with mock.patch('wrapper.views.LB', balancer), \
+                mock.patch('wrapper.views.ROUTING', RoutingState(LocalBackend(), persist=True)):
+            LBView().post(request)
+        self.assertEqual(RoutingSetting.objects.get(name='strategy').value, 'least_outstanding')
@@ -0,0 +1,59 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from wrapper.sessions import SessionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"message_id": "abc"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSessionPool(SimpleTestCase):
+    def test_session_is_reused_per_url(self):
+        pool = SessionPool()
+        self.assertIs(pool.session('http://a'), pool.session('http://a'))
+        self.assertIsNot(pool.session('http://a'), pool.session('http://b'))
+
+    def test_post_applies_configured_timeouts(self):
+        pool = SessionPool(connect_timeout=1, read_timeout=2)
+        with mock.patch('requests.Session.post') as m_post:
+            pool.post('http://a', json={})
+            pool.post('http://a', json={}, timeout=5)
+        self.assertEqual(m_post.call_args_list, [
+            mock.call('http://a', json={}, timeout=(1.0, 2.0)),
+            mock.call('http://a', json={}, timeout=5),
+        ])
+
+    def test_stats_report_connection_reuse(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f'http://127.0.0.1:{server.server_port}/'
+        pool = SessionPool()
+        try:
+            for _ in range(4):
+                self.assertEqual(pool.post(url, json={}).json(), {'message_id': 'abc'})
+            stats = pool.stats()[url]
+        finally:
+            pool.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['connections_opened'], 1)
+        self.assertEqual(stats['connections_idle'], 1)
+        self.assertEqual(stats['reuse_ratio'], 0.75)
@@ -0,0 +1,55 @@
+from django.test import SimpleTestCase
+
+from wrapper.registry import ServerEntry
+from wrapper.throttle import Throttle, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(SimpleTestCase):
+    def test_allows_a_burst_then_refills_at_rate(self):
+        clock = Clock()
+        bucket = TokenBucket(rate=2, burst=3, clock=clock)
+        self.assertEqual([bucket.try_acquire() for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.wait_time(), 0.5)
+        clock.now = 0.5
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.available())
+
+    def test_refund_returns_a_token_up_to_burst(self):
+        bucket = TokenBucket(rate=1, burst=1, clock=Clock())
+        self.assertTrue(bucket.try_acquire())
+        bucket.refund()
+        self.assertTrue(bucket.try_acquire())
+        bucket.refund()
+        bucket.refund()
+        self.assertEqual(bucket.tokens, 1)
+
+    def test_never_holds_more_than_burst(self):
+        clock = Clock()
+        bucket = TokenBucket(rate=10, burst=2, clock=clock)
+        clock.now = 60
+        self.assertEqual([bucket.try_acquire() for _ in range(3)], [True, True, False])
+
+
+class TestThrottle(SimpleTestCase):
+    def test_unlimited_servers_are_never_throttled(self):
+        throttle = Throttle()
+        server = ServerEntry(1, 'server1', 1)
+        self.assertTrue(all(throttle.try_acquire(server) for _ in range(100)))
+        self.assertEqual(throttle.wait_time([server]), 0)
+
+    def test_bucket_is_replaced_when_the_rate_changes(self):
+        throttle = Throttle(burst_seconds=1, clock=Clock())
+        slow = ServerEntry(1, 'server1', 1, rate_limit=1)
+        self.assertTrue(throttle.try_acquire(slow))
+        self.assertFalse(throttle.available(slow))
+        fast = slow._replace(rate_limit=5)
+        self.assertEqual([throttle.try_acquire(fast) for _ in range(6)], [True] * 5 + [False])
+        self.assertAlmostEqual(throttle.wait_time([fast]), 0.2)
@@ -1,18 +1,27 @@
+import base64
+from datetime import timedelta
 import json
+import os
 from unittest import mock
 
+from asgiref.sync import async_to_sync
 from django.http import JsonResponse
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
 from django.utils import timezone
 
+from wrapper.blocklist import INVALID_NUMBERS
+from wrapper.health import HEALTH
+from wrapper.latency import TRACKER
 from wrapper.load_balancer import LoadBalancer
 from wrapper.models import InvalidNumber, SentMessage, Server
-from wrapper.views import SendView, LBView, CallbackView
+from wrapper.registry import REGISTRY
+from wrapper.views import SendView, SendBatchView, LBView, CallbackView, ListMessageView, send_async
 
 
 class MockRequest:
-    def __init__(self, body=None):
+    def __init__(self, body=None, method="POST"):
         self.body = body
+        self.method = method
 
 class MockResponse:
     def __init__(self, body=None, status_code=200):
@@ -43,7 +52,7 @@ class TestSend(TestCase):
     @mock.patch("wrapper.views.JsonResponse")
     @mock.patch("wrapper.views.LB")
     def test_send_returns_502_if_it_exceeds_retry_count(self, m_LB, m_jsonresp):
-        def side_effect(data, headers=None):
+        def side_effect(data, headers=None, exclude=(), server=None):
             raise Exception('The bears have really bad news.')
         m_LB.request.side_effect = side_effect
         data = json.dumps({
@@ -97,9 +106,149 @@ class TestSend(TestCase):
         SentMessage.objects.all().delete()
         InvalidNumber.objects.all().delete()
 
+class TestSendBatch(TestCase):
+    def setUp(self):
+        InvalidNumber(number="2223334444").save()
+
+    def test_send_batch_rejects_a_malformed_body(self):
+        for body in ['{"number": "1"}', '[]', '[{"number": "1"}]']:
+            response = SendBatchView().post(MockRequest(body=body))
+            self.assertEqual(response.status_code, 400)
+
+    @mock.patch("wrapper.views.LB")
+    def test_send_batch_reports_a_result_per_item(self, m_LB):
+        def side_effect(data, headers=None, exclude=(), server=None):
+            if data["to_number"] == "6667778888":
+                raise Exception("The bears have really bad news.")
+            return MockResponse()
+        m_LB.request.side_effect = side_effect
+        data = json.dumps([
+            {"number": "9994440101", "message": "Vote."},
+            {"number": "2223334444", "message": "Blocked."},
+            {"number": "6667778888", "message": "Doomed."},
+            {"number": "9994440102", "message": "Vote again."},
+        ])
+        REGISTRY.snapshot()
+        INVALID_NUMBERS.refresh()
+
+        with self.assertNumQueries(2):
+            response = SendBatchView().post(MockRequest(body=data))
+
+        results = json.loads(response.content)["results"]
+        self.assertEqual([r["status"] for r in results], [200, 400, 502, 200])
+        self.assertEqual([r["number"] for r in results], ["9994440101", "2223334444", "6667778888", "9994440102"])
+        self.assertEqual(
+            sorted(SentMessage.objects.values_list("number", flat=True)),
+            ["9994440101", "9994440102"]
+        )
+        self.assertEqual(m_LB.request.call_count, 4)
+
+    @mock.patch("wrapper.views.LB")
+    def test_send_batch_fails_only_items_answered_without_a_message_id(self, m_LB):
+        no_message_id = mock.MagicMock(status_code=200)
+        no_message_id.json.return_value = {"message": "accepted"}
+
+        def side_effect(data, headers=None, exclude=(), server=None):
+            return no_message_id if data["to_number"] == "6667778888" else MockResponse()
+        m_LB.request.side_effect = side_effect
+        data = json.dumps([
+            {"number": "9994440101", "message": "Vote."},
+            {"number": "6667778888", "message": "Lost."},
+        ])
+
+        with self.assertLogs("wrapper.views", level="ERROR"):
+            response = SendBatchView().post(MockRequest(body=data))
+
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)["results"]
+        self.assertEqual([r["status"] for r in results], [200, 502])
+        self.assertEqual(list(SentMessage.objects.values_list("number", flat=True)), ["9994440101"])
+
+    @mock.patch.dict(os.environ, {"SEND_MODE": "queue"})
+    @mock.patch("wrapper.views.LB")
+    def test_send_batch_queues_messages_in_queue_mode(self, m_LB):
+        data = json.dumps([
+            {"number": "9994440101", "message": "Vote."},
+            {"number": "2223334444", "message": "Blocked."},
+        ])
+        response = SendBatchView().post(MockRequest(body=data))
+        results = json.loads(response.content)["results"]
+        self.assertEqual([r["status"] for r in results], [202, 400])
+        m_LB.request.assert_not_called()
+        self.assertEqual(list(SentMessage.objects.values_list("status", "message")), [("queued", "Vote.")])
+
+    def tearDown(self):
+        SentMessage.objects.all().delete()
+        InvalidNumber.objects.all().delete()
+
+
+class TestSendAsync(TestCase):
+    def setUp(self):
+        REGISTRY.invalidate()
+        HEALTH.reset()
+        InvalidNumber(number="2223334444").save()
+        self.server = Server(url="server1", weight=1)
+        self.server.save()
+
+    def test_send_async_rejects_other_methods(self):
+        response = async_to_sync(send_async)(MockRequest(method="GET"))
+        self.assertEqual(response.status_code, 405)
+
+    def test_send_async_returns_400_if_given_invalid_number(self):
+        data = json.dumps({
+            "number": "2223334444",
+            "message": "The text is coming from inside the internet."
+        })
+        response = async_to_sync(send_async)(MockRequest(body=data))
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch("wrapper.load_balancer.ASYNC_SESSIONS")
+    def test_send_async_saves_sent_message_on_success(self, m_sessions):
+        async def post(url, headers=None, json=None):
+            return MockResponse()
+        m_sessions.post.side_effect = post
+        lb = LoadBalancer()
+        data = json.dumps({
+            "number": "9994440101",
+            "message": "Vote."
+        })
+        with mock.patch("wrapper.views.LB", lb):
+            response = async_to_sync(send_async)(MockRequest(body=data))
+        self.assertEqual(response.status_code, 200)
+        headers = {"Content-Type": "application/json", "Idempotency-Key": mock.ANY}
+        m_sessions.post.assert_called_once_with("server1", headers=headers, json={
+            "to_number": "9994440101",
+            "message": "Vote.",
+            "callback_url": None,
+        })
+        sm = SentMessage.objects.get(uuid="some_id")
+        self.assertEqual(sm.server, self.server)
+        self.assertEqual(sm.status, "pending")
+
+    @mock.patch("wrapper.load_balancer.ASYNC_SESSIONS")
+    def test_send_async_returns_502_if_it_exceeds_retry_count(self, m_sessions):
+        async def post(url, headers=None, json=None):
+            raise Exception("The bears have really bad news.")
+        m_sessions.post.side_effect = post
+        data = json.dumps({
+            "number": "6667778888",
+            "message": "You're doing it, Peter."
+        })
+        with mock.patch("wrapper.views.LB", LoadBalancer()):
+            response = async_to_sync(send_async)(MockRequest(body=data))
+        self.assertEqual(response.status_code, 502)
+        self.assertFalse(SentMessage.objects.exists())
+
+    def tearDown(self):
+        Server.objects.all().delete()
+        SentMessage.objects.all().delete()
+        InvalidNumber.objects.all().delete()
+
+
 class TestUpdateLBStrategy(TestCase):
+    @mock.patch("wrapper.views.ROUTING")
     @mock.patch("wrapper.views.LB")
-    def test_update_lb_strategy_calls_set_strat_on_LB(self, m_LB):
+    def test_update_lb_strategy_calls_set_strat_on_LB(self, m_LB, m_ROUTING):
         data = json.dumps({
             "strategy": "weighted_random"
         })
@@ -107,14 +256,16 @@ class TestUpdateLBStrategy(TestCase):
         LBView().post(request)
         m_LB.set_strat.assert_called_with("weighted_random")
 
+    @mock.patch("wrapper.views.ROUTING")
     @mock.patch("wrapper.views.JsonResponse")
     @mock.patch("wrapper.views.LB")
-    def test_update_lb_strategy_returns_200(self, m_LB, m_jsonresp):
+    def test_update_lb_strategy_returns_200(self, m_LB, m_jsonresp, m_ROUTING):
         data = json.dumps({
             "strategy": "weighted_random"
         })
         request = MockRequest(body=data)
         LBView().post(request)
+        m_ROUTING.save_strategy.assert_called_with(m_LB.strategy)
         m_jsonresp.assert_called_with({
             "status": 200,
             "message": "Load Balancer strategy successfully updated."
@@ -123,7 +274,7 @@ class TestUpdateLBStrategy(TestCase):
     @mock.patch("wrapper.views.JsonResponse")
     @mock.patch("wrapper.views.LB")
     def test_update_lb_strategy_returns_500_if_error(self, m_LB, m_jsonresp):
-        def side_effect(data, headers=None):
+        def side_effect(data, headers=None, exclude=()):
             raise Exception("I'm afraid I can't do that, Dave.")
         m_LB.set_strat.side_effect = side_effect
 
@@ -142,8 +293,10 @@ class TestUpdateLBStrategy(TestCase):
 
 class TestCallback(TestCase):
     def setUp(self):
+        TRACKER.reset()
         s1 = Server(url="server1", weight=0.4)
         s1.save()
+        self.s1 = s1
         start = timezone.now()
         SentMessage(
             uuid="1234",
@@ -175,3 +328,93 @@ class TestCallback(TestCase):
         })
         request = MockRequest(body=data)
         CallbackView().post(request)
+
+    def test_callback_records_latency_for_the_sending_server(self):
+        data = json.dumps({
+            "message_id": "1234",
+            "status": "delivered"
+        })
+        request = MockRequest(body=data)
+        CallbackView().post(request)
+        sm = SentMessage.objects.get(uuid="1234")
+        self.assertEqual(TRACKER.estimate(self.s1.id), sm.latency())
+
+    def test_repeated_invalid_callbacks_record_the_number_once(self):
+        SentMessage(
+            uuid="9012",
+            number="0192019211",
+            server=self.s1,
+            status="pending",
+            start_time=timezone.now()
+        ).save()
+        for message_id in ["5678", "9012"]:
+            data = json.dumps({
+                "message_id": message_id,
+                "status": "invalid"
+            })
+            CallbackView().post(MockRequest(body=data))
+        self.assertEqual(InvalidNumber.objects.filter(number="0192019211").count(), 1)
+
+
+class TestListMessages(TestCase):
+    def setUp(self):
+        self.s1 = Server(url="server1", weight=0.5)
+        self.s1.save()
+        self.s2 = Server(url="server2", weight=0.5)
+        self.s2.save()
+        self.start = timezone.now()
+        for i in range(5):
+            SentMessage(
+                uuid=f"id{i}",
+                number=f"555000000{i}",
+                server=self.s1 if i % 2 == 0 else self.s2,
+                status="delivered" if i < 3 else "pending",
+                start_time=self.start + timedelta(seconds=i // 2)
+            ).save()
+        self.factory = RequestFactory()
+
+    def get(self, **params):
+        return ListMessageView().get(self.factory.get("/list_messages/", params))
+
+    def test_list_messages_pages_through_every_message_in_order(self):
+        uuids = []
+        params = {"limit": 2}
+        while True:
+            body = json.loads(self.get(**params).content)
+            uuids.extend(message["uuid"] for message in body["data"])
+            if body["next_cursor"] is None:
+                break
+            params["cursor"] = body["next_cursor"]
+        self.assertEqual(uuids, ["id0", "id1", "id2", "id3", "id4"])
+
+    def test_list_messages_filters_by_status_server_and_number(self):
+        body = json.loads(self.get(status="delivered", server=self.s1.id).content)
+        self.assertEqual([m["uuid"] for m in body["data"]], ["id0", "id2"])
+        body = json.loads(self.get(number="5550000003").content)
+        self.assertEqual([m["uuid"] for m in body["data"]], ["id3"])
+
+    def test_list_messages_filters_by_time_range(self):
+        since = (self.start + timedelta(seconds=1)).isoformat()
+        until = (self.start + timedelta(seconds=2)).isoformat()
+        body = json.loads(self.get(since=since, until=until).content)
+        self.assertEqual([m["uuid"] for m in body["data"]], ["id2", "id3"])
+
+    def test_list_messages_rejects_bad_parameters(self):
+        for params in [{"limit": "ten"}, {"limit": 0}, {"cursor": "nope"}, {"since": "yesterday"}, {"server": "x"}]:
+            self.assertEqual(self.get(**params).status_code, 400)
+
+    def test_list_messages_rejects_out_of_range_dates_and_bad_cursor_ids(self):
+        def cursor(position):
+            return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+        for params in [{"since": "2020-13-01T00:00:00"}, {"until": "2020-01-01T25:00:00"},
+                       {"cursor": cursor(["2020-01-01T00:00:00", "x"])},
+                       {"cursor": cursor(["2020-01-01T00:00:00", None])},
+                       {"cursor": cursor(["2020-13-01T00:00:00", 1])}]:
+            self.assertEqual(self.get(**params).status_code, 400)
+
+    def test_list_messages_streams_ndjson_export(self):
+        response = self.get(format="ndjson", status="pending")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)["uuid"] for line in lines], ["id3", "id4"])
@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+
+
+class Saturated(Exception):
+    """
+    Raised when every provider is at its rate limit or concurrency cap.
+    `retry_after` is how long, in seconds, until one should have room.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f'Every provider is at capacity; retry in {retry_after:.3f}s')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average, with bursts of up to
+    `burst` requests. Tokens are refilled lazily from the elapsed time
+    whenever the bucket is looked at.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.clock = clock
+        self.tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def refund(self):
+        """
+        Gives back a token taken for a request that was never sent.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens >= 1
+
+    def wait_time(self):
+        """
+        Seconds until the next token is due.
+        """
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class Throttle:
+    """
+    One TokenBucket per provider with a Server.rate_limit. Buckets hold
+    THROTTLE_BURST_SECONDS (1) seconds' worth of tokens and are replaced
+    when a provider's rate changes.
+
+    Limits are enforced per process, so with several workers each should
+    be given its share of the provider's account limit.
+    """
+
+    def __init__(self, burst_seconds=None, clock=time.monotonic):
+        self.burst_seconds = float(burst_seconds or os.getenv('THROTTLE_BURST_SECONDS', '1'))
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def bucket(self, server):
+        if not server.rate_limit:
+            return None
+        bucket = self._buckets.get(server.url)
+        if bucket is None or bucket.rate != server.rate_limit:
+            with self._lock:
+                bucket = self._buckets.get(server.url)
+                if bucket is None or bucket.rate != server.rate_limit:
+                    burst = max(1.0, server.rate_limit * self.burst_seconds)
+                    bucket = self._buckets[server.url] = TokenBucket(server.rate_limit, burst, self.clock)
+        return bucket
+
+    def available(self, server):
+        bucket = self.bucket(server)
+        return bucket is None or bucket.available()
+
+    def try_acquire(self, server):
+        bucket = self.bucket(server)
+        return bucket is None or bucket.try_acquire()
+
+    def refund(self, server):
+        bucket = self.bucket(server)
+        if bucket is not None:
+            bucket.refund()
+
+    def wait_time(self, servers):
+        """
+        Seconds until any of `servers` has a token.
+        """
+        waits = [self.bucket(server).wait_time() if self.bucket(server) else 0.0 for server in servers]
+        return min(waits, default=0.0)
+
+    def reset(self):
+        with self._lock:
+            self._buckets = {}
+
+
+THROTTLE = Throttle()
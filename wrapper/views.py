@@ -2,21 +2,37 @@ import json
 import logging
 import os
 
-from django.http import JsonResponse, HttpResponse
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
 from django.shortcuts import render
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
+from wrapper.analytics import STATS, parse_window
+from wrapper.blocklist import INVALID_NUMBERS
+from wrapper.dispatch import build_request, forward, forward_many
+from wrapper.health import HEALTH
+from wrapper.ingest import CALLBACKS, callback_error
+from wrapper.latency import TRACKER
 from wrapper.load_balancer import LoadBalancer
-from wrapper.models import InvalidNumber, SentMessage, Server
+from wrapper.metrics import DELIVERY_SECONDS, INVALID_NUMBERS_TOTAL, METRICS
+from wrapper.models import InvalidNumber, SentMessage
+from wrapper.pagination import InvalidQuery, encode_cursor, filter_messages, page_limit
+from wrapper.profiling import phase
+from wrapper.registry import REGISTRY
+from wrapper.retry import RETRY_POLICY
+from wrapper.routing_state import ROUTING
+from wrapper.sessions import SESSIONS
 
 
 logger = logging.getLogger(__name__)
 
 
 LB = LoadBalancer()
+ROUTING.attach(LB)
 
 
 class SendView(View):
@@ -25,19 +41,31 @@ class SendView(View):
         return super(SendView, self).dispatch(request, *args, **kwargs)
 
     def post(self, request):
-        request_body = json.loads(request.body)
+        with phase('parse'):
+            request_body = json.loads(request.body)
 
-        if request_body["number"] in InvalidNumber.objects.values_list("number", flat=True):
+        with phase('invalid_number'):
+            is_invalid = INVALID_NUMBERS.contains(request_body["number"])
+        if is_invalid:
+            INVALID_NUMBERS_TOTAL.inc(source='rejected')
             return JsonResponse({
                     "status": 400,
                     "message": "The number you have submitted has been marked invalid by our SMS providers."
                 }, status=400)
 
-        request_to_forward = {
-            "to_number": request_body["number"],
-            "message": request_body["message"],
-            "callback_url": os.getenv('CALLBACK_URL'),
-        }
+        if os.getenv('SEND_MODE', 'sync') == 'queue':
+            SentMessage(
+                number = request_body["number"],
+                message = request_body["message"],
+                status = "queued",
+                start_time = timezone.now(),
+            ).save()
+            return JsonResponse({
+                "status": 202,
+                "message": "Data accepted for forwarding."
+            }, status=202)
+
+        request_to_forward = build_request(request_body["number"], request_body["message"])
 
         sm = SentMessage(
             number = request_body["number"],
@@ -45,21 +73,9 @@ class SendView(View):
             start_time = timezone.now(),
         )
 
-        retry_count = 0
-        response = None
-
-        while retry_count < int(os.getenv('MAX_RETRY', '2')):
-            try: 
-                response = LB.request(request_to_forward, headers={"Content-Type": "application/json"})
-                if response.status_code != 200:
-                    print(response.status_code)
-                    raise Exception(response.json()["message"])
-                break
-            except Exception as e:
-                logger.error(f'The following exception occured:\n{e}')
-                retry_count += 1
+        response = forward(LB, request_to_forward)
 
-        if retry_count >= int(os.getenv('MAX_RETRY', '2')):
+        if response is None:
             sm.status = 'failed_to_send'
             return JsonResponse({
                 "status": 502,
@@ -67,15 +83,161 @@ class SendView(View):
             }, status=502)
 
         sm.uuid = response.json()["message_id"]
-        sm.server = Server.objects.filter(url=LB.targeted_url).first()
+        target = REGISTRY.snapshot().get(LB.targeted_url)
+        sm.server_id = target.id if target else None
 
-
-        sm.save()
+        with phase('save'):
+            sm.save()
         return JsonResponse({
             "status": 200,
             "message": "Data successfully forwarded."
         }, status=200)
 
+class SendBatchView(View):
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super(SendBatchView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        try:
+            with phase('parse'):
+                items = json.loads(request.body)
+            if not isinstance(items, list) or not items:
+                raise ValueError("Expected a non-empty array of messages.")
+            if len(items) > int(os.getenv('SEND_BATCH_MAX', '1000')):
+                raise ValueError("Too many messages in one batch.")
+            numbers = [str(item["number"]) for item in items]
+            texts = [str(item["message"]) for item in items]
+        except (ValueError, KeyError, TypeError) as e:
+            return JsonResponse({
+                "status": 400,
+                "message": f"Invalid batch: {e}"
+            }, status=400)
+
+        with phase('invalid_number'):
+            invalid_numbers = INVALID_NUMBERS.filter(set(numbers))
+        results = [None] * len(items)
+        to_send = []
+        for index, number in enumerate(numbers):
+            if number in invalid_numbers:
+                INVALID_NUMBERS_TOTAL.inc(source='rejected')
+                results[index] = {
+                    "number": number,
+                    "status": 400,
+                    "message": "The number you have submitted has been marked invalid by our SMS providers."
+                }
+            else:
+                to_send.append(index)
+
+        if os.getenv('SEND_MODE', 'sync') == 'queue':
+            now = timezone.now()
+            SentMessage.objects.bulk_create([
+                SentMessage(number=numbers[i], message=texts[i], status="queued", start_time=now)
+                for i in to_send
+            ])
+            for index in to_send:
+                results[index] = {
+                    "number": numbers[index],
+                    "status": 202,
+                    "message": "Data accepted for forwarding."
+                }
+            return JsonResponse({"status": 200, "results": results}, status=200)
+
+        sent = forward_many(LB, [build_request(numbers[i], texts[i]) for i in to_send])
+        servers = REGISTRY.snapshot()
+        messages = []
+        for index, (response, url, start_time) in zip(to_send, sent):
+            if response is None:
+                results[index] = {
+                    "number": numbers[index],
+                    "status": 502,
+                    "message": "Bad gateway. Failed to forward data. Max retries exceeded."
+                }
+                continue
+            try:
+                message_id = response.json()["message_id"]
+            except (ValueError, KeyError, TypeError) as e:
+                # Already sent, but its callback could never be matched.
+                logger.error(f'The following exception occured:\n{e}')
+                results[index] = {
+                    "number": numbers[index],
+                    "status": 502,
+                    "message": "Bad gateway. The provider's answer had no message_id."
+                }
+                continue
+            target = servers.get(url)
+            messages.append(SentMessage(
+                uuid=message_id,
+                number=numbers[index],
+                status="pending",
+                start_time=start_time,
+                server_id=target.id if target else None,
+            ))
+            results[index] = {
+                "number": numbers[index],
+                "status": 200,
+                "message": "Data successfully forwarded."
+            }
+
+        with phase('save'):
+            SentMessage.objects.bulk_create(messages)
+        return JsonResponse({"status": 200, "results": results}, status=200)
+
+async def send_async(request):
+    """
+    Async twin of SendView for deployments served through text_api.asgi.
+    The provider round trip, including retries, is awaited instead of
+    holding a worker thread, so one process can keep many sends in flight.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    with phase('parse'):
+        request_body = json.loads(request.body)
+
+    # The cache only needs the database to refresh itself or to confirm a
+    # possible match, so most numbers are cleared without leaving the loop.
+    with phase('invalid_number'):
+        if INVALID_NUMBERS.is_fresh() and not INVALID_NUMBERS.might_contain(request_body["number"]):
+            is_invalid = False
+        else:
+            is_invalid = await sync_to_async(INVALID_NUMBERS.contains, thread_sensitive=True)(request_body["number"])
+    if is_invalid:
+        INVALID_NUMBERS_TOTAL.inc(source='rejected')
+        return JsonResponse({
+                "status": 400,
+                "message": "The number you have submitted has been marked invalid by our SMS providers."
+            }, status=400)
+
+    request_to_forward = build_request(request_body["number"], request_body["message"])
+
+    sm = SentMessage(
+        number = request_body["number"],
+        status = "pending",
+        start_time = timezone.now(),
+    )
+
+    response = await RETRY_POLICY.asend(LB, request_to_forward)
+    if response is None:
+        return JsonResponse({
+            "status": 502,
+            "message": "Bad gateway. Failed to forward data. Max retries exceeded."
+        }, status=502)
+
+    sm.uuid = response.json()["message_id"]
+    sm.server_id = LB.targeted_server.id
+
+    with phase('save'):
+        await sync_to_async(sm.save, thread_sensitive=True)()
+    return JsonResponse({
+        "status": 200,
+        "message": "Data successfully forwarded."
+    }, status=200)
+
+
+send_async.csrf_exempt = True
+
+
 class LBView(View):
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
@@ -85,6 +247,7 @@ class LBView(View):
         try:
             request_body = json.loads(request.body)
             LB.set_strat(request_body["strategy"])
+            ROUTING.save_strategy(LB.strategy)
 
             response_body = {
                 "status": 200,
@@ -101,26 +264,39 @@ class LBView(View):
 class CallbackView(View):
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
-        print("dispatching")
         return super(CallbackView, self).dispatch(request, *args, **kwargs)
 
     def post(self, request):
-        print("handling post")
         try:
-            print(request.body)
             request_body = json.loads(request.body)
+            logger.debug(f'Received callback: {request_body}')
+            error = callback_error(request_body)
+            if error:
+                return JsonResponse({
+                    "status": 400,
+                    "message": error
+                }, status=400)
 
-            print(request_body)
+            if os.getenv('CALLBACK_MODE', 'direct') == 'buffered':
+                CALLBACKS.add(request_body["message_id"], request_body["status"])
+                return JsonResponse({
+                    "status": 200,
+                    "message": "Data ingested."
+                })
 
             sm = SentMessage.objects.filter(uuid=request_body["message_id"])[0]
             end_time = timezone.now()
 
             if request_body["status"] == "invalid":
-                InvalidNumber(number=sm.number).save()
+                _, created = InvalidNumber.objects.get_or_create(number=sm.number)
+                if created:
+                    INVALID_NUMBERS_TOTAL.inc(source='reported')
 
             sm.end_time = end_time
             sm.status = request_body["status"]
             sm.save()
+            TRACKER.observe(sm.server_id, sm.latency())
+            DELIVERY_SECONDS.observe(sm.latency() / 1e6, server=REGISTRY.url_for(sm.server_id))
             return JsonResponse({
                 "status": 200,
                 "message": "Data ingested."
@@ -137,7 +313,71 @@ class ListMessageView(View):
         return super(ListMessageView, self).dispatch(request, *args, **kwargs)
 
     def get(self, request):
-        messages = list(SentMessage.objects.values())
-        return JsonResponse({'data': messages})
+        try:
+            messages = filter_messages(request.GET).values()
+            if request.GET.get('format') == 'ndjson':
+                # iterator() reads through a server-side cursor, so memory use
+                # does not grow with the size of the export.
+                rows = messages.iterator(chunk_size=2000)
+                return StreamingHttpResponse(
+                    (json.dumps(row, cls=DjangoJSONEncoder) + "\n" for row in rows),
+                    content_type='application/x-ndjson',
+                )
+            limit = page_limit(request.GET)
+        except InvalidQuery as e:
+            return JsonResponse({
+                "status": 400,
+                "message": f"{e}"
+            }, status=400)
 
+        page = list(messages[:limit + 1])
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return JsonResponse({'data': page[:limit], 'next_cursor': next_cursor})
+
+
+class ProviderPoolView(View):
+    def get(self, request):
+        return JsonResponse({
+            "status": 200,
+            "data": SESSIONS.stats(),
+        }, status=200)
+
+
+class ProviderHealthView(View):
+    def get(self, request):
+        return JsonResponse({
+            "status": 200,
+            "data": HEALTH.states(),
+        }, status=200)
 
+
+class LBWeightsView(View):
+    def get(self, request):
+        return JsonResponse({
+            "status": 200,
+            "data": {
+                "strategy": LB.strategy,
+                "adaptive": LB.weights.enabled,
+                "servers": LB.weights.describe(LB.targets),
+            },
+        }, status=200)
+
+
+class StatsView(View):
+    def get(self, request):
+        try:
+            window, bucket = parse_window(request.GET)
+        except InvalidQuery as e:
+            return JsonResponse({
+                "status": 400,
+                "message": f"{e}"
+            }, status=400)
+        return JsonResponse({
+            "status": 200,
+            "data": STATS.get(window, bucket),
+        }, status=200)
+
+
+class MetricsView(View):
+    def get(self, request):
+        return HttpResponse(METRICS.render(), content_type='text/plain; version=0.0.4; charset=utf-8')